@@ -1,118 +1,216 @@
 import numpy as np
 import gc
+import operator
 from setup import set_good_events
-from cut_ditau_functions import make_ditau_region, make_ditau_cut
+from cut_ditau_functions import make_ditau_cut
 from cut_mutau_functions import make_mutau_region, make_mutau_cut
-from cut_etau_functions  import make_etau_region,  make_etau_cut
+from cut_etau_functions  import make_etau_cut
 from cut_dimuon_functions  import make_dimuon_region, make_dimuon_cut
 from cut_emu_functions  import make_emu_region, make_emu_cut
+from cut_ditau_functions  import ditau_region_predicates,  ditau_region_mask
+from cut_mutau_functions  import mutau_region_predicates,  mutau_region_mask
+from cut_etau_functions   import etau_region_predicates,   etau_region_mask
+from cut_dimuon_functions import dimuon_region_predicates, dimuon_region_mask
+from cut_emu_functions    import emu_region_predicates,    emu_region_mask, emu_DZeta_value
 from FF_dictionary import FF_fit_values, FF_mvis_weights
 from calculate_functions import user_exp, user_line, user_line_p_const
+from columnar_functions import gather, store_selection
 from plotting_functions import set_vars_to_plot
 
+### README
+# Every FF region of a final state (SR, AR, DRsr, DRar, their aiso versions, and the combined AR_star/DRar_star)
+# is stored as one bit of the uint16 branch "region_flags_<final state>_<DeepTau version>", named after the
+# settings it was made with so it is never reused for others. The per-event quantities the regions are built from
+# (pair sign, lepton isolation, DeepTau working point, mt, b-tag veto) are computed once by <final state>_region_predicates,
+# each region is a boolean combination of them from <final state>_region_mask, and selecting a region is then
+# np.flatnonzero(region_flags & FF_region_bits[region]).
+# The mutau and etau determination regions differ between the QCD and WJ fake factors, so the WJ versions have their own bits.
+# The SR requirements on flat branches (pair sign, mt, DZeta) are also pushed into the uproot cut of SR loads,
+# see SR_pushdown_requirements, so events failing them are never read into arrays.
+FF_region_bits = {
+  "SR"           : 1 << 0,
+  "AR"           : 1 << 1,
+  "DRsr"         : 1 << 2,
+  "DRar"         : 1 << 3,
+  "SR_aiso"      : 1 << 4,
+  "AR_aiso"      : 1 << 5,
+  "DRsr_aiso"    : 1 << 6,
+  "DRar_aiso"    : 1 << 7,
+  "AR_star"      : 1 << 8,
+  "DRar_star"    : 1 << 9,
+  "DRsr_WJ"      : 1 << 10,
+  "DRar_WJ"      : 1 << 11,
+  "DRsr_aiso_WJ" : 1 << 12,
+  "DRar_aiso_WJ" : 1 << 13,
+}
+
+FF_region_functions = {
+  "ditau"  : (ditau_region_predicates,  ditau_region_mask),
+  "mutau"  : (mutau_region_predicates,  mutau_region_mask),
+  "etau"   : (etau_region_predicates,   etau_region_mask),
+  "emu"    : (emu_region_predicates,    emu_region_mask),
+  "dimuon" : (dimuon_region_predicates, dimuon_region_mask),
+}
+
+
 def FF_control_flow(final_state_mode, semilep_mode, region, event_dictionary, DeepTau_version):
-  if (final_state_mode == "ditau"):
-    if (region == "SR"):        event_dictionary   = make_ditau_SR_cut(event_dictionary, DeepTau_version)
-    if (region == "AR"):        event_dictionary   = make_ditau_AR_cut(event_dictionary, DeepTau_version)
-    if (region == "DRsr"):      event_dictionary   = make_ditau_DRsr_cut(event_dictionary, DeepTau_version)
-    if (region == "DRar"):      event_dictionary   = make_ditau_DRar_cut(event_dictionary, DeepTau_version)
-    if (region == "SR_aiso"):   event_dictionary   = make_ditau_SR_aiso_cut(event_dictionary, DeepTau_version)
-    if (region == "AR_aiso"):   event_dictionary   = make_ditau_AR_aiso_cut(event_dictionary, DeepTau_version)
-    if (region == "DRsr_aiso"): event_dictionary   = make_ditau_DRsr_aiso_cut(event_dictionary, DeepTau_version)
-    if (region == "DRar_aiso"): event_dictionary   = make_ditau_DRar_aiso_cut(event_dictionary, DeepTau_version)
-    if (region == "AR_star"):   event_dictionary   = make_ditau_AR_star_cut(event_dictionary, DeepTau_version)
-    if (region == "DRar_star"): event_dictionary   = make_ditau_DRar_star_cut(event_dictionary, DeepTau_version)
-    if (region == "combined_OS") or (region == "combined_SS"):
-      if "OS" in region:   sign = -1
-      elif "SS" in region: sign = 1
-      else: print("you need to specify OS or SS (or extend this function)")
-      event_dictionary = make_ditau_combined_cut(event_dictionary, DeepTau_version, sign)
-
-  if (final_state_mode == "mutau"):
-    if (region == "SR"):      event_dictionary = make_mutau_SR_cut(event_dictionary, DeepTau_version)
-    if (region == "AR"):      event_dictionary = make_mutau_AR_cut(event_dictionary, DeepTau_version)
-    if (region == "SR_aiso"): event_dictionary = make_mutau_SR_aiso_cut(event_dictionary, DeepTau_version)
-    if (region == "AR_aiso"): event_dictionary = make_mutau_AR_aiso_cut(event_dictionary, DeepTau_version)
-
-    if (semilep_mode == "QCD"):
-      if (region == "DRsr"):      event_dictionary = make_mutau_DRsr_QCD_cut(event_dictionary, DeepTau_version)
-      if (region == "DRar"):      event_dictionary = make_mutau_DRar_QCD_cut(event_dictionary, DeepTau_version)
-      if (region == "DRsr_aiso"): event_dictionary = make_mutau_DRsr_aiso_QCD_cut(event_dictionary, DeepTau_version)
-      if (region == "DRar_aiso"): event_dictionary = make_mutau_DRar_aiso_QCD_cut(event_dictionary, DeepTau_version)
-
-    if (semilep_mode == "WJ"):
-      if (region == "DRsr"):      event_dictionary = make_mutau_DRsr_WJ_cut(event_dictionary, DeepTau_version)
-      if (region == "DRar"):      event_dictionary = make_mutau_DRar_WJ_cut(event_dictionary, DeepTau_version)
-      if (region == "DRsr_aiso"): event_dictionary = make_mutau_DRsr_aiso_WJ_cut(event_dictionary, DeepTau_version)
-      if (region == "DRar_aiso"): event_dictionary = make_mutau_DRar_aiso_WJ_cut(event_dictionary, DeepTau_version)
+  '''
+  Add the indices of events in 'region' to event_dictionary as "pass_<region>_cuts".
+  All regions of the final state are evaluated together the first time and kept in the region flags branch,
+  later calls on the same events (for any region) only do a bitwise AND.
+  The flags are cut along with the other branches by apply_cut, so they stay aligned with the events,
+  and their branch name holds the final state and DeepTau_version, so other settings make new flags.
+  '''
+  flag_name = FF_region_name(final_state_mode, semilep_mode, region)
+  if flag_name not in FF_region_parameters(final_state_mode, DeepTau_version):
+    print(f"missing region condition for {final_state_mode} {semilep_mode} {region}")
+    return event_dictionary
+  flags_branch = FF_region_flags_branch(final_state_mode, DeepTau_version)
+  if ((flags_branch not in event_dictionary) or
+      (len(event_dictionary[flags_branch]) != len(event_dictionary["Lepton_pt"]))):
+    event_dictionary = make_FF_region_flags(event_dictionary, final_state_mode, DeepTau_version)
+  event_dictionary = select_FF_region(event_dictionary, final_state_mode, flag_name, DeepTau_version)
+  return event_dictionary
 
-  if (final_state_mode == "etau"):
-    if (region == "SR"):      event_dictionary = make_etau_SR_cut(event_dictionary, DeepTau_version)
-    if (region == "AR"):      event_dictionary = make_etau_AR_cut(event_dictionary, DeepTau_version)
-    if (region == "SR_aiso"): event_dictionary = make_etau_SR_aiso_cut(event_dictionary, DeepTau_version)
-    if (region == "AR_aiso"): event_dictionary = make_etau_AR_aiso_cut(event_dictionary, DeepTau_version)
-
-    if (semilep_mode == "QCD"):
-      if (region == "DRsr"):      event_dictionary = make_etau_DRsr_QCD_cut(event_dictionary, DeepTau_version)
-      if (region == "DRar"):      event_dictionary = make_etau_DRar_QCD_cut(event_dictionary, DeepTau_version)
-      if (region == "DRsr_aiso"): event_dictionary = make_etau_DRsr_aiso_QCD_cut(event_dictionary, DeepTau_version)
-      if (region == "DRar_aiso"): event_dictionary = make_etau_DRar_aiso_QCD_cut(event_dictionary, DeepTau_version)
-
-    if (semilep_mode == "WJ"):
-      if (region == "DRsr"):      event_dictionary = make_etau_DRsr_WJ_cut(event_dictionary, DeepTau_version)
-      if (region == "DRar"):      event_dictionary = make_etau_DRar_WJ_cut(event_dictionary, DeepTau_version)
-      if (region == "DRsr_aiso"): event_dictionary = make_etau_DRsr_aiso_WJ_cut(event_dictionary, DeepTau_version)
-      if (region == "DRar_aiso"): event_dictionary = make_etau_DRar_aiso_WJ_cut(event_dictionary, DeepTau_version)
-
-  if (final_state_mode == "dimuon"):
-    if (region == "SR"):      event_dictionary = make_dimuon_SR_cut(event_dictionary)
-    else: print("missing region condition")
 
-  if (final_state_mode == "emu"):
-    if (region == "SR"):        event_dictionary   = make_emu_SR_cut(event_dictionary)
-    if (region == "AR"):        event_dictionary   = make_emu_AR_cut(event_dictionary)
-    if (region == "DRsr"):      event_dictionary   = make_emu_DRsr_cut(event_dictionary)
-    if (region == "DRar"):      event_dictionary   = make_emu_DRar_cut(event_dictionary)
-    if (region == "SR_aiso"):   event_dictionary   = make_emu_SR_aiso_cut(event_dictionary)
-    if (region == "AR_aiso"):   event_dictionary   = make_emu_AR_aiso_cut(event_dictionary)
-    if (region == "DRsr_aiso"): event_dictionary   = make_emu_DRsr_aiso_cut(event_dictionary)
-    if (region == "DRar_aiso"): event_dictionary   = make_emu_DRar_aiso_cut(event_dictionary)
+def FF_region_name(final_state_mode, semilep_mode, region):
+  ''' key of 'region' in FF_region_bits '''
+  combined_regions = {"combined_OS" : "AR_star", "combined_SS" : "DRar_star"}
+  region = combined_regions.get(region, region)
+  if (final_state_mode in ["mutau", "etau"]) and (semilep_mode == "WJ") and (region.startswith("DR")):
+    region = region + "_WJ"
+  return region
+
+
+def FF_region_branch(flag_name):
+  ''' QCD and WJ determination regions are stored in the same branch, e.g. "pass_DRsr_cuts" '''
+  return "pass_" + flag_name.replace("_WJ", "") + "_cuts"
+
+
+def FF_region_flags_branch(final_state_mode, DeepTau_version):
+  ''' region flags are only valid for the final state and DeepTau version they were made with '''
+  return f"region_flags_{final_state_mode}_{DeepTau_version}"
+
+
+def FF_region_parameters(final_state_mode, DeepTau_version):
+  ''' {region : make_<final state>_region arguments} for every region of the final state '''
+  if   (final_state_mode == "ditau"):  return ditau_region_parameters(DeepTau_version)
+  elif (final_state_mode == "mutau"):  return mutau_region_parameters(DeepTau_version)
+  elif (final_state_mode == "etau"):   return etau_region_parameters(DeepTau_version)
+  elif (final_state_mode == "emu"):    return emu_region_parameters()
+  elif (final_state_mode == "dimuon"): return {"SR" : {"FS_pair_sign" : -1}}
+  else: print(f"no regions defined for {final_state_mode}")
+  return {}
+
+
+def make_FF_region_flags(event_dictionary, final_state_mode, DeepTau_version):
+  '''
+  Evaluate every region of the final state and store them as bits of the uint16 branch
+  FF_region_flags_branch(final_state_mode, DeepTau_version), replacing flags made with other settings
+  '''
+  make_predicates, make_mask = FF_region_functions[final_state_mode]
+  region_predicates = {} # keyed by DeepTau version, some mutau regions always use 2p5
+  region_flags = np.zeros(len(event_dictionary["Lepton_pt"]), dtype=np.uint16)
+  for flag_name, parameters in FF_region_parameters(final_state_mode, DeepTau_version).items():
+    version = parameters.get("DeepTau_version")
+    if version not in region_predicates:
+      region_predicates[version] = make_predicates(event_dictionary, version)
+    region_flags[make_mask(region_predicates[version], **parameters)] |= FF_region_bits[flag_name]
+  for old_flags_branch in [branch for branch in event_dictionary if branch.startswith("region_flags_")]:
+    del event_dictionary[old_flags_branch]
+  event_dictionary[FF_region_flags_branch(final_state_mode, DeepTau_version)] = region_flags
+  return event_dictionary
+
+
+def select_FF_region(event_dictionary, final_state_mode, flag_name, DeepTau_version):
+  ''' "pass_<region>_cuts" from the region flags made by make_FF_region_flags '''
+  region_bit   = FF_region_bits[flag_name]
+  region_flags = event_dictionary[FF_region_flags_branch(final_state_mode, DeepTau_version)]
+  event_dictionary = store_selection(event_dictionary, FF_region_branch(flag_name),
+                                     np.flatnonzero(region_flags & region_bit))
+  return event_dictionary
 
+
+def make_FF_region(event_dictionary, final_state_mode, flag_name, DeepTau_version):
+  ''' evaluate a single region directly, without the region flags '''
+  make_predicates, make_mask = FF_region_functions[final_state_mode]
+  parameters = FF_region_parameters(final_state_mode, DeepTau_version)[flag_name]
+  region_predicates = make_predicates(event_dictionary, parameters.get("DeepTau_version"))
+  event_dictionary = store_selection(event_dictionary, FF_region_branch(flag_name),
+                                     np.flatnonzero(make_mask(region_predicates, **parameters)))
   return event_dictionary
 
+
+def SR_pushdown_requirements(final_state_mode):
+  '''
+  [(branch, comparison, value)] of the SR requirements on flat branches, taken from the SR parameters.
+  Requirements on jagged branches (lepton isolation, DeepTau, b-tag veto) need the l1/l2 indices
+  and stay in the region mask. Only the final states whose SR is cut by apply_final_state_cut are included.
+  '''
+  if final_state_mode not in ["ditau", "mutau", "etau", "emu"]: return []
+  SR = FF_region_parameters(final_state_mode, DeepTau_version=None)["SR"] # flat requirements don't use DeepTau
+  requirements = [("HTT_pdgId", "<" if SR["FS_pair_sign"] == -1 else ">", 0)]
+  if ("pass_mt_req" in SR):
+    requirements.append(("HTT_mT_lmet", "<" if SR["pass_mt_req"] else ">=", SR["mt_value"]))
+  if (final_state_mode == "emu"):
+    requirements.append(("HTT_DZeta", ">", emu_DZeta_value))
+  return requirements
+
+
+def SR_pushdown_cut(final_state_mode):
+  ''' the SR_pushdown_requirements as a string to add to good_events, e.g. " & (HTT_pdgId < 0)" '''
+  return "".join(f" & ({branch} {comparison} {value})"
+                 for branch, comparison, value in SR_pushdown_requirements(final_state_mode))
+
+
+def SR_pushdown_mask(event_dictionary, final_state_mode):
+  ''' boolean mask of events passing the SR_pushdown_requirements, for events that were loaded without them '''
+  comparisons = {"<" : operator.lt, ">" : operator.gt, ">=" : operator.ge}
+  mask = np.ones(len(event_dictionary["HTT_pdgId"]), dtype=bool)
+  for branch, comparison, value in SR_pushdown_requirements(final_state_mode):
+    mask &= comparisons[comparison](np.asarray(event_dictionary[branch]), value)
+  return mask
+
+
 ditau_DeepTauVsJet_WP = 5
+def ditau_region_parameters(DeepTau_version):
+  ''' ditau regions always use DeepTau 2p5 '''
+  def region(FS_pair_sign, pass_DeepTau_t1_req, pass_DeepTau_t2_req):
+    return {"FS_pair_sign" : FS_pair_sign,
+            "pass_DeepTau_t1_req" : pass_DeepTau_t1_req, "DeepTau_t1_value" : ditau_DeepTauVsJet_WP,
+            "pass_DeepTau_t2_req" : pass_DeepTau_t2_req, "DeepTau_t2_value" : ditau_DeepTauVsJet_WP,
+            "DeepTau_version" : "2p5"}
+  ditau_regions = {
+    "SR"        : region(-1, True,  True),
+    "AR"        : region(-1, False, True),
+    "DRsr"      : region( 1, True,  True),
+    "DRar"      : region( 1, False, True),
+    "SR_aiso"   : region(-1, True,  False),
+    "AR_aiso"   : region(-1, False, False),
+    "DRsr_aiso" : region( 1, True,  False),
+    "DRar_aiso" : region( 1, False, False),
+    # combine all regions for a given sign pair
+    "AR_star"   : region(-1, "None", "None"),
+    "DRar_star" : region( 1, "None", "None"),
+  }
+  return ditau_regions
+
 # ditau region cuts
 def make_ditau_SR_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_SR_cuts" if iso_region == True else "pass_SR_aiso_cuts"
-  event_dictionary = make_ditau_region(event_dictionary, name, FS_pair_sign=-1,
-                       pass_DeepTau_t1_req=True, DeepTau_t1_value=ditau_DeepTauVsJet_WP,
-                       pass_DeepTau_t2_req=iso_region, DeepTau_t2_value=ditau_DeepTauVsJet_WP, 
-                       DeepTau_version="2p5")
-  return event_dictionary
+  region = "SR" if iso_region == True else "SR_aiso"
+  return make_FF_region(event_dictionary, "ditau", region, DeepTau_version)
 
 def make_ditau_AR_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_AR_cuts" if iso_region == True else "pass_AR_aiso_cuts"
-  event_dictionary = make_ditau_region(event_dictionary, name, FS_pair_sign=-1,
-                       pass_DeepTau_t1_req=False, DeepTau_t1_value=ditau_DeepTauVsJet_WP,
-                       pass_DeepTau_t2_req=iso_region,  DeepTau_t2_value=ditau_DeepTauVsJet_WP, 
-                       DeepTau_version="2p5")
-  return event_dictionary
+  region = "AR" if iso_region == True else "AR_aiso"
+  return make_FF_region(event_dictionary, "ditau", region, DeepTau_version)
 
 def make_ditau_DRsr_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_DRsr_cuts" if iso_region == True else "pass_DRsr_aiso_cuts"
-  event_dictionary = make_ditau_region(event_dictionary, name, FS_pair_sign=1,
-                       pass_DeepTau_t1_req=True, DeepTau_t1_value=ditau_DeepTauVsJet_WP,
-                       pass_DeepTau_t2_req=iso_region, DeepTau_t2_value=ditau_DeepTauVsJet_WP, 
-                       DeepTau_version="2p5")
-  return event_dictionary
+  region = "DRsr" if iso_region == True else "DRsr_aiso"
+  return make_FF_region(event_dictionary, "ditau", region, DeepTau_version)
 
 def make_ditau_DRar_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_DRar_cuts" if iso_region == True else "pass_DRar_aiso_cuts"
-  event_dictionary = make_ditau_region(event_dictionary, name, FS_pair_sign=1,
-                       pass_DeepTau_t1_req=False, DeepTau_t1_value=ditau_DeepTauVsJet_WP,
-                       pass_DeepTau_t2_req=iso_region, DeepTau_t2_value=ditau_DeepTauVsJet_WP, 
-                       DeepTau_version="2p5")
-  return event_dictionary
+  region = "DRar" if iso_region == True else "DRar_aiso"
+  return make_FF_region(event_dictionary, "ditau", region, DeepTau_version)
 
 def make_ditau_SR_aiso_cut(event_dictionary, DeepTau_version):
   return make_ditau_SR_cut(event_dictionary, DeepTau_version, iso_region=False)
@@ -128,12 +226,8 @@ def make_ditau_DRar_aiso_cut(event_dictionary, DeepTau_version):
 
 def make_ditau_combined_cut(event_dictionary, DeepTau_version, sign):
   # use to combine all regions for a given sign pair
-  name = "pass_AR_star_cuts" if sign==-1 else "pass_DRar_star_cuts"
-  event_dictionary = make_ditau_region(event_dictionary, name, FS_pair_sign=sign,
-                       pass_DeepTau_t1_req="None", DeepTau_t1_value=ditau_DeepTauVsJet_WP,
-                       pass_DeepTau_t2_req="None", DeepTau_t2_value=ditau_DeepTauVsJet_WP,
-                       DeepTau_version="2p5")
-  return event_dictionary
+  region = "AR_star" if sign==-1 else "DRar_star"
+  return make_FF_region(event_dictionary, "ditau", region, DeepTau_version)
 
 def make_ditau_AR_star_cut(event_dictionary, DeepTau_version):
   return make_ditau_combined_cut(event_dictionary, DeepTau_version, -1)
@@ -145,22 +239,40 @@ def make_ditau_DRar_star_cut(event_dictionary, DeepTau_version):
 
 mutau_DeepTauVsJet_WP = 5
 mutau_mt_value = 65 # replace with 9999 to disable temporarily # reverted from 60 on May 21st...
+def mutau_region_parameters(DeepTau_version):
+  ''' SR and AR use the requested DeepTau version, the determination regions always use 2p5 '''
+  def region(FS_pair_sign, pass_mu_iso_req, mu_iso_value, pass_DeepTau_req, DeepTau_version,
+             pass_mt_req=True, pass_BTag_req=True):
+    return {"FS_pair_sign" : FS_pair_sign, "pass_mu_iso_req" : pass_mu_iso_req, "mu_iso_value" : mu_iso_value,
+            "pass_DeepTau_req" : pass_DeepTau_req, "DeepTau_value" : mutau_DeepTauVsJet_WP,
+            "DeepTau_version" : DeepTau_version,
+            "pass_mt_req" : pass_mt_req, "mt_value" : mutau_mt_value, "pass_BTag_req" : pass_BTag_req}
+  mutau_regions = {
+    "SR"           : region(-1, True,  [0.00, 0.15], True,  DeepTau_version),
+    "AR"           : region(-1, True,  [0.00, 0.15], False, DeepTau_version),
+    "SR_aiso"      : region(-1, False, [0.00, 0.15], True,  DeepTau_version),
+    "AR_aiso"      : region(-1, False, [0.00, 0.15], False, DeepTau_version),
+    # QCD, puts mu_iso between 0.05 and 0.15
+    "DRsr"         : region( 1, True,  [0.05, 0.15], True,  "2p5"),
+    "DRar"         : region( 1, True,  [0.05, 0.15], False, "2p5"),
+    "DRsr_aiso"    : region( 1, False, [0.05, 0.15], True,  "2p5"),
+    "DRar_aiso"    : region( 1, False, [0.05, 0.15], False, "2p5"),
+    # WJ, inverted mt requirement
+    "DRsr_WJ"      : region(-1, True,  [0.00, 0.15], True,  "2p5", pass_mt_req=False),
+    "DRar_WJ"      : region(-1, True,  [0.00, 0.15], False, "2p5", pass_mt_req=False),
+    "DRsr_aiso_WJ" : region(-1, False, [0.00, 0.15], True,  "2p5", pass_mt_req=False),
+    "DRar_aiso_WJ" : region(-1, False, [0.00, 0.15], False, "2p5", pass_mt_req=False),
+  }
+  return mutau_regions
+
 ### begin mutau region cuts
 def make_mutau_SR_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_SR_cuts" if iso_region == True else "pass_SR_aiso_cuts"
-  event_dictionary   = make_mutau_region(event_dictionary, name, 
-                         FS_pair_sign=-1, pass_mu_iso_req=iso_region, mu_iso_value=[0.00, 0.15],
-                         pass_DeepTau_req=True, DeepTau_value=mutau_DeepTauVsJet_WP, DeepTau_version=DeepTau_version,
-                         pass_mt_req=True, mt_value=mutau_mt_value, pass_BTag_req=True)
-  return event_dictionary
+  region = "SR" if iso_region == True else "SR_aiso"
+  return make_FF_region(event_dictionary, "mutau", region, DeepTau_version)
 
 def make_mutau_AR_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_AR_cuts" if iso_region == True else "pass_AR_aiso_cuts"
-  event_dictionary   = make_mutau_region(event_dictionary, name, 
-                         FS_pair_sign=-1, pass_mu_iso_req=iso_region, mu_iso_value=[0.00, 0.15],
-                         pass_DeepTau_req=False, DeepTau_value=mutau_DeepTauVsJet_WP, DeepTau_version=DeepTau_version,
-                         pass_mt_req=True, mt_value=mutau_mt_value, pass_BTag_req=True)
-  return event_dictionary
+  region = "AR" if iso_region == True else "AR_aiso"
+  return make_FF_region(event_dictionary, "mutau", region, DeepTau_version)
 
 def make_mutau_SR_aiso_cut(event_dictionary, DeepTau_version):
   return make_mutau_SR_cut(event_dictionary, DeepTau_version, iso_region=False)
@@ -170,20 +282,12 @@ def make_mutau_AR_aiso_cut(event_dictionary, DeepTau_version):
  
 ### QCD 
 def make_mutau_DRsr_QCD_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_DRsr_cuts" if iso_region == True else "pass_DRsr_aiso_cuts"
-  event_dictionary   = make_mutau_region(event_dictionary, name,
-                         FS_pair_sign=1, pass_mu_iso_req=iso_region, mu_iso_value=[0.05, 0.15],
-                         pass_DeepTau_req=True, DeepTau_value=mutau_DeepTauVsJet_WP, DeepTau_version="2p5",
-                         pass_mt_req=True, mt_value=mutau_mt_value, pass_BTag_req=True)
-  return event_dictionary
+  region = "DRsr" if iso_region == True else "DRsr_aiso"
+  return make_FF_region(event_dictionary, "mutau", region, DeepTau_version)
 
 def make_mutau_DRar_QCD_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_DRar_cuts" if iso_region == True else "pass_DRar_aiso_cuts"
-  event_dictionary   = make_mutau_region(event_dictionary, name,
-                         FS_pair_sign=1, pass_mu_iso_req=iso_region, mu_iso_value=[0.05, 0.15],
-                         pass_DeepTau_req=False, DeepTau_value=mutau_DeepTauVsJet_WP, DeepTau_version="2p5",
-                         pass_mt_req=True, mt_value=mutau_mt_value, pass_BTag_req=True)
-  return event_dictionary
+  region = "DRar" if iso_region == True else "DRar_aiso"
+  return make_FF_region(event_dictionary, "mutau", region, DeepTau_version)
 
 def make_mutau_DRsr_aiso_QCD_cut(event_dictionary, DeepTau_version):
   return make_mutau_DRsr_QCD_cut(event_dictionary, DeepTau_version, iso_region=False)
@@ -193,20 +297,12 @@ def make_mutau_DRar_aiso_QCD_cut(event_dictionary, DeepTau_version):
 
 ### WJ
 def make_mutau_DRsr_WJ_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_DRsr_cuts" if iso_region == True else "pass_DRsr_aiso_cuts"
-  event_dictionary   = make_mutau_region(event_dictionary, name,
-                         FS_pair_sign=-1, pass_mu_iso_req=iso_region, mu_iso_value=[0.0, 0.15],
-                         pass_DeepTau_req=True, DeepTau_value=mutau_DeepTauVsJet_WP, DeepTau_version="2p5",
-                         pass_mt_req=False, mt_value=mutau_mt_value, pass_BTag_req=True)
-  return event_dictionary
+  region = "DRsr_WJ" if iso_region == True else "DRsr_aiso_WJ"
+  return make_FF_region(event_dictionary, "mutau", region, DeepTau_version)
 
 def make_mutau_DRar_WJ_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_DRar_cuts" if iso_region == True else "pass_DRar_aiso_cuts"
-  event_dictionary   = make_mutau_region(event_dictionary, name,
-                         FS_pair_sign=-1, pass_mu_iso_req=iso_region, mu_iso_value=[0.0, 0.15],
-                         pass_DeepTau_req=False, DeepTau_value=mutau_DeepTauVsJet_WP, DeepTau_version="2p5",
-                         pass_mt_req=False, mt_value=mutau_mt_value, pass_BTag_req=True)
-  return event_dictionary
+  region = "DRar_WJ" if iso_region == True else "DRar_aiso_WJ"
+  return make_FF_region(event_dictionary, "mutau", region, DeepTau_version)
 
 def make_mutau_DRsr_aiso_WJ_cut(event_dictionary, DeepTau_version):
   return make_mutau_DRsr_WJ_cut(event_dictionary, DeepTau_version, iso_region=False)
@@ -241,21 +337,33 @@ def make_mutau_DRar_aiso_TT_cut(event_dictionary, DeepTau_version):
 # etau
 etau_DeepTauVsJet_WP = 5
 etau_mt_value = 60
+def etau_region_parameters(DeepTau_version):
+  ''' etau has no WJ determination regions yet '''
+  def region(FS_pair_sign, pass_el_iso_req, el_iso_value, pass_DeepTau_req):
+    return {"FS_pair_sign" : FS_pair_sign, "pass_el_iso_req" : pass_el_iso_req, "el_iso_value" : el_iso_value,
+            "pass_DeepTau_req" : pass_DeepTau_req, "DeepTau_value" : etau_DeepTauVsJet_WP,
+            "DeepTau_version" : DeepTau_version,
+            "pass_mt_req" : True, "mt_value" : etau_mt_value, "pass_BTag_req" : True}
+  etau_regions = {
+    "SR"        : region(-1, True,  [0.00, 0.15], True),
+    "AR"        : region(-1, True,  [0.00, 0.15], False),
+    "SR_aiso"   : region(-1, False, [0.00, 0.15], True),
+    "AR_aiso"   : region(-1, False, [0.00, 0.15], False),
+    # QCD, puts el_iso between 0.05 and 0.15
+    "DRsr"      : region( 1, True,  [0.05, 0.15], True),
+    "DRar"      : region( 1, True,  [0.05, 0.15], False),
+    "DRsr_aiso" : region( 1, False, [0.05, 0.15], True),
+    "DRar_aiso" : region( 1, False, [0.05, 0.15], False),
+  }
+  return etau_regions
+
 def make_etau_SR_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_SR_cuts" if iso_region == True else "pass_SR_aiso_cuts"
-  event_dictionary   = make_etau_region(event_dictionary, name, 
-                         FS_pair_sign=-1, pass_el_iso_req=iso_region, el_iso_value=[0.00, 0.15],
-                         pass_DeepTau_req=True, DeepTau_value=etau_DeepTauVsJet_WP, DeepTau_version=DeepTau_version,
-                         pass_mt_req=True, mt_value=etau_mt_value, pass_BTag_req=True)
-  return event_dictionary
+  region = "SR" if iso_region == True else "SR_aiso"
+  return make_FF_region(event_dictionary, "etau", region, DeepTau_version)
 
 def make_etau_AR_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_AR_cuts" if iso_region == True else "pass_AR_aiso_cuts"
-  event_dictionary   = make_etau_region(event_dictionary, name, 
-                         FS_pair_sign=-1, pass_el_iso_req=iso_region, el_iso_value=[0.00, 0.15],
-                         pass_DeepTau_req=False, DeepTau_value=etau_DeepTauVsJet_WP, DeepTau_version=DeepTau_version,
-                         pass_mt_req=True, mt_value=etau_mt_value, pass_BTag_req=True)
-  return event_dictionary
+  region = "AR" if iso_region == True else "AR_aiso"
+  return make_FF_region(event_dictionary, "etau", region, DeepTau_version)
 
 def make_etau_SR_aiso_cut(event_dictionary, DeepTau_version):
   return make_etau_SR_cut(event_dictionary, DeepTau_version, iso_region=False)
@@ -265,26 +373,18 @@ def make_etau_AR_aiso_cut(event_dictionary, DeepTau_version):
 
 # QCD
 def make_etau_DRsr_QCD_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_DRsr_cuts" if iso_region == True else "pass_DRsr_aiso_cuts"
-  event_dictionary   = make_etau_region(event_dictionary, name, 
-                         FS_pair_sign=1, pass_el_iso_req=iso_region, el_iso_value=[0.05, 0.15],
-                         pass_DeepTau_req=True, DeepTau_value=etau_DeepTauVsJet_WP, DeepTau_version=DeepTau_version,
-                         pass_mt_req=True, mt_value=etau_mt_cut, pass_BTag_req=True)
-  return event_dictionary
+  region = "DRsr" if iso_region == True else "DRsr_aiso"
+  return make_FF_region(event_dictionary, "etau", region, DeepTau_version)
 
 def make_etau_DRar_QCD_cut(event_dictionary, DeepTau_version, iso_region=True):
-  name = "pass_DRar_cuts" if iso_region == True else "pass_DRar_aiso_cuts"
-  event_dictionary   = make_etau_region(event_dictionary, name, 
-                         FS_pair_sign=1, pass_el_iso_req=iso_region, el_iso_value=[0.05, 0.15],
-                         pass_DeepTau_req=False, DeepTau_value=etau_DeepTauVsJet_WP, DeepTau_version=DeepTau_version,
-                         pass_mt_req=True, mt_value=etau_mt_value, pass_BTag_req=True)
-  return event_dictionary
+  region = "DRar" if iso_region == True else "DRar_aiso"
+  return make_FF_region(event_dictionary, "etau", region, DeepTau_version)
 
 def make_etau_DRsr_aiso_QCD_cut(event_dictionary, DeepTau_version):
-  return make_etau_DRsr_cut(event_dictionary, DeepTau_version, iso_region=False)
+  return make_etau_DRsr_QCD_cut(event_dictionary, DeepTau_version, iso_region=False)
 
 def make_etau_DRar_aiso_QCD_cut(event_dictionary, DeepTau_version):
-  return make_etau_DRar_cut(event_dictionary, DeepTau_version, iso_region=False)
+  return make_etau_DRar_QCD_cut(event_dictionary, DeepTau_version, iso_region=False)
 
 
 # dimuon
@@ -294,36 +394,45 @@ def make_dimuon_SR_cut(event_dictionary, iso_region=True):
   return event_dictionary
 
 #emu region cuts
+def emu_region(FS_pair_sign, pass_el_iso_req, pass_mu_iso_req):
+  ''' make_emu_region arguments for the given sign and lepton isolation requirements '''
+  return {"FS_pair_sign" : FS_pair_sign,
+          "pass_el_iso_req" : pass_el_iso_req, "el_iso_value" : [0.00,0.15],
+          "pass_mu_iso_req" : pass_mu_iso_req, "mu_iso_value" : [0.00,0.15],
+          "pass_BTag_req" : True}
+
+def emu_region_parameters():
+  ''' the muon is anti-isolated in the determination regions, the electron in the aiso regions '''
+  emu_regions = {
+    "SR"        : emu_region(-1, True,  True),
+    "AR"        : emu_region( 1, True,  True),
+    "DRsr"      : emu_region(-1, True,  False),
+    "DRar"      : emu_region( 1, True,  False),
+    "SR_aiso"   : emu_region(-1, False, True),
+    "AR_aiso"   : emu_region( 1, False, True),
+    "DRsr_aiso" : emu_region(-1, False, False),
+    "DRar_aiso" : emu_region( 1, False, False),
+  }
+  return emu_regions
+
 def make_emu_SR_cut(event_dictionary, iso_region_el=True, iso_region_mu=True):
   name = "pass_SR_cuts" if ((iso_region_el == True) and (iso_region_mu ==True)) else "pass_SR_aiso_cuts"
-  event_dictionary   = make_emu_region(event_dictionary, name, 
-                         FS_pair_sign=-1, pass_el_iso_req=iso_region_el, el_iso_value=[0.00,0.15],
-                         pass_mu_iso_req=iso_region_mu, mu_iso_value=[0.00,0.15],
-                         pass_BTag_req=True)
+  event_dictionary = make_emu_region(event_dictionary, name, **emu_region(-1, iso_region_el, iso_region_mu))
   return event_dictionary
 
 def make_emu_AR_cut(event_dictionary, iso_region_el=True, iso_region_mu=True):
   name = "pass_AR_cuts" if ((iso_region_el == True) and (iso_region_mu ==True)) else "pass_AR_aiso_cuts"
-  event_dictionary = make_emu_region(event_dictionary, name, 
-                         FS_pair_sign=1, pass_el_iso_req=iso_region_el, el_iso_value=[0.00,0.15],
-                         pass_mu_iso_req=iso_region_mu, mu_iso_value=[0.00,0.15],
-                         pass_BTag_req=True)
+  event_dictionary = make_emu_region(event_dictionary, name, **emu_region(1, iso_region_el, iso_region_mu))
   return event_dictionary
 
 def make_emu_DRsr_cut(event_dictionary, iso_region_el=True, iso_region_mu=False):
   name = "pass_DRsr_cuts" if ((iso_region_el == True) and (iso_region_mu == False)) else "pass_DRsr_aiso_cuts"
-  event_dictionary = make_emu_region(event_dictionary, name, 
-                         FS_pair_sign=-1, pass_el_iso_req=iso_region_el, el_iso_value=[0.00,0.15],
-                         pass_mu_iso_req=iso_region_mu, mu_iso_value=[0.00,0.15],
-                         pass_BTag_req=True)
+  event_dictionary = make_emu_region(event_dictionary, name, **emu_region(-1, iso_region_el, iso_region_mu))
   return event_dictionary
 
 def make_emu_DRar_cut(event_dictionary, iso_region_el=True, iso_region_mu=False):
   name = "pass_DRar_cuts" if ((iso_region_el == True) and (iso_region_mu == False)) else "pass_DRar_aiso_cuts"
-  event_dictionary = make_emu_region(event_dictionary, name, 
-                         FS_pair_sign=1, pass_el_iso_req=iso_region_el, el_iso_value=[0.00,0.15],
-                         pass_mu_iso_req=iso_region_mu, mu_iso_value=[0.00,0.15],
-                         pass_BTag_req=True)
+  event_dictionary = make_emu_region(event_dictionary, name, **emu_region(1, iso_region_el, iso_region_mu))
   return event_dictionary
 
 def make_emu_SR_aiso_cut(event_dictionary,):
@@ -342,7 +451,83 @@ def make_emu_DRar_aiso_cut(event_dictionary):
 # Calculation Functions
 #########################################################################################
 
+# FF_mvis_weights as arrays, converted once so that the fractions can be looked up for all events at once
+FF_mvis_weight_tables = {final_state : {jet_mode : {process : np.array(fractions, dtype=np.float64)
+                                                    for process, fractions in processes.items()}
+                                        for jet_mode, processes in jet_modes.items()}
+                         for final_state, jet_modes in FF_mvis_weights.items()}
+
 def add_FF_weights(event_dictionary, final_state_mode, jet_mode, semilep_mode, closure=False, bypass=[]):
+  '''
+  interface to read FF_dictionary, evaluated for all events at once.
+  The weights keep the precision of Lepton_pt/HTT_m_vis (float32 from the ntuples), as the old per-event loop did
+  '''
+  if (jet_mode == "2j") or (jet_mode == "3j") or (jet_mode == "4j"): jet_mode = "GTE2j"
+  QCD_fitvals   = FF_fit_values[final_state_mode][jet_mode]["QCD"]
+  if (final_state_mode != "ditau"):
+    WJ_fitvals   = FF_fit_values[final_state_mode][jet_mode]["WJ"]
+  if bypass != []:  QCD_fitvals, WJ_fitvals = bypass, bypass
+
+  fakeleg_indices = "l1_indices" if final_state_mode == "ditau" else "l2_indices" # mutau/etau is always l2, ditau is always l1
+  tau_pt = gather(event_dictionary["Lepton_pt"], event_dictionary[fakeleg_indices])
+  m_vis  = np.asarray(event_dictionary["HTT_m_vis"])
+  m_vis_max = 180.0 if final_state_mode == "etau" else 300.0 # exactly 300 breaks index hack below
+  clamped = ~(m_vis < m_vis_max)
+  m_vis = np.where(clamped, m_vis.dtype.type(m_vis_max - 1), m_vis)
+  # temporarily disabled for piecewise
+  #low_val = 20.0 if final_state_mode == "ditau" else 30.0
+  ##low_val = 40.0 if final_state_mode == "ditau" else 30.0
+  #hi_val  = 140.0 if final_state_mode == "ditau" else 200
+  #tau_pt = np.clip(tau_pt, low_val, hi_val)
+  if (final_state_mode == "etau"):
+    m_vis_idx = np.where(m_vis <= 40, 1, m_vis // 20).astype(np.int64)
+  else:
+    m_vis_idx = (m_vis // 10).astype(np.int64) # hard-coding mvis bins of 10 GeV, starting at 0 and ending at 300
+
+  #user_func_QCD = user_line_p_const if final_state_mode=="mutau" else user_line
+  user_func_QCD = user_line_p_const
+  #user_func_QCD = user_exp if final_state_mode=="mutau" else user_line
+  user_func_WJ = user_line_p_const #user_exp
+  #FF_QCD    = user_func_QCD(tau_pt, *QCD_fitvals) # use this for closure plots..
+  #FF_QCD    = user_func_QCD(tau_pt, *QCD_fitvals) * 1.1 # SS --> OS bias
+  #FF_QCD    = user_func_QCD(tau_pt, *QCD_fitvals) * (-0.0014*m_vis + 1.5841) # SS --> OS bias # old method
+  # SS --> OS bias # new method. clamped m_vis was a python float in the per-event loop, so its bias is computed in double
+  SS_to_OS_bias = np.where(clamped, m_vis.dtype.type(-0.0016*(m_vis_max - 1) + 1.5008), -0.0016*m_vis + 1.5008)
+  FF_QCD = user_func_QCD(tau_pt, *QCD_fitvals) * SS_to_OS_bias
+  # TODO: below is a hack that sets fraction to 1 for a closure test
+  #       for mutau, this is not correct. You need the fraction of events as a function of mvis in DRar, not 1
+  FF_fractions = FF_mvis_weight_tables[final_state_mode][jet_mode]
+  f_QCD = FF_fractions["QCD"][m_vis_idx].astype(FF_QCD.dtype) if not closure else 1
+  if (final_state_mode != "ditau"):
+    FF_WJ = user_func_WJ(tau_pt, *WJ_fitvals)
+    f_WJ  = FF_fractions["WJ"][m_vis_idx].astype(FF_WJ.dtype) if not closure else 1
+
+  if (semilep_mode == "Full"):
+    FF_weight = f_QCD * FF_QCD
+    if (final_state_mode != "ditau"):
+      FF_weight += f_WJ * FF_WJ
+  elif (semilep_mode == "QCD"):  FF_weight = f_QCD * FF_QCD
+  elif (semilep_mode == "WJ"):   FF_weight = f_WJ  * FF_WJ
+  else:
+    print("add_FF_weights function error")
+    return event_dictionary
+
+  non_positive = np.flatnonzero(FF_weight <= 0)
+  if len(non_positive) > 0:
+    print(f"{len(non_positive)} non-positive FF weights out of {len(FF_weight)}! First few:")
+    shown = non_positive[:5]
+    l1_pt = gather(event_dictionary["Lepton_pt"][shown], np.asarray(event_dictionary["l1_indices"])[shown])
+    for i, fit_value in zip(shown, user_func_QCD(l1_pt, *QCD_fitvals)):
+      print(f"FF_weight: {FF_weight[i]}, tau_pt: {tau_pt[i]}, value from fit: {fit_value}, " + \
+            f"m_vis, m_vis_idx: {m_vis[i]}, {m_vis_idx[i]}")
+  event_dictionary["FF_weight"] = FF_weight
+  return event_dictionary
+
+
+def add_FF_weights_rowscan(event_dictionary, final_state_mode, jet_mode, semilep_mode, closure=False, bypass=[]):
+  '''
+  Original event-by-event version of add_FF_weights, kept to validate the vectorized version.
+  '''
   # interface to read FF_dictionary
   unpack_FF_vars = ["Lepton_pt", "HTT_m_vis", "l1_indices", "l2_indices", "Lepton_iso"]
   unpack_FF_vars = (event_dictionary.get(key) for key in unpack_FF_vars)
@@ -172,7 +172,7 @@ if __name__ == "__main__":
       branches     = set_branches(final_state_mode, era, DeepTau_version, process)
       new_process_dictionary = load_process_from_file(process, using_directory, file_map, log_file,
                                               branches, good_events, final_state_mode,
-                                              data=("Data" in process), testing=testing)
+                                              testing=testing)
       event_dictionary = new_process_dictionary[process]["info"]
       if (event_dictionary == None): continue
 
@@ -1,4 +1,10 @@
-def set_branches(final_state_mode, era, DeepTau_version, process="None", temp_version="None"):
+def set_branches(final_state_mode, era, DeepTau_version, process="None", temp_version="None", vars_to_plot=None):
+  '''
+  Return the branches to load. Without 'vars_to_plot' this is a fixed superset for the final state,
+  with it only the branches the cut flow and those variables need (see plan_branches).
+  '''
+  if vars_to_plot is not None:
+    return plan_branches(final_state_mode, era, DeepTau_version, vars_to_plot, process)
   common_branches = [
     "run", "luminosityBlock", "event", "Generator_weight", "NWEvents", "XSecMCweight",
     "TauSFweight", "MuSFweight", "ElSFweight", "BTagSFfull", 
@@ -28,6 +34,85 @@ def set_branches(final_state_mode, era, DeepTau_version, process="None", temp_ve
   return branches
 
 
+# Branches read by each step of the cut flow and by the combined process dictionaries,
+# used by plan_branches to load only what a given final state and set of plotted variables needs.
+# DeepTau and trigger branches depend on the DeepTau version and era, they are added by the helpers below.
+# Keep these up to date when a function starts reading a new branch.
+cut_function_branches = {
+  "append_lepton_indices" : ["FSLeptons"],
+  "append_flavor_indices" : ["Lepton_pt", "Lepton_tauIdx", "Tau_genPartFlav"],
+  "load_and_store_NWEvents" : ["XSecMCweight"],
+  "make_jet_cut" : ["nCleanJet", "CleanJet_pt", "CleanJet_eta", "CleanJet_phi", "CleanJet_mass"],
+  "add_FF_weights" : ["Lepton_pt", "HTT_m_vis"],
+  "add_FF_weight_from_branch" : ["Lepton_pt", "HTT_m_vis", "FFweight"],
+  "add_HpT_correction" : ["HTT_H_pt", "nCleanJet"],
+  "append_to_combined_processes" : ["Generator_weight", "Weight_TTbar_NNLO", "Weight_DY_Zpt", "TauSFweight",
+                                    "MuSFweight", "ElSFweight", "BTagSFfull", "PUweight", "XSecMCweight",
+                                    "FFweight", "FFweight_QCD", "FFweight_WJ", "FFweight_FractionQCD"],
+  "make_ditau_cut" : ["Lepton_pt", "Lepton_eta", "Lepton_phi", "Lepton_mass", "Lepton_tauIdx",
+                      "Tau_dxy", "Tau_dz", "Tau_decayMode", "Tau_charge",
+                      "Tau_rawPNetVSjet", "Tau_rawPNetVSmu", "Tau_rawPNetVSe", "PuppiMET_pt", "PuppiMET_phi",
+                      "nCleanJet", "CleanJet_pt", "CleanJet_eta", "CleanJet_phi", "CleanJet_mass"],
+  "ditau_region_predicates" : ["HTT_pdgId", "Lepton_tauIdx"],
+  "make_mutau_cut" : ["Lepton_pt", "Lepton_eta", "Lepton_phi", "Lepton_iso", "Lepton_mass",
+                      "Lepton_muIdx", "Lepton_tauIdx", "Muon_dxy", "Muon_dz", "Muon_charge", "Muon_mass",
+                      "Tau_dxy", "Tau_dz", "Tau_charge", "Tau_decayMode", "Tau_leadTkPtOverTauPt",
+                      "Tau_rawPNetVSjet", "Tau_rawPNetVSmu", "Tau_rawPNetVSe", "PuppiMET_pt", "PuppiMET_phi",
+                      "HTT_mT_lmet", "CleanJet_btagWP",
+                      "nCleanJet", "CleanJet_pt", "CleanJet_eta", "CleanJet_phi", "CleanJet_mass"],
+  "mutau_region_predicates" : ["HTT_pdgId", "HTT_mT_lmet", "Lepton_iso", "Lepton_tauIdx", "CleanJet_btagWP", "nCleanJet"],
+  "make_etau_cut" : ["Lepton_pt", "Lepton_eta", "Lepton_phi", "Lepton_iso", "Lepton_mass",
+                     "Lepton_elIdx", "Lepton_tauIdx", "Electron_dxy", "Electron_dz", "Electron_charge", "Electron_mass",
+                     "Tau_dxy", "Tau_dz", "Tau_charge", "Tau_decayMode",
+                     "Tau_rawPNetVSjet", "Tau_rawPNetVSmu", "Tau_rawPNetVSe", "PuppiMET_pt", "PuppiMET_phi",
+                     "CleanJet_btagWP", "nCleanJet", "CleanJet_pt", "CleanJet_eta", "CleanJet_phi", "CleanJet_mass"],
+  "etau_region_predicates" : ["HTT_pdgId", "HTT_mT_lmet", "Lepton_iso", "Lepton_tauIdx", "CleanJet_btagWP"],
+  "make_emu_cut" : ["Lepton_pt", "Lepton_eta", "Lepton_phi", "Lepton_iso", "Lepton_elIdx", "Lepton_muIdx",
+                    "Electron_dxy", "Electron_dz", "Electron_charge", "Muon_dxy", "Muon_dz", "Muon_charge",
+                    "HTT_DZeta", "CleanJet_btagWP"],
+  "emu_region_predicates" : ["HTT_pdgId", "HTT_DZeta", "Lepton_iso", "Lepton_elIdx", "Lepton_muIdx", "CleanJet_btagWP"],
+  "make_dimuon_cut" : ["Lepton_pt", "Lepton_eta", "Lepton_phi", "Lepton_iso", "Lepton_muIdx",
+                       "Muon_dxy", "Muon_dz", "HTT_m_vis"],
+  "dimuon_region_predicates" : ["HTT_pdgId"],
+  "manual_dimuon_lepton_veto" : ["Lepton_pt", "Lepton_pdgId", "Lepton_iso"],
+}
+
+common_cut_functions = ["append_lepton_indices", "append_flavor_indices", "load_and_store_NWEvents", "make_jet_cut",
+                        "add_FF_weights", "add_FF_weight_from_branch", "add_HpT_correction", "append_to_combined_processes"]
+final_state_cut_functions = {
+  "ditau"  : ["make_ditau_cut",  "ditau_region_predicates"],
+  "mutau"  : ["make_mutau_cut",  "mutau_region_predicates"],
+  "etau"   : ["make_etau_cut",   "etau_region_predicates"],
+  "emu"    : ["make_emu_cut",    "emu_region_predicates"],
+  "dimuon" : ["make_dimuon_cut", "dimuon_region_predicates", "manual_dimuon_lepton_veto"],
+}
+
+# plotted variables that are computed from other branches instead of being read
+derived_variable_branches = {
+  "HTT_H_pt_corr" : ["HTT_H_pt", "nCleanJet"],
+}
+
+
+def plan_branches(final_state_mode, era, DeepTau_version, vars_to_plot, process="None"):
+  '''
+  Return the branches needed to cut 'final_state_mode' events and plot 'vars_to_plot':
+  the branches declared by each cut function (cut_function_branches), the DeepTau and trigger branches,
+  and the plotted variables that are ntuple branches. Plotted variables made by the cut functions
+  ("FS_" and jet variables) are not in the set_branches superset and are skipped.
+  '''
+  branches = ["run"] # the cut flow checks len(event_dictionary["run"])
+  for function in common_cut_functions + final_state_cut_functions[final_state_mode]:
+    branches += cut_function_branches[function]
+  if final_state_mode in ["ditau", "mutau", "etau"]: branches = add_DeepTau_branches(branches, DeepTau_version)
+  branches = add_trigger_branches(branches, era, final_state_mode)
+  available_branches = set_branches(final_state_mode, era, DeepTau_version, process)
+  for var in vars_to_plot:
+    if var in derived_variable_branches: branches += derived_variable_branches[var]
+    elif var in available_branches: branches.append(var)
+  if ("_TauTau" in process): branches = add_signal_branches(branches)
+  return list(dict.fromkeys(branches)) # remove duplicates, keeping the order
+
+
 def add_final_state_branches(branches_, final_state_mode):
   """ Helper function to add only relevant branches to loaded branches based on final state """
   final_state_branches = {
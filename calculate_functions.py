@@ -3,6 +3,7 @@ import numpy as np
 
 ### README
 # this file contains functions to perform simple calculations and return or print the result
+# calculate_binned_values is the histogram (with under/overflow) used for every plotted process
 
 
 
@@ -23,6 +24,62 @@ def calculate_underoverflow(events, xbins, weights, variable=""):
   return underflow_value, overflow_value, underflow_error, overflow_error
 
 
+# edges of the under/overflow counting in calculate_underoverflow, values outside them are not counted at all
+underoverflow_limits = (-999999., 999999.)
+
+def bin_indices(events, xbins):
+  '''
+  Bin of each event in 'xbins', the same bins as np.histogram (each bin includes its lower edge, the last bin
+  also its upper edge), for events between the first and last edge.
+  Linear binnings are computed directly from the bin width, others with a binary search.
+  '''
+  nBins = len(xbins) - 1
+  widths = np.diff(xbins)
+  if np.allclose(widths, widths[0]):
+    indices = np.clip(((events - xbins[0]) / widths[0]).astype(np.intp), 0, nBins - 1)
+    # the division can be off by one next to an edge, fix against the edges themselves like np.histogram
+    indices -= (events < xbins[indices])
+    indices += (events >= xbins[indices + 1]) & (indices < nBins - 1)
+  else:
+    indices = np.minimum(np.searchsorted(xbins, events, side="right") - 1, nBins - 1)
+  return indices
+
+
+def calculate_binned_values(events, xbins, weights, variable=""):
+  '''
+  Histogram of 'events' in 'xbins' with the under/overflow added to the first and last bins,
+  and the same for the squared weights. Same result as calculate_underoverflow plus np.histogram
+  of the weights and squared weights, but every event gets a bin index once,
+  and each sum is a single np.bincount over those (bin 0 is the underflow, bin nBins+1 the overflow).
+  The quirks of calculate_underoverflow are kept: events equal to the last edge also count as overflow,
+  and the overflow of the squared weights is the overflow of the weights.
+  '''
+  events, weights = np.asarray(events), np.asarray(weights)
+  xbins = np.asarray(xbins, dtype=np.float64)
+  nBins = len(xbins) - 1
+  counted  = (events >= underoverflow_limits[0]) & (events <= underoverflow_limits[1]) # NaN is not counted
+  in_range = (events >= xbins[0]) & (events <= xbins[-1])
+  flow_bin = np.where(events < xbins[0], 0, nBins + 1)
+  flow_bin[in_range] = 1 + bin_indices(events[in_range], xbins)
+  flow_bin, counted_weights = flow_bin[counted], weights[counted]
+
+  sum_weights   = np.bincount(flow_bin, weights=counted_weights, minlength=nBins + 2)
+  sum_weights_2 = np.bincount(flow_bin, weights=counted_weights*counted_weights, minlength=nBins + 2)
+  underflow_value = sum_weights[0]
+  overflow_value  = sum_weights[-1] + counted_weights[events[counted] == xbins[-1]].sum()
+  if (underflow_value > 1000) or (overflow_value > 100000):
+    print(f"large under/over flow values for variable '{variable}': {underflow_value}, {overflow_value}")
+
+  dtype = weights.dtype if weights.dtype.kind == "f" else np.float64
+  binned_values   = sum_weights[1:-1].astype(dtype)
+  binned_weight_2 = sum_weights_2[1:-1].astype(dtype)
+  binned_values[0]    += underflow_value
+  binned_values[-1]   += overflow_value
+  binned_weight_2[0]  += sum_weights_2[0]
+  binned_weight_2[-1] += overflow_value
+  return binned_values, binned_weight_2
+
+
 def check_nEvents(combined_process_dict):
   # for checking nEvents in samples and entering SR
   for key in combined_process_dict.keys():
@@ -0,0 +1,433 @@
+import math
+import numpy as np
+from collections.abc import MutableMapping
+
+### README
+# this file contains array-level helpers used by the cut functions
+# jagged branches (one small array per event) are flattened to a single "content" array plus
+# per-event "counts", so that object lookups and four-vector math run over whole samples at once
+# instead of event-by-event in python.
+# The four-vector functions follow the arithmetic of ROOT's TLorentzVector (SetPtEtaPhiM, M, Pt, Eta)
+# in double precision, so results match the previous per-event ROOT calculation.
+# numpy's sinh and log can differ from the C math library in the last bit, so those two go through
+# python's math module (the same libm ROOT uses) to keep the outputs identical.
+# EventTable tracks which branches have one entry per event, so apply_cut cuts the right branches,
+# and defers the np.take of apply_cut until a branch is read, see its docstring. Cut functions add the
+# indices of the events passing a cut, and the branches made for those events, with store_selection.
+# Jagged branches can also be awkward arrays (loaded with library="ak"), the helpers then read their
+# content and offsets buffers instead of concatenating one small numpy array per event.
+
+
+def is_awkward(values):
+  ''' True for awkward arrays, the jagged branches loaded with library="ak" '''
+  return type(values).__module__.startswith("awkward")
+
+
+def jagged_content(jagged):
+  '''
+  Return the flattened content and per-event counts of a jagged branch.
+  Accepts the numpy object arrays produced by uproot with library="np",
+  and awkward arrays (library="ak"), whose content and counts are read from their buffers directly.
+  '''
+  if is_awkward(jagged):
+    import awkward as ak
+    return ak.to_numpy(ak.flatten(jagged, axis=1)), ak.to_numpy(ak.num(jagged, axis=1)).astype(np.int64)
+  counts = np.fromiter(map(len, jagged), dtype=np.int64, count=len(jagged))
+  if (len(jagged) == 0) or (counts.sum() == 0):
+    dtype = jagged[0].dtype if len(jagged) > 0 else np.float64
+    return np.zeros(0, dtype=dtype), counts
+  content = np.concatenate(jagged)
+  return content, counts
+
+
+def to_object_array(jagged):
+  ''' numpy object array of per-event arrays (the library="np" layout) for a jagged branch '''
+  content, counts = jagged_content(jagged)
+  object_array = np.empty(len(counts), dtype=object)
+  for i, event in enumerate(np.split(content, np.cumsum(counts)[:-1]) if len(counts) > 0 else []):
+    object_array[i] = event
+  return object_array
+
+
+def take_rows(values, indices):
+  ''' np.take of the rows in 'indices', also for awkward arrays '''
+  if is_awkward(values): return values[np.asarray(indices)]
+  return np.take(values, indices)
+
+
+def jagged_offsets(counts):
+  ''' starting position of each event in the flattened content '''
+  offsets = np.zeros(len(counts), dtype=np.int64)
+  np.cumsum(counts[:-1], out=offsets[1:])
+  return offsets
+
+
+def content_indices(indices, counts, offsets):
+  '''
+  Positions in the flattened content of the per-event 'indices'.
+  Negative indices count from the end of each event, indices outside an event raise an IndexError
+  instead of silently reading the neighbouring event.
+  '''
+  indices = np.asarray(indices, dtype=np.int64)
+  indices = np.where(indices < 0, indices + counts, indices)
+  if np.any((indices < 0) | (indices >= counts)):
+    bad_event = np.flatnonzero((indices < 0) | (indices >= counts))[0]
+    raise IndexError(f"index out of range in event {bad_event} which has {counts[bad_event]} entries")
+  return offsets + indices
+
+
+def gather(jagged, indices):
+  '''
+  Vectorized equivalent of [event[idx] for event, idx in zip(jagged, indices)].
+  Negative indices count from the end of each event, like normal python indexing.
+  '''
+  content, counts = jagged_content(jagged)
+  return content[content_indices(indices, counts, jagged_offsets(counts))]
+
+
+def gather_pair(jagged, l1_indices, l2_indices):
+  ''' gather for both legs of a pair, flattening the branch only once '''
+  content, counts = jagged_content(jagged)
+  offsets = jagged_offsets(counts)
+  return [content[content_indices(indices, counts, offsets)] for indices in (l1_indices, l2_indices)]
+
+
+def count_per_event(jagged, condition):
+  ''' number of entries per event satisfying 'condition', a function applied to the flattened content '''
+  content, counts = jagged_content(jagged)
+  event_index = np.repeat(np.arange(len(counts)), counts)
+  return np.bincount(event_index[condition(content)], minlength=len(counts))
+
+
+def pad_jagged(jagged, max_length=None, fill_value=0):
+  '''
+  Convert a jagged branch to a rectangular (nEvents, max_length) array.
+  Returns the padded array and a boolean mask of which entries are real.
+  '''
+  content, counts = jagged_content(jagged)
+  if max_length is None: max_length = int(counts.max()) if len(counts) > 0 else 0
+  positions = np.arange(max_length)
+  valid     = positions[np.newaxis, :] < counts[:, np.newaxis]
+  flat_idx  = jagged_offsets(counts)[:, np.newaxis] + positions[np.newaxis, :]
+  padded    = np.full(valid.shape, fill_value, dtype=content.dtype)
+  padded[valid] = content[flat_idx[valid]]
+  return padded, valid
+
+
+def compact_padded(valid, *padded_arrays):
+  '''
+  Move the valid entries of each row to the front, preserving their order.
+  Used to mimic building a python list of only passing objects.
+  '''
+  order = np.argsort(~valid, axis=1, kind="stable")
+  compacted = [np.take_along_axis(array, order, axis=1) for array in padded_arrays]
+  return np.take_along_axis(valid, order, axis=1), compacted
+
+
+def phi_mpi_pi_array(delta_phi):
+  ''' array version of calculate_functions.phi_mpi_pi '''
+  return np.where(delta_phi > np.pi, delta_phi - 2*np.pi,
+                  np.where(delta_phi < -np.pi, delta_phi + 2*np.pi, delta_phi))
+
+
+def calculate_mt_array(lep_pt, lep_phi, MET_pt, MET_phi):
+  ''' array version of calculate_functions.calculate_mt '''
+  delta_phi = phi_mpi_pi_array(lep_phi - MET_phi)
+  return np.sqrt(2 * lep_pt * MET_pt * (1 - np.cos(delta_phi) ) )
+
+
+def calculate_acoplan_array(l1_phi, l2_phi):
+  ''' array version of calculate_functions.calculate_acoplan '''
+  return 1 - (abs(phi_mpi_pi_array(l1_phi - l2_phi))/np.pi)
+
+
+def calculate_dphi_array(phi1, phi2):
+  ''' |delta phi| folded into [0, pi], as done with acos(cos(dphi)) in the cut functions '''
+  try: # catch versioning differnece between numpy 1 and 2
+    return np.acos(np.cos(phi1 - phi2))
+  except AttributeError:
+    return np.arccos(np.cos(phi1 - phi2))
+
+
+def _libm(function, values):
+  ''' elementwise python math function, returns a float64 array of the same shape '''
+  values = np.asarray(values, dtype=np.float64)
+  return np.frompyfunc(function, 1, 1)(values).astype(np.float64).reshape(values.shape)
+
+
+def encode_single_decayMode(decayMode):
+  ''' array version of single_DM_encoder = {0: 0, 1: 1, 10:2, 11:3}, unknown decay modes raise a KeyError '''
+  decayMode = np.asarray(decayMode).astype(np.int64)
+  single_DM_lookup = np.full(12, -1, dtype=np.int64)
+  single_DM_lookup[[0, 1, 10, 11]] = [0, 1, 2, 3]
+  known = (decayMode >= 0) & (decayMode < 12)
+  encoded = np.where(known, single_DM_lookup[np.where(known, decayMode, 0)], -1)
+  if np.any(encoded < 0): raise KeyError(int(decayMode[encoded < 0][0]))
+  return encoded
+
+
+def PtEtaPhiM_to_XYZT(pt, eta, phi, mass):
+  ''' same arithmetic as TLorentzVector::SetPtEtaPhiM, in double precision '''
+  pt, eta, phi, mass = (np.asarray(v, dtype=np.float64) for v in (pt, eta, phi, mass))
+  pt = np.abs(pt)
+  x = pt*np.cos(phi)
+  y = pt*np.sin(phi)
+  z = pt*_libm(math.sinh, eta)
+  p2 = x*x + y*y + z*z
+  t = np.where(mass >= 0, np.sqrt(p2 + mass*mass), np.sqrt(np.maximum(p2 - mass*mass, 0.)))
+  return x, y, z, t
+
+
+def vector_mass(x, y, z, t):
+  ''' TLorentzVector::M, negative for space-like vectors '''
+  mm = t*t - (x*x + y*y + z*z)
+  return np.where(mm < 0.0, -np.sqrt(np.abs(mm)), np.sqrt(np.abs(mm)))
+
+
+def vector_pt(x, y):
+  ''' TLorentzVector::Pt '''
+  return np.sqrt(x*x + y*y)
+
+
+def vector_eta(x, y, z):
+  ''' TLorentzVector::Eta (TVector3::PseudoRapidity) '''
+  mag = np.sqrt(x*x + y*y + z*z)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    cos_theta = np.where(mag == 0.0, 1.0, z/mag)
+  defined = (cos_theta*cos_theta < 1)
+  eta = np.where(z == 0, 0., np.where(z > 0, 10e10, -10e10))
+  ratio = (1.0 - cos_theta[defined])/(1.0 + cos_theta[defined])
+  eta[defined] = -0.5*_libm(math.log, ratio)
+  return eta
+
+
+def highest_mjj_pair_array(x, y, z, t, nJets):
+  '''
+  Columnar version of calculate_functions.highest_mjj_pair.
+  Inputs are padded (nEvents, max_jets) cartesian components with the jets of
+  each event stored first, and the number of jets per event.
+  Ties resolve to the first (j, k) pair in the original loop order.
+  Events with fewer than two jets return indices of -1 and mjj of -999.
+  '''
+  nEvents, max_jets = x.shape
+  mjj    = np.full(nEvents, -999.)
+  j1_idx = np.full(nEvents, -1, dtype=np.int64)
+  j2_idx = np.full(nEvents, -1, dtype=np.int64)
+  for k_jet in range(1, max_jets):
+    rows = np.flatnonzero(nJets > k_jet)
+    if len(rows) == 0: break
+    for j_jet in range(k_jet):
+      temp_mjj = vector_mass(x[rows, j_jet] + x[rows, k_jet], y[rows, j_jet] + y[rows, k_jet],
+                             z[rows, j_jet] + z[rows, k_jet], t[rows, j_jet] + t[rows, k_jet])
+      # pairs are visited k-first here, but the original loop is j-first with a strict '>'
+      # so on a tie the pair with the smaller j must win
+      better = (temp_mjj > mjj[rows]) | ((temp_mjj == mjj[rows]) & (j_jet < j1_idx[rows]))
+      update = rows[better]
+      mjj[update]    = temp_mjj[better]
+      j1_idx[update] = j_jet
+      j2_idx[update] = k_jet
+  return j1_idx, j2_idx, mjj
+
+
+def take_pair(padded, j1_idx, j2_idx):
+  ''' return the entries at j1_idx and j2_idx of each row of a padded array (indices must be valid) '''
+  rows = np.arange(len(j1_idx))
+  return padded[rows, j1_idx], padded[rows, j2_idx]
+
+
+def get_dijet_info(jet_pt, jet_eta, jet_phi, jet_mass, nJet, valid=None):
+  '''
+  Find the highest mjj pair in each event and return its indices, mass, and the
+  ROOT-style pt/eta of both jets. jet_* are jagged branches, or padded arrays if
+  'valid' (a prefix mask of real entries) is given.
+  Only the first nJet jets of each event are considered, as in the per-event loops.
+  '''
+  if valid is None:
+    jet_pt,   valid = pad_jagged(jet_pt)
+    jet_eta,  _     = pad_jagged(jet_eta)
+    jet_phi,  _     = pad_jagged(jet_phi)
+    jet_mass, _     = pad_jagged(jet_mass)
+  nJet = np.minimum(np.asarray(nJet, dtype=np.int64), valid.sum(axis=1))
+  x, y, z, t = PtEtaPhiM_to_XYZT(jet_pt, jet_eta, jet_phi, jet_mass)
+  j1_idx, j2_idx, mjj = highest_mjj_pair_array(x, y, z, t, nJet)
+  has_pair = (j1_idx >= 0)
+  safe_j1, safe_j2 = np.where(has_pair, j1_idx, 0), np.where(has_pair, j2_idx, 0)
+  x1, x2 = take_pair(x, safe_j1, safe_j2)
+  y1, y2 = take_pair(y, safe_j1, safe_j2)
+  z1, z2 = take_pair(z, safe_j1, safe_j2)
+  dijet_info = {
+    "j1_idx" : j1_idx,
+    "j2_idx" : j2_idx,
+    "mjj"    : mjj,
+    "j1_pt"  : vector_pt(x1, y1),
+    "j2_pt"  : vector_pt(x2, y2),
+    "j1_eta" : vector_eta(x1, y1, z1),
+    "j2_eta" : vector_eta(x2, y2, z2),
+    "has_pair" : has_pair,
+  }
+  return dijet_info
+
+
+def get_event_jet_kinematics(nJet, jet_pt, jet_eta, jet_phi, jet_mass):
+  '''
+  Jet quantities used by the trigger kinematic checks in the final state cut functions.
+  Dummy values are -999, events with one jet only have j1_pt set (to the stored jet pt),
+  and events with two or more jets use the highest mjj pair with ROOT-style pt and eta.
+  '''
+  nJet = np.asarray(nJet, dtype=np.int64)
+  nEvents = len(nJet)
+  jet_kinematics = {key : np.full(nEvents, -999.) for key in ["j1_pt", "j2_pt", "j1_eta", "j2_eta", "mjj"]}
+  one_jet  = np.flatnonzero(nJet == 1)
+  two_jets = np.flatnonzero(nJet >= 2)
+  if len(one_jet) > 0:
+    jet_kinematics["j1_pt"][one_jet] = gather(jet_pt[one_jet], np.zeros(len(one_jet), dtype=np.int64))
+  if len(two_jets) > 0:
+    dijet = get_dijet_info(jet_pt[two_jets], jet_eta[two_jets], jet_phi[two_jets], jet_mass[two_jets], nJet[two_jets])
+    for key in jet_kinematics:
+      jet_kinematics[key][two_jets] = dijet[key]
+  return jet_kinematics
+
+
+def branch_length(values):
+  ''' number of entries in a branch, None for a single value '''
+  return len(values) if hasattr(values, "__len__") else None
+
+
+def event_count(event_dictionary):
+  ''' number of loaded events (entries of the input tree passing good_events), one "run" per event '''
+  return len(event_dictionary["run"])
+
+
+class EventTable(MutableMapping):
+  '''
+  Event dictionary ({branch : array}) with one shared row count (nRows), set from the number of loaded events,
+  and the alignment of every branch, so apply_cut knows which branches to cut without a list of protected branches.
+  Each branch is declared by how it was made, and its length is checked when it is added:
+  - aligned (table[branch] = values, or add_aligned): one entry per row, cut by every cut.
+  - selection (add_selection): the sorted indices of the rows passing a cut, e.g. "pass_cuts".
+    apply_cut keeps those rows, after which the selection is aligned (the row number before the cut of each row).
+  - selected (add_selected): made by a cut function for the rows of a selection that is not applied yet,
+    aligned once that selection is applied.
+  A branch with the wrong length raises a ValueError when it is added instead of being silently misaligned.
+  Selections that are not applied and their selected branches are not cut by other cuts, as the protected branches
+  were, and a selection made before the last cut can not be applied anymore.
+  Cuts are also lazy: apply_selection() records the selected indices instead of copying each branch,
+  successive cuts are composed on the (small) index arrays, and a branch is only copied with np.take
+  the first time it is read after a cut. Branches that are never read again are never copied.
+  Use store_selection in functions that also take plain dictionaries.
+  '''
+  __slots__ = ("branches", "selections", "selected_by", "pending", "nRows", "nCuts")
+
+  def __init__(self, event_dictionary, nRows):
+    self.branches    = {} # branch : values before the pending selection
+    self.selections  = {} # branch : pending indices into the values, None if there is none
+    self.selected_by = {} # branch : the selection it is waiting for, itself for a selection, None if aligned
+    self.pending     = {} # selection : nCuts when it was added
+    self.nRows       = nRows
+    self.nCuts       = 0  # number of cuts that removed rows
+    for branch in event_dictionary:
+      self.add_aligned(branch, event_dictionary[branch])
+
+  def __getitem__(self, branch):
+    values, selection = self.branches[branch], self.selections[branch]
+    if selection is not None:
+      values = take_rows(values, selection)
+      self.branches[branch], self.selections[branch] = values, None
+    return values
+
+  def __setitem__(self, branch, values):
+    self.add_aligned(branch, values)
+
+  def add_aligned(self, branch, values):
+    ''' add a branch with one entry per row '''
+    if branch_length(values) != self.nRows:
+      raise ValueError(f"{branch} has {branch_length(values)} entries for {self.nRows} events")
+    self.branches[branch], self.selections[branch], self.selected_by[branch] = values, None, None
+    self.pending.pop(branch, None)
+
+  def add_selection(self, branch, indices):
+    ''' add the sorted indices of the rows passing a cut, applied later by apply_cut (apply_selection) '''
+    indices = np.asarray(indices)
+    if (indices.ndim != 1) or ((len(indices) > 0) and (indices.dtype.kind not in "iu")):
+      raise ValueError(f"{branch} is not an array of row indices")
+    if (len(indices) > 0) and ((indices[0] < 0) or (indices[-1] >= self.nRows) or np.any(np.diff(indices) <= 0)):
+      raise ValueError(f"{branch} is not a sorted selection of the {self.nRows} events")
+    self.branches[branch], self.selections[branch], self.selected_by[branch] = indices, None, branch
+    self.pending[branch] = self.nCuts
+
+  def add_selected(self, branch, values, selection):
+    ''' add a branch made for the rows of 'selection' only, one entry per selected row '''
+    if selection not in self.pending:
+      raise ValueError(f"{branch} is made for {selection}, which is not a pending selection")
+    if branch_length(values) != len(self.branches[selection]):
+      raise ValueError(f"{branch} has {branch_length(values)} entries for the {len(self.branches[selection])} events of {selection}")
+    self.branches[branch], self.selections[branch], self.selected_by[branch] = values, None, selection
+    self.pending.pop(branch, None)
+
+  def __delitem__(self, branch):
+    del self.branches[branch]
+    del self.selections[branch]
+    del self.selected_by[branch]
+    self.pending.pop(branch, None)
+
+  def __contains__(self, branch):
+    return branch in self.branches
+
+  def __iter__(self):
+    return iter(self.branches)
+
+  def __len__(self):
+    return len(self.branches)
+
+  def __copy__(self):
+    ''' shallow copy, branches and pending selections are shared until they are read or cut '''
+    copied = EventTable({}, self.nRows)
+    copied.branches, copied.selections = dict(self.branches), dict(self.selections)
+    copied.selected_by, copied.pending = dict(self.selected_by), dict(self.pending)
+    copied.nCuts = self.nCuts
+    return copied
+
+  def apply_selection(self, selection):
+    '''
+    Keep the rows of the pending 'selection' in every aligned branch, and align the branches made for it.
+    Branches with the same pending np.take share one composed index array.
+    '''
+    if selection not in self.pending:
+      raise ValueError(f"{selection} is not a pending selection")
+    if self.pending.pop(selection) != self.nCuts:
+      raise ValueError(f"{selection} was made before the last cut, it does not select the current events")
+    indices  = self.branches[selection]
+    nKept    = len(indices)
+    composed = {} # id of a pending np.take : (that index array, composed index array)
+    for branch, taken in self.selections.items():
+      if self.selected_by[branch] == selection:
+        self.selected_by[branch] = None
+        continue
+      if self.selected_by[branch] is not None: continue # waiting for another selection
+      if nKept == self.nRows: continue # every row passes, nothing to select
+      if taken is None:
+        self.selections[branch] = indices
+        continue
+      if id(taken) not in composed:
+        composed[id(taken)] = (taken, np.take(taken, indices))
+      self.selections[branch] = composed[id(taken)][1]
+    if nKept != self.nRows: self.nCuts += 1
+    self.nRows = nKept
+    return self
+
+
+def store_selection(event_dictionary, selection, indices, selected_branches={}):
+  '''
+  Store the indices of the events passing a cut as 'selection', and 'selected_branches' ({branch : values}),
+  made for those events only. An EventTable checks their lengths and aligns them when apply_cut applies 'selection',
+  a plain dictionary just stores them (apply_cut then needs them as protected branches).
+  '''
+  if isinstance(event_dictionary, EventTable):
+    event_dictionary.add_selection(selection, indices)
+    for branch, values in selected_branches.items():
+      event_dictionary.add_selected(branch, values, selection)
+  else:
+    event_dictionary[selection] = indices
+    for branch, values in selected_branches.items():
+      event_dictionary[branch] = values
+  return event_dictionary
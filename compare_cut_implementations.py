@@ -0,0 +1,164 @@
+# equivalence check between the columnar cut functions and the original event-by-event versions
+import numpy as np
+import argparse
+import copy
+import time
+
+import uproot
+
+from setup                   import set_good_events
+from branch_functions        import set_branches
+from FF_functions            import FF_control_flow # imported first to resolve the circular FF/cut import
+from FF_functions            import FF_region_parameters, FF_region_branch, make_FF_region_flags, select_FF_region
+from FF_functions            import FF_region_flags_branch
+from cut_and_study_functions import append_lepton_indices, make_jet_cut, make_jet_cut_rowscan
+from cut_and_study_functions import append_lepton_indices_rowscan, append_flavor_indices, append_flavor_indices_rowscan
+from cut_ditau_functions     import make_ditau_cut, make_ditau_cut_rowscan
+from cut_mutau_functions     import make_mutau_cut, make_mutau_cut_rowscan
+from cut_etau_functions      import make_etau_cut, make_etau_cut_rowscan
+from cut_emu_functions       import make_emu_cut, make_emu_cut_rowscan
+from cut_dimuon_functions    import make_dimuon_cut, make_dimuon_cut_rowscan
+from cut_dimuon_functions    import manual_dimuon_lepton_veto, manual_dimuon_lepton_veto_rowscan
+from cut_ditau_functions     import make_ditau_region_rowscan
+from cut_mutau_functions     import make_mutau_region_rowscan
+from cut_etau_functions      import make_etau_region_rowscan
+from cut_emu_functions       import make_emu_region_rowscan
+from cut_dimuon_functions    import make_dimuon_region_rowscan
+
+### README
+# Loads one or more ntuples, runs both versions of a cut function on identical copies of the events,
+# and diffs every branch the functions create. Values must match exactly (NaNs compare equal).
+# The FF regions of the final state are also compared, region flags against the rowscan make_*_region.
+# The lepton and (for MC) gen flavor indices appended before any cut are compared first.
+# Example usage:
+#   python3 compare_cut_implementations.py --final_state ditau --era 2022EFG --DeepTau 2p5 \
+#     --input "/path/to/Run3FSSplitSamples/ditau/MC/VBF*.root"
+# dtype differences are reported but are not failures, since several rowscan outputs
+# were built from lists of mixed python and numpy scalars.
+
+
+def FS_cut_implementations(era, DeepTau_version, tau_pt_cut):
+  '''
+  Return {final_state : (columnar function, rowscan function)}, both taking only the event dictionary
+  '''
+  implementations = {
+    "ditau" : (lambda events: make_ditau_cut(era, events, DeepTau_version, tau_pt_cut=tau_pt_cut),
+               lambda events: make_ditau_cut_rowscan(era, events, DeepTau_version, tau_pt_cut=tau_pt_cut)),
+    "mutau" : (lambda events: make_mutau_cut(era, events, DeepTau_version, tau_pt_cut=tau_pt_cut),
+               lambda events: make_mutau_cut_rowscan(era, events, DeepTau_version, tau_pt_cut=tau_pt_cut)),
+    "etau"  : (lambda events: make_etau_cut(era, events, DeepTau_version, tau_pt_cut=tau_pt_cut),
+               lambda events: make_etau_cut_rowscan(era, events, DeepTau_version, tau_pt_cut=tau_pt_cut)),
+    "emu"   : (lambda events: make_emu_cut(era, events),
+               lambda events: make_emu_cut_rowscan(era, events)),
+    "dimuon" : (lambda events: make_dimuon_cut(events),
+                lambda events: make_dimuon_cut_rowscan(events)),
+  }
+  return implementations
+
+
+def FS_region_implementations(final_state, DeepTau_version):
+  '''
+  Return {region : (selection from the region flags, rowscan make_*_region)} for every FF region of the final state
+  '''
+  rowscan_region = {"ditau" : make_ditau_region_rowscan, "mutau" : make_mutau_region_rowscan,
+                    "etau"  : make_etau_region_rowscan,  "emu"   : make_emu_region_rowscan,
+                    "dimuon" : make_dimuon_region_rowscan}[final_state]
+  def from_flags(events, region):
+    events = make_FF_region_flags(events, final_state, DeepTau_version)
+    events = select_FF_region(events, final_state, region, DeepTau_version)
+    del events[FF_region_flags_branch(final_state, DeepTau_version)] # only the region branch is compared
+    return events
+  implementations = {}
+  for region, parameters in FF_region_parameters(final_state, DeepTau_version).items():
+    implementations[region] = (lambda events, region=region: from_flags(events, region),
+                               lambda events, region=region, parameters=parameters:
+                                 rowscan_region(events, FF_region_branch(region), **parameters))
+  return implementations
+
+
+def compare_outputs(label, events, columnar_function, rowscan_function):
+  '''
+  Run both functions on shallow copies of 'events' and compare every new branch.
+  Returns True if all branches are identical.
+  '''
+  columnar_events, rowscan_events = copy.copy(events), copy.copy(events)
+  start = time.time()
+  columnar_events = columnar_function(columnar_events)
+  columnar_time = time.time() - start
+  start = time.time()
+  rowscan_events = rowscan_function(rowscan_events)
+  rowscan_time = time.time() - start
+
+  new_columnar = set(columnar_events) - set(events)
+  new_rowscan  = set(rowscan_events) - set(events)
+  all_match = True
+  if (new_columnar != new_rowscan):
+    all_match = False
+    print(f"{label}: branches only in columnar output {sorted(new_columnar - new_rowscan)}")
+    print(f"{label}: branches only in rowscan output {sorted(new_rowscan - new_columnar)}")
+
+  for branch in sorted(new_columnar & new_rowscan):
+    columnar, rowscan = np.asarray(columnar_events[branch]), np.asarray(rowscan_events[branch])
+    if (columnar.shape != rowscan.shape):
+      all_match = False
+      print(f"{label}: {branch} shape differs, columnar {columnar.shape} rowscan {rowscan.shape}")
+      continue
+    if (len(rowscan) == 0): continue
+    if (columnar.dtype != rowscan.dtype):
+      print(f"{label}: {branch} dtype differs, columnar {columnar.dtype} rowscan {rowscan.dtype} (values compared)")
+    if not np.array_equal(columnar, rowscan, equal_nan=(columnar.dtype.kind == "f")):
+      all_match = False
+      mismatched = np.flatnonzero(columnar != rowscan)
+      print(f"{label}: {branch} differs in {len(mismatched)} events, first at {mismatched[:5]}")
+      print(f"  columnar {columnar[mismatched[:5]]}")
+      print(f"  rowscan  {rowscan[mismatched[:5]]}")
+
+  print(f"{label}: {'identical' if all_match else 'DIFFERENT'}, " + \
+        f"columnar {columnar_time:.2f}s, rowscan {rowscan_time:.2f}s, {len(events['Lepton_pt'])} events")
+  return all_match
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compare columnar and rowscan cut functions on the same events.")
+  parser.add_argument('--input',       dest='input',       required=True, help='ntuple(s) to load, wildcards allowed')
+  parser.add_argument('--final_state', dest='final_state', default="ditau", action='store')
+  parser.add_argument('--era',         dest='era',         default="2022 G", action='store')
+  parser.add_argument('--DeepTau',     dest='DeepTau_version', default="2p5", action='store')
+  parser.add_argument('--tau_pt',      dest='tau_pt_cut',  default="None", action='store')
+  parser.add_argument('--jet_modes',   dest='jet_modes',   default="0j,1j,2j,GTE1j,GTE2j",
+                      help='comma separated jet modes to compare for make_jet_cut')
+  parser.add_argument('--max_events',  dest='max_events',  default=-1, type=int, help='only compare the first N events')
+  args = parser.parse_args()
+
+  good_events = set_good_events(args.final_state, args.era)
+  branches    = set_branches(args.final_state, args.era, args.DeepTau_version)
+  input_files = args.input if args.input.endswith(":Events") else args.input + ":Events"
+  events = uproot.concatenate([input_files], branches, cut=good_events, library="np")
+  if (args.max_events > 0):
+    events = {branch : values[:args.max_events] for branch, values in events.items()}
+  all_match = compare_outputs("lepton indices", events, append_lepton_indices, append_lepton_indices_rowscan)
+  events = append_lepton_indices(events)
+
+  if ("Tau_genPartFlav" in events) and (args.final_state in ["ditau", "mutau", "etau"]):
+    for keep_fakes in [False, True]:
+      all_match &= compare_outputs(f"flavor indices keep_fakes={keep_fakes}", events,
+                                   lambda events: append_flavor_indices(events, args.final_state, keep_fakes),
+                                   lambda events: append_flavor_indices_rowscan(events, args.final_state, keep_fakes))
+
+  implementations = FS_cut_implementations(args.era, args.DeepTau_version, args.tau_pt_cut)
+  if args.final_state in implementations:
+    all_match &= compare_outputs(args.final_state, events, *implementations[args.final_state])
+  else:
+    print(f"No rowscan comparison available for {args.final_state}")
+  if (args.final_state == "dimuon"):
+    all_match &= compare_outputs("dimuon lepton veto", events, manual_dimuon_lepton_veto, manual_dimuon_lepton_veto_rowscan)
+
+  for region, (flag_function, rowscan_function) in FS_region_implementations(args.final_state, args.DeepTau_version).items():
+    all_match &= compare_outputs(f"region {region}", events, flag_function, rowscan_function)
+
+  for jet_mode in args.jet_modes.split(","):
+    all_match &= compare_outputs(f"jets {jet_mode}", events,
+                                 lambda events: make_jet_cut(events, jet_mode),
+                                 lambda events: make_jet_cut_rowscan(events, jet_mode))
+
+  print("all outputs identical" if all_match else "differences found, see above")
@@ -6,7 +6,6 @@ import numpy as np
 import sys
 import matplotlib.pyplot as plt
 import gc
-import copy
 
 # explicitly import used functions from user files, grouped roughly by call order and relatedness
 # import statements for setup
@@ -19,7 +18,7 @@ from file_map_dictionary import set_dataset_info
 from file_functions          import load_process_from_file, append_to_combined_processes, sort_combined_processes
 from FF_functions            import set_JetFakes_process, FF_control_flow
 from cut_and_study_functions import apply_HTT_FS_cuts_to_process
-from cut_and_study_functions import apply_cut, set_protected_branches
+from cut_and_study_functions import split_DY_by_gen
 
 # plotting
 from luminosity_dictionary import luminosities_with_normtag as luminosities
@@ -64,7 +63,8 @@ if __name__ == "__main__":
 
   print_setup_info(setup)
   # used for printing, might be different from what is called per process
-  good_events  = set_good_events(final_state_mode, era, non_SR_region=False, temp_version=temp_version)
+  good_events  = set_good_events(final_state_mode, era, non_SR_region=False, temp_version=temp_version,
+                                 pushdown_SR=True)
   branches     = set_branches(final_state_mode, era, DeepTau_version, "ggH_TauTau", temp_version=temp_version)
   vars_to_plot = set_vars_to_plot(final_state_mode, jet_mode=jet_mode)
   from branch_functions import add_signal_branches
@@ -101,7 +101,7 @@ if __name__ == "__main__":
       this_file_map = {process: input_file} # Make a temporary filemap just for this loop
       new_process_dictionary = load_process_from_file(process, using_directory, this_file_map, log_file,
                                                 branches, good_events, final_state_mode,
-                                                data=("Data" in process), testing=testing)
+                                                testing=testing)
       if new_process_dictionary == None: continue # skip process if empty
 
       cut_events = apply_HTT_FS_cuts_to_process(era, process, new_process_dictionary, log_file, final_state_mode, jet_mode,
@@ -110,36 +110,16 @@ if __name__ == "__main__":
       if cut_events == None: continue
 
       if ("DY" in process) and (final_state_mode != "dimuon"):
-        # def split_DY_by_gen, return combined_process_dictionary
-        event_flavor_arr = cut_events["event_flavor"]
-        pass_gen_flav, pass_lep_flav, pass_jet_flav = [], [], []
-        for i, event_flavor in enumerate(event_flavor_arr):
-          if event_flavor == "G": pass_gen_flav.append(i)
-          if event_flavor == "L": pass_lep_flav.append(i)
-          if event_flavor == "J": pass_jet_flav.append(i)
-    
-        protected_branches = set_protected_branches(final_state_mode="none", jet_mode="Inclusive")
-        background_gen_deepcopy = copy.deepcopy(cut_events)
-        background_gen_deepcopy["pass_flavor_cut"] = np.array(pass_gen_flav)
-        background_gen_deepcopy = apply_cut(background_gen_deepcopy, "pass_flavor_cut", protected_branches)
-        if background_gen_deepcopy == None: continue
-
-        background_lep_deepcopy = copy.deepcopy(cut_events)
-        background_lep_deepcopy["pass_flavor_cut"] = np.array(pass_lep_flav)
-        background_lep_deepcopy = apply_cut(background_lep_deepcopy, "pass_flavor_cut", protected_branches)
-        if background_lep_deepcopy == None: continue
-
-        background_jet_deepcopy = copy.deepcopy(cut_events)
-        background_jet_deepcopy["pass_flavor_cut"] = np.array(pass_jet_flav)
-        background_jet_deepcopy = apply_cut(background_jet_deepcopy, "pass_flavor_cut", protected_branches)
-        if background_jet_deepcopy == None: continue
+        DY_splits = split_DY_by_gen(cut_events)
+        if DY_splits == None: continue
+        background_gen, background_lep, background_jet = DY_splits
 
         if ("NLO" in process): process += "temp"
-        combined_process_dictionary = append_to_combined_processes(process.replace("temp","DYGen"), background_gen_deepcopy, 
+        combined_process_dictionary = append_to_combined_processes(process.replace("temp","DYGen"), background_gen, 
                                              vars_to_plot, combined_process_dictionary, one_file_at_a_time)
-        combined_process_dictionary = append_to_combined_processes(process.replace("temp","DYLep"), background_lep_deepcopy, 
+        combined_process_dictionary = append_to_combined_processes(process.replace("temp","DYLep"), background_lep, 
                                              vars_to_plot, combined_process_dictionary, one_file_at_a_time)
-        combined_process_dictionary = append_to_combined_processes(process.replace("temp","DYJet"), background_jet_deepcopy, 
+        combined_process_dictionary = append_to_combined_processes(process.replace("temp","DYJet"), background_jet, 
                                              vars_to_plot, combined_process_dictionary, one_file_at_a_time)
       else:
         combined_process_dictionary = append_to_combined_processes(process, cut_events, vars_to_plot, 
@@ -1,9 +1,13 @@
 import numpy as np
+import copy
 
 ### README
 # this file contains functions to perform cuts and self-contained studies
 
 from calculate_functions  import highest_mjj_pair, return_TLorentz_Jets
+from columnar_functions   import pad_jagged, compact_padded, take_pair, get_dijet_info
+from columnar_functions   import jagged_content, jagged_offsets, gather, gather_pair, take_rows
+from columnar_functions   import EventTable, event_count, store_selection
 from utility_functions    import text_options, log_print
 
 from cut_ditau_functions  import make_ditau_cut 
@@ -13,7 +17,7 @@ from cut_dimuon_functions import make_dimuon_cut, manual_dimuon_lepton_veto
 from cut_emu_functions    import make_emu_cut
  
 from FF_functions         import make_ditau_SR_cut, make_mutau_SR_cut, make_etau_SR_cut, make_emu_SR_cut
-from FF_functions         import make_ditau_AR_cut, make_ditau_AR_star_cut, make_mutau_AR_cut, make_etau_AR_cut, make_emu_AR_cut
+from FF_functions         import FF_control_flow
 from FF_functions         import add_FF_weights, add_FF_weight_from_branch
 
 from file_functions       import load_and_store_NWEvents 
@@ -24,6 +28,22 @@ def append_lepton_indices(event_dictionary):
   Read the entries of "FSLeptons" and extract the values to place in separate branches.
   It was easier to do this once when the data is first loaded than to do it every time
   that it is needed. 
+  The first two entries of every event are read from the flattened branch at once,
+  outputs are identical to append_lepton_indices_rowscan.
+  '''
+  FSLeptons, nFSLeptons = jagged_content(event_dictionary["FSLeptons"])
+  if np.any(nFSLeptons < 2): raise IndexError("FSLeptons has fewer than two entries in some events")
+  nMultiplePairs = np.count_nonzero(nFSLeptons > 2)
+  if nMultiplePairs > 0: print(f"More than one FS pair in {nMultiplePairs} events, using the first pair")
+  offsets = jagged_offsets(nFSLeptons)
+  event_dictionary["l1_indices"] = FSLeptons[offsets]
+  event_dictionary["l2_indices"] = FSLeptons[offsets + 1]
+  return event_dictionary
+
+
+def append_lepton_indices_rowscan(event_dictionary):
+  '''
+  Original event-by-event version of append_lepton_indices, kept to validate the columnar version.
   '''
   FSLeptons = event_dictionary["FSLeptons"]
   l1_indices, l2_indices = [], []
@@ -36,7 +56,72 @@ def append_lepton_indices(event_dictionary):
   return event_dictionary
 
 
+# event_flavor is stored as an int8 code instead of the letters used before
+# G : genuine tau(s), L : tau(s) faked by a lepton, J : tau(s) faked by a jet
+event_flavor_codes = {"G" : 0, "L" : 1, "J" : 2}
+
 def append_flavor_indices(event_dictionary, final_state_mode, keep_fakes=False):
+  '''
+  Gen match the FS taus with Tau_genPartFlav. Events passing are stored in "pass_gen_cuts":
+  genuine and lepton fakes, and also jet fakes if 'keep_fakes' is True, along with their tau flavors
+  and event_flavor code (see event_flavor_codes).
+  The tau flavors are looked up with fancy indexing into the flattened branches,
+  outputs are identical to append_flavor_indices_rowscan.
+  '''
+  nEvents = len(event_dictionary["Lepton_pt"])
+  if (final_state_mode == "ditau") or (final_state_mode == "mutau") or (final_state_mode == "etau"):
+    tau_idx, tau_flav = event_dictionary["Lepton_tauIdx"], event_dictionary["Tau_genPartFlav"]
+    t1_tau_idx, t2_tau_idx = gather_pair(tau_idx, event_dictionary["l1_indices"], event_dictionary["l2_indices"])
+
+  if final_state_mode == "ditau":
+    t1_flav, t2_flav = gather_pair(tau_flav, t1_tau_idx, t2_tau_idx)
+    # genuine tau --> both taus are taus at gen level
+    genuine  = (t1_flav == 5) & (t2_flav == 5)
+    # jet fake --> one tau is faked by jet
+    jet_fake = ~genuine & ((t1_flav == 0) | (t2_flav == 0))
+    # lep fake --> both taus are faked by lepton
+    # event with one tau faking jet enters category above first due to ordering
+    # implies also the case where both are faked but one is faked by lepton 
+    # is added to jet fakes, which i think is fine
+    lep_fake = ~genuine & ~jet_fake & (((t1_flav < 5) & (t1_flav > 0)) | ((t2_flav < 5) & (t1_flav > 0)))
+  elif ((final_state_mode == "mutau") or (final_state_mode == "etau")):
+    t1_flav  = gather(tau_flav, t1_tau_idx + t2_tau_idx + 1) # update with NanoAODv12 samples
+    t2_flav  = np.full(nEvents, -1)
+    genuine  = (t1_flav == 5)
+    jet_fake = (t1_flav == 0)
+    lep_fake = (t1_flav < 5) & (t1_flav > 0)
+
+  # TODO: Braden I don't think this is gen-matching
+  else:
+    if (nEvents > 0):
+      print(f"No gen matching for that final state ({final_state_mode}), no branches appended")
+      return event_dictionary
+    t1_flav, t2_flav = np.zeros(0), np.zeros(0) # empty branches, as the original loop made
+    genuine = lep_fake = jet_fake = np.zeros(0, dtype=bool)
+
+  flavor = np.full(nEvents, -1, dtype=np.int8)
+  flavor[genuine]  = event_flavor_codes["G"]
+  flavor[lep_fake] = event_flavor_codes["L"]
+  flavor[jet_fake] = event_flavor_codes["J"]
+  # save genuine background events and lep_fakes, remove jet fakes with gen matching
+  # used in all categories because fakes are estimated with FF method
+  pass_gen = genuine | lep_fake
+  # keep_fakes saves all events and their flavors, even if they are jet fakes
+  # used to split DY to genuine, lep fakes, and jet fakes in all categories
+  if (keep_fakes==True): pass_gen = pass_gen | jet_fake
+
+  event_dictionary = store_selection(event_dictionary, "pass_gen_cuts", np.flatnonzero(pass_gen), {
+    "FS_t1_flav"   : t1_flav[pass_gen],
+    "FS_t2_flav"   : t2_flav[pass_gen],
+    "event_flavor" : flavor[pass_gen],
+  })
+  return event_dictionary
+
+
+def append_flavor_indices_rowscan(event_dictionary, final_state_mode, keep_fakes=False):
+  '''
+  Original event-by-event version of append_flavor_indices, kept to validate the columnar version.
+  '''
   unpack_flav = ["l1_indices", "l2_indices", "Lepton_tauIdx", "Tau_genPartFlav"]
   unpack_flav = (event_dictionary.get(key) for key in unpack_flav)
   to_check = [range(len(event_dictionary["Lepton_pt"])), *unpack_flav]
@@ -44,6 +129,7 @@ def append_flavor_indices(event_dictionary, final_state_mode, keep_fakes=False):
   pass_gen_cuts, event_flavor = [], []
   for i, l1_idx, l2_idx, tau_idx, tau_flav in zip(*to_check):
     genuine, lep_fake, jet_fake = False, False, False
+    flavor = -1
     t1_flav = -1
     t2_flav = -1
     if final_state_mode == "ditau":
@@ -52,29 +138,29 @@ def append_flavor_indices(event_dictionary, final_state_mode, keep_fakes=False):
       if (t1_flav == 5) and (t2_flav == 5):
         # genuine tau --> both taus are taus at gen level
         genuine = True
-        event_flavor.append("G")
+        flavor = event_flavor_codes["G"]
       elif (t1_flav == 0) or (t2_flav == 0):
         # jet fake --> one tau is faked by jet
         jet_fake = True
-        event_flavor.append("J")
+        flavor = event_flavor_codes["J"]
       elif (t1_flav < 5 and t1_flav > 0) or (t2_flav < 5 and t1_flav > 0):
         # lep fake --> both taus are faked by lepton
         # event with one tau faking jet enters category above first due to ordering
         # implies also the case where both are faked but one is faked by lepton 
         # is added to jet fakes, which i think is fine
         lep_fake = True
-        event_flavor.append("L")
+        flavor = event_flavor_codes["L"]
     elif ((final_state_mode == "mutau") or (final_state_mode == "etau")):
       t1_flav = tau_flav[tau_idx[l1_idx] + tau_idx[l2_idx] + 1] # update with NanoAODv12 samples
       if (t1_flav == 5):
         genuine = True
-        event_flavor.append("G")
+        flavor = event_flavor_codes["G"]
       elif (t1_flav == 0):
         jet_fake = True
-        event_flavor.append("J")
+        flavor = event_flavor_codes["J"]
       elif (t1_flav < 5 and t1_flav > 0):
         lep_fake = True
-        event_flavor.append("L")
+        flavor = event_flavor_codes["L"]
 
     # TODO: Braden I don't think this is gen-matching
     else:
@@ -87,6 +173,7 @@ def append_flavor_indices(event_dictionary, final_state_mode, keep_fakes=False):
       FS_t1_flav.append(t1_flav)
       FS_t2_flav.append(t2_flav)
       pass_gen_cuts.append(i)
+      event_flavor.append(flavor)
 
     if (keep_fakes==True) and ((genuine) or (lep_fake) or (jet_fake)):
       # save all events and their flavors, even if they are jet fakes
@@ -94,11 +181,12 @@ def append_flavor_indices(event_dictionary, final_state_mode, keep_fakes=False):
       FS_t1_flav.append(t1_flav)
       FS_t2_flav.append(t2_flav)
       pass_gen_cuts.append(i)
+      event_flavor.append(flavor)
       
   event_dictionary["FS_t1_flav"] = np.array(FS_t1_flav)
   event_dictionary["FS_t2_flav"] = np.array(FS_t2_flav)
   event_dictionary["pass_gen_cuts"] = np.array(pass_gen_cuts)
-  event_dictionary["event_flavor"]  = np.array(event_flavor)
+  event_dictionary["event_flavor"]  = np.array(event_flavor, dtype=np.int8)
   return event_dictionary
 
 #def make_jet_cut(event_dictionary, jet_mode):
@@ -120,6 +208,102 @@ def make_temp_jet_cut(event_dictionary, jet_mode):
 
 #def make_old_jet_cut(event_dictionary, jet_mode):
 def make_jet_cut(event_dictionary, jet_mode):
+  '''
+  Columnar version of the jet selection. Jets passing pt > 0 and |eta| < 4.7 are counted,
+  and for events with two or more passing jets the highest mjj pair is found with array math
+  (see columnar_functions) instead of building ROOT TLorentzVectors event-by-event.
+  Outputs are the same as make_jet_cut_rowscan, which is kept for validation.
+  '''
+  nJet = np.asarray(event_dictionary["nCleanJet"], dtype=np.int64)
+  max_jets = max(1, int(nJet.max())) if len(nJet) > 0 else 1
+  jet_pt,   valid = pad_jagged(event_dictionary["CleanJet_pt"],   max_length=max_jets)
+  jet_eta,  _     = pad_jagged(event_dictionary["CleanJet_eta"],  max_length=max_jets)
+  jet_phi,  _     = pad_jagged(event_dictionary["CleanJet_phi"],  max_length=max_jets)
+  jet_mass, _     = pad_jagged(event_dictionary["CleanJet_mass"], max_length=max_jets)
+  valid = valid & (np.arange(max_jets)[np.newaxis, :] < nJet[:, np.newaxis])
+  passing = valid & (jet_pt > 0.0) & (abs(jet_eta) < 4.7)
+  #passing = valid & (jet_pt > 30.0) & (abs(jet_eta) < 4.7)
+  nPassingJets = passing.sum(axis=1)
+  passing, (jet_pt, jet_eta, jet_phi, jet_mass) = compact_padded(passing, jet_pt, jet_eta, jet_phi, jet_mass)
+
+  event_dictionary["nCleanJetGT30"] = nPassingJets
+  event_dictionary["CleanJet_pt_1"] = np.where(nPassingJets == 0, -1, jet_pt[:, 0]) # desperate addition for make_fitter_shapes...
+
+  def dijet_columns(selection):
+    ''' highest mjj pair for selected events, which must all have two or more passing jets '''
+    dijet = get_dijet_info(jet_pt[selection], jet_eta[selection], jet_phi[selection], jet_mass[selection],
+                           nPassingJets[selection], valid=passing[selection])
+    j1_idx, j2_idx = dijet["j1_idx"], dijet["j2_idx"]
+    columns = {}
+    columns["CleanJetGT30_pt_1"],  columns["CleanJetGT30_pt_2"]  = take_pair(jet_pt[selection],  j1_idx, j2_idx)
+    columns["CleanJetGT30_eta_1"], columns["CleanJetGT30_eta_2"] = take_pair(jet_eta[selection], j1_idx, j2_idx)
+    columns["CleanJetGT30_phi_1"], columns["CleanJetGT30_phi_2"] = take_pair(jet_phi[selection], j1_idx, j2_idx)
+    columns["FS_mjj"]     = dijet["mjj"]
+    columns["FS_detajj"]  = abs(dijet["j1_eta"] - dijet["j2_eta"])
+    columns["FS_j1index"] = j1_idx
+    columns["FS_j2index"] = j2_idx
+    return columns
+
+  if jet_mode == "pass":
+    print("debug jet mode, only filling nCleanJetGT30")
+
+  elif jet_mode == "Inclusive":
+    pass
+ 
+  elif jet_mode == "0j":
+    event_dictionary = store_selection(event_dictionary, "pass_0j_cuts", np.flatnonzero(nPassingJets == 0))
+
+  elif jet_mode == "1j":
+    pass_1j = (nPassingJets == 1)
+    event_dictionary = store_selection(event_dictionary, "pass_1j_cuts", np.flatnonzero(pass_1j), {
+      "CleanJetGT30_pt_1"  : jet_pt[pass_1j, 0],
+      "CleanJetGT30_eta_1" : jet_eta[pass_1j, 0],
+      "CleanJetGT30_phi_1" : jet_phi[pass_1j, 0],
+    })
+
+  elif jet_mode == "2j":
+    pass_2j = (nPassingJets == 2)
+    columns = dijet_columns(pass_2j)
+    event_dictionary = store_selection(event_dictionary, "pass_2j_cuts", np.flatnonzero(pass_2j),
+      {key : columns[key] for key in ["CleanJetGT30_pt_1", "CleanJetGT30_phi_1", "CleanJetGT30_eta_1",
+                                      "CleanJetGT30_pt_2", "CleanJetGT30_eta_2", "CleanJetGT30_phi_2", "FS_mjj", "FS_detajj"]})
+
+  elif jet_mode == "3j" or jet_mode == "GTE2j":
+    # importantly different from inclusive
+    # as before, "3j" fills empty branches since only GTE2j events are selected
+    pass_GTE2j = (nPassingJets >= 2) & (jet_mode == "GTE2j")
+    columns = dijet_columns(pass_GTE2j)
+    event_dictionary = store_selection(event_dictionary, "pass_GTE2j_cuts", np.flatnonzero(pass_GTE2j),
+      {key : columns[key] for key in ["CleanJetGT30_pt_1", "CleanJetGT30_pt_2", "CleanJetGT30_eta_1", "CleanJetGT30_eta_2",
+                                      "CleanJetGT30_phi_1", "CleanJetGT30_phi_2", "FS_mjj", "FS_detajj",
+                                      "FS_j1index", "FS_j2index"]})
+
+  elif jet_mode == "GTE1j":
+    pass_GTE1j = (nPassingJets >= 1)
+    # events with one jet keep that jet as the leading jet and fill the rest with -1
+    has_pair = (nPassingJets[pass_GTE1j] >= 2)
+    columns = dijet_columns(pass_GTE1j & (nPassingJets >= 2))
+    selected_columns = {}
+    for var, padded in [("pt", jet_pt), ("eta", jet_eta), ("phi", jet_phi)]:
+      leading, subleading = padded[pass_GTE1j, 0].astype(np.float64), np.full(len(has_pair), -1.)
+      leading[has_pair]    = columns[f"CleanJetGT30_{var}_1"]
+      subleading[has_pair] = columns[f"CleanJetGT30_{var}_2"]
+      selected_columns[f"CleanJetGT30_{var}_1"] = leading
+      selected_columns[f"CleanJetGT30_{var}_2"] = subleading
+    for key in ["FS_mjj", "FS_detajj"]:
+      filled = np.full(len(has_pair), -1.)
+      filled[has_pair] = columns[key]
+      selected_columns[key] = filled
+    event_dictionary = store_selection(event_dictionary, "pass_GTE1j_cuts", np.flatnonzero(pass_GTE1j), selected_columns)
+
+  return event_dictionary
+
+
+def make_jet_cut_rowscan(event_dictionary, jet_mode):
+  '''
+  Original event-by-event jet selection using ROOT TLorentzVectors.
+  Slow, kept to validate make_jet_cut.
+  '''
   nEvents_precut = len(event_dictionary["Lepton_pt"])
   unpack_jetVars = ["nCleanJet", "CleanJet_pt", "CleanJet_eta", "CleanJet_phi", "CleanJet_mass", 
                     #"HTT_DiJet_j1index", "HTT_DiJet_j2index",]
@@ -291,6 +475,9 @@ def apply_cut(event_dictionary, cut_branch, protected_branches=[]):
 
   If all events are removed by cut, print a message to alert the user.
   The deletion is actually handled in the main body when the size of the dictionary is checked.
+  An EventTable knows which branches already pass the cut (the ones added with store_selection, see its docstring),
+  so 'protected_branches' is only used for plain dictionaries, and the np.take of each branch is deferred
+  until the branch is read.
   '''
   delete_sample = False
   if len(event_dictionary[cut_branch]) == 0:
@@ -300,18 +487,44 @@ def apply_cut(event_dictionary, cut_branch, protected_branches=[]):
  
   if DEBUG: print(f"cut branch: {cut_branch}")
   if DEBUG: print(f"protected branches: {protected_branches}")
+  if isinstance(event_dictionary, EventTable):
+    # the cut is only recorded, each aligned branch is taken when it is next read
+    return event_dictionary.apply_selection(cut_branch)
+
   for branch in event_dictionary:
     if delete_sample:
       pass
 
     if ((branch != cut_branch) and (branch not in protected_branches)):
       if DEBUG: print(f"{len(event_dictionary[branch])} \t\t = pre cut len({branch})")
-      event_dictionary[branch] = np.take(event_dictionary[branch], event_dictionary[cut_branch])
+      event_dictionary[branch] = take_rows(event_dictionary[branch], event_dictionary[cut_branch])
       if DEBUG: print(f"{len(event_dictionary[branch])} \t\t = post cut len({branch})")
 
   return event_dictionary
 
 
+def split_DY_by_gen(event_dictionary):
+  '''
+  Split DY events by gen flavor (the "G", "L", "J" event_flavor_codes) into three event dictionaries.
+  Same result as deep copying 'event_dictionary' three times and calling apply_cut on each copy
+  with a "pass_flavor_cut" branch, but the flavor masks are made with one comparison each and
+  apply_cut runs on shallow copies of an EventTable: nothing is deep copied, and each branch
+  is only taken from the shared values when it is read.
+  Returns [gen, lep, jet], or None if any of them has no events (in which case nothing should be added).
+  '''
+  if not isinstance(event_dictionary, EventTable): # e.g. cut events loaded from the skim cache
+    event_dictionary = EventTable(event_dictionary, event_count(event_dictionary))
+  event_flavor = np.asarray(event_dictionary["event_flavor"])
+  DY_splits = []
+  for flavor in ["G", "L", "J"]:
+    DY_split = copy.copy(event_dictionary)
+    DY_split = store_selection(DY_split, "pass_flavor_cut", np.flatnonzero(event_flavor == event_flavor_codes[flavor]))
+    DY_split = apply_cut(DY_split, "pass_flavor_cut")
+    if DY_split == None: return None
+    DY_splits.append(DY_split)
+  return DY_splits
+
+
 def make_run_cut(event_dictionary, good_runs):
   '''
   Given a set of runs, create a branch of events belonging to that set.
@@ -327,7 +540,7 @@ def make_run_cut(event_dictionary, good_runs):
       if run in good_runs:
         pass_run_cut.append(i) 
 
-  event_dictionary["pass_run_cut"] = np.array(pass_run_cut)
+  event_dictionary = store_selection(event_dictionary, "pass_run_cut", np.array(pass_run_cut, dtype=np.int64))
   return event_dictionary
 
 
@@ -336,35 +549,33 @@ def apply_final_state_cut(era, event_dictionary, final_state_mode, DeepTau_versi
   Organizational function that generalizes call to a (set of) cuts based on the
   final cut. Importantly, the function that rejects events, 'apply_cut',
   is called elsewhere
+  'event_dictionary' is an EventTable (see apply_HTT_FS_cuts_to_process), so no branches need protecting
   '''
-  # setting inclusive in the jet_mode includes all jet branches in protected branches
-  # this is okay because in the current ordering (FS cut then jet cut), no jet branches are ever created yet.
-  protected_branches = set_protected_branches(final_state_mode=final_state_mode, jet_mode="Inclusive")
   skip_DeepTau = False
   if final_state_mode == "ditau":
     event_dictionary = make_ditau_SR_cut(event_dictionary, DeepTau_version)
-    event_dictionary = apply_cut(event_dictionary, "pass_SR_cuts", protected_branches)
+    event_dictionary = apply_cut(event_dictionary, "pass_SR_cuts")
     if (event_dictionary == None): return event_dictionary
     event_dictionary = make_ditau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau, tau_pt_cut)
-    event_dictionary = apply_cut(event_dictionary, "pass_cuts", protected_branches)
+    event_dictionary = apply_cut(event_dictionary, "pass_cuts")
   elif final_state_mode == "mutau":
     event_dictionary = make_mutau_SR_cut(event_dictionary, DeepTau_version)
-    event_dictionary = apply_cut(event_dictionary, "pass_SR_cuts", protected_branches)
+    event_dictionary = apply_cut(event_dictionary, "pass_SR_cuts")
     if (event_dictionary == None): return event_dictionary
     event_dictionary = make_mutau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau, tau_pt_cut)
-    event_dictionary = apply_cut(event_dictionary, "pass_cuts", protected_branches)
+    event_dictionary = apply_cut(event_dictionary, "pass_cuts")
   elif final_state_mode == "etau":
     event_dictionary = make_etau_SR_cut(event_dictionary, DeepTau_version)
-    event_dictionary = apply_cut(event_dictionary, "pass_SR_cuts", protected_branches)
+    event_dictionary = apply_cut(event_dictionary, "pass_SR_cuts")
     if (event_dictionary == None): return event_dictionary
     event_dictionary = make_etau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau, tau_pt_cut)
-    event_dictionary = apply_cut(event_dictionary, "pass_cuts", protected_branches)
+    event_dictionary = apply_cut(event_dictionary, "pass_cuts")
   elif final_state_mode == "emu":
     event_dictionary = make_emu_SR_cut(event_dictionary)
-    event_dictionary = apply_cut(event_dictionary, "pass_SR_cuts", protected_branches)
+    event_dictionary = apply_cut(event_dictionary, "pass_SR_cuts")
     if (event_dictionary == None): return event_dictionary
     event_dictionary = make_emu_cut(era, event_dictionary)
-    event_dictionary = apply_cut(event_dictionary, "pass_cuts", protected_branches)
+    event_dictionary = apply_cut(event_dictionary, "pass_cuts")
   else:
     print(f"No cuts to apply for {final_state_mode} final state.")
   return event_dictionary
@@ -395,6 +606,7 @@ def apply_jet_cut(event_dictionary, jet_mode):
     "GTE2j" : "pass_GTE2j_cuts",
   }
   event_dictionary   = make_jet_cut(event_dictionary, jet_mode)
+  # only used for plain dictionaries (FF_plot_set scripts), an EventTable needs no protected branches
   protected_branches = set_protected_branches(final_state_mode="none", jet_mode=jet_mode)
   if jet_mode == "Inclusive" or jet_mode == "pass":
     print("jet mode is Inclusive, no jet cut performed")
@@ -417,9 +629,11 @@ def apply_HTT_FS_cuts_to_process(era, process, process_dictionary, log_file,
   if len(process_events["run"])==0: 
     print(f"Uh oh, no events in sample.")
     return None
+  # branches to cut are known from how the cut functions add them, cuts are composed,
+  # and each branch is only copied when it is read (see EventTable)
+  process_events = EventTable(process_events, event_count(process_events))
 
   process_events = append_lepton_indices(process_events)
-  protected_branches = ["FS_t1_flav", "FS_t2_flav", "pass_gen_cuts", "event_flavor"]
 
   if ("Data" not in process) and (final_state_mode != "dimuon"):
     if ("TTToSemiLeptonic" in process): process = "TTToSemiLeptonic"
@@ -438,7 +652,7 @@ def apply_HTT_FS_cuts_to_process(era, process, process_dictionary, log_file,
     #print("KEEPING ALL FAKES!") #DEBUG
     if (final_state_mode != "emu"):
       process_events = append_flavor_indices(process_events, final_state_mode, keep_fakes=keep_fakes)
-      process_events = apply_cut(process_events, "pass_gen_cuts", protected_branches=protected_branches)
+      process_events = apply_cut(process_events, "pass_gen_cuts")
     if (process_events==None or len(process_events["run"])==0): return None
 
   FS_cut_events = apply_final_state_cut(era, process_events, final_state_mode, DeepTau_version, tau_pt_cut, useMiniIso=useMiniIso)
@@ -461,6 +675,7 @@ def set_protected_branches(final_state_mode, jet_mode, DeepTau_version="none"):
   '''
   Set branches to be protected (i.e. not cut on) when using "apply_cut."
   Generally, you should protect any branches introduced by a cut.
+  Only needed for plain dictionaries, an EventTable tracks this itself.
 
   protect all "FS" branches for FS cuts
   protect all "pass_xj_cuts" and "JetGT30_" branches for jet cuts
@@ -523,7 +738,7 @@ def apply_AR_cut(era, process, event_dictionary, final_state_mode, jet_mode, sem
   The block below for gen matching normally is not executed since this function is only called with Data
   in standard plot
   '''
-  protected_branches = ["None"]
+  event_dictionary = EventTable(event_dictionary, event_count(event_dictionary)) # see apply_HTT_FS_cuts_to_process
   event_dictionary = append_lepton_indices(event_dictionary)
   if ("Data" not in process) and (final_state_mode != "dimuon"):
     load_and_store_NWEvents(process, event_dictionary)
@@ -538,41 +753,31 @@ def apply_AR_cut(era, process, event_dictionary, final_state_mode, jet_mode, sem
     if ((("TT" in process) or ("WJ" in process) or ("DY" in process)) and (final_state_mode=="emu")):
       keep_fakes = True
     process_events = append_flavor_indices(process_events, final_state_mode, keep_fakes=keep_fakes)
-    process_events = apply_cut(process_events, "pass_gen_cuts", protected_branches=protected_branches)
+    process_events = apply_cut(process_events, "pass_gen_cuts")
     if (process_events==None or len(process_events["run"])==0): return None
   if (final_state_mode != "dimuon"):
     skip_DeepTau = True
+    AR_region = "AR"
     if (final_state_mode == "ditau"):
       method = "NEW"
       print("WHICH METHOD DO YOU WANT TO BE USING?????")
       print(f"CURRENTLY USING: {method} METHOD")
-      if (method == "OLD"):
-        event_dictionary = make_ditau_AR_cut(event_dictionary, DeepTau_version)
-        cut_string = "pass_AR_cuts"
-      elif (method == "NEW"):
-        event_dictionary = make_ditau_AR_star_cut(event_dictionary, DeepTau_version)
-        cut_string = "pass_AR_star_cuts"
+      if (method == "OLD"):   AR_region = "AR"
+      elif (method == "NEW"): AR_region = "AR_star"
       else: print(f"METHOD NOT SET! METHOD IS: {method}     CRASHING!!!")
-      event_dictionary = apply_cut(event_dictionary, cut_string, protected_branches)
-      event_dictionary = apply_jet_cut(event_dictionary, jet_mode)
+    # selected from the packed region flags (see FF_functions.FF_control_flow)
+    event_dictionary = FF_control_flow(final_state_mode, semilep_mode, AR_region, event_dictionary, DeepTau_version)
+    event_dictionary = apply_cut(event_dictionary, "pass_"+AR_region+"_cuts")
+    event_dictionary = apply_jet_cut(event_dictionary, jet_mode)
+    if (final_state_mode == "ditau"):
       event_dictionary = make_ditau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau, tau_pt_cut)
     if (final_state_mode == "mutau"):
-      event_dictionary = make_mutau_AR_cut(event_dictionary, DeepTau_version)
-      event_dictionary = apply_cut(event_dictionary, "pass_AR_cuts", protected_branches)
-      event_dictionary = apply_jet_cut(event_dictionary, jet_mode)
       event_dictionary = make_mutau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau, tau_pt_cut)
     if (final_state_mode == "etau"):
-      event_dictionary = make_etau_AR_cut(event_dictionary, DeepTau_version)
-      event_dictionary = apply_cut(event_dictionary, "pass_AR_cuts", protected_branches)
-      event_dictionary = apply_jet_cut(event_dictionary, jet_mode)
       event_dictionary = make_etau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau, tau_pt_cut)
     if (final_state_mode == "emu"):
-      event_dictionary = make_emu_AR_cut(event_dictionary, iso_region_el=True, iso_region_mu=True)
-      event_dictionary = apply_cut(event_dictionary, "pass_AR_cuts", protected_branches)
-      event_dictionary = apply_jet_cut(event_dictionary, jet_mode)
       event_dictionary = make_emu_cut(era, event_dictionary)
-    protected_branches = set_protected_branches(final_state_mode=final_state_mode, jet_mode="none")
-    event_dictionary   = apply_cut(event_dictionary, "pass_cuts", protected_branches)
+    event_dictionary   = apply_cut(event_dictionary, "pass_cuts")
     # weights associated with jet_mode key (testing suffix automatically removed)
     if (final_state_mode in ["etau", "emu"]):
       event_dictionary = add_FF_weight_from_branch(event_dictionary, final_state_mode, process)
@@ -1,8 +1,56 @@
 import numpy as np
 
+from columnar_functions import gather_pair, jagged_content, store_selection
+
 def make_dimuon_cut(event_dictionary, useMiniIso=False):
   '''
   Works similarly to 'make_ditau_cut'. 
+  Both muons are gathered for all events at once and the selection is a boolean mask.
+  Outputs are identical to make_dimuon_cut_rowscan, which is kept to validate this function.
+  '''
+  nEvents_precut = len(event_dictionary["Lepton_pt"])
+  l1_idx, l2_idx = event_dictionary["l1_indices"], event_dictionary["l2_indices"]
+  m1_pt,  m2_pt  = gather_pair(event_dictionary["Lepton_pt"],  l1_idx, l2_idx)
+  m1_iso, m2_iso = gather_pair(event_dictionary["Lepton_iso"], l1_idx, l2_idx)
+  mvis = np.asarray(event_dictionary["HTT_m_vis"])
+  # removed (dR > 0.5) and changed (mvis > 20) cut. Our minimum dR is 0.3 from skim level
+  passKinematics = (m1_pt > 26) & (m2_pt > 20) & (70 < mvis) & (mvis < 130)
+  iso_cut = 0.25 # for PFRelIso, Loose 25, Medium 20, Tight 15
+  if (useMiniIso == True): iso_cut = 0.40 # for MiniIso, Loose 40, Medium 20, Tight 10
+  passIso = (m1_iso < iso_cut) & (m2_iso < iso_cut)
+  pass_mask = passKinematics & passIso
+
+  l1_idx, l2_idx = np.asarray(l1_idx)[pass_mask], np.asarray(l2_idx)[pass_mask]
+  passing_events = {branch : event_dictionary[branch][pass_mask]
+                    for branch in ["Lepton_eta", "Lepton_phi", "Lepton_muIdx", "Muon_dxy", "Muon_dz"]}
+  m1_muIdx, m2_muIdx = gather_pair(passing_events["Lepton_muIdx"], l1_idx, l2_idx)
+  m1_eta, m2_eta = gather_pair(passing_events["Lepton_eta"], l1_idx, l2_idx)
+  m1_phi, m2_phi = gather_pair(passing_events["Lepton_phi"], l1_idx, l2_idx)
+  m1_dxy, m2_dxy = gather_pair(passing_events["Muon_dxy"], m1_muIdx, m2_muIdx)
+  m1_dz,  m2_dz  = gather_pair(passing_events["Muon_dz"],  m1_muIdx, m2_muIdx)
+
+  pass_cuts = np.flatnonzero(pass_mask)
+  event_dictionary = store_selection(event_dictionary, "pass_cuts", pass_cuts, {
+    "FS_m1_pt"  : m1_pt[pass_mask],
+    "FS_m1_eta" : m1_eta,
+    "FS_m1_phi" : m1_phi,
+    "FS_m1_iso" : m1_iso[pass_mask],
+    "FS_m1_dxy" : abs(m1_dxy),
+    "FS_m1_dz"  : m1_dz,
+    "FS_m2_pt"  : m2_pt[pass_mask],
+    "FS_m2_eta" : m2_eta,
+    "FS_m2_phi" : m2_phi,
+    "FS_m2_iso" : m2_iso[pass_mask],
+    "FS_m2_dxy" : abs(m2_dxy),
+    "FS_m2_dz"  : m2_dz,
+  })
+  print(f"events before and after dimuon cuts = {nEvents_precut}, {len(pass_cuts)}")
+  return event_dictionary
+
+
+def make_dimuon_cut_rowscan(event_dictionary, useMiniIso=False):
+  '''
+  Original event-by-event version of make_dimuon_cut, kept to validate the columnar version.
   '''
   nEvents_precut = len(event_dictionary["Lepton_pt"])
   unpack_dimuon = ["Lepton_pt", "Lepton_eta", "Lepton_phi", "Lepton_iso", 
@@ -52,7 +100,27 @@ def make_dimuon_cut(event_dictionary, useMiniIso=False):
   print(f"events before and after dimuon cuts = {nEvents_precut}, {len(np.array(pass_cuts))}")
   return event_dictionary
 
+def dimuon_region_predicates(event_dictionary, DeepTau_version=None):
+  ''' the pair sign is the only dimuon region quantity, DeepTau_version is unused '''
+  return {"pair_sign" : np.sign(event_dictionary["HTT_pdgId"])}
+
+
+def dimuon_region_mask(region_predicates, FS_pair_sign):
+  ''' boolean mask of events in one dimuon region, arguments are the same as make_dimuon_region '''
+  return (region_predicates["pair_sign"] == FS_pair_sign)
+
+
 def make_dimuon_region(event_dictionary, new_branch_name, FS_pair_sign):
+  ''' Store the indices of events in the region as 'new_branch_name', identical to make_dimuon_region_rowscan '''
+  region_mask = dimuon_region_mask(dimuon_region_predicates(event_dictionary), FS_pair_sign)
+  event_dictionary = store_selection(event_dictionary, new_branch_name, np.flatnonzero(region_mask))
+  return event_dictionary
+
+
+def make_dimuon_region_rowscan(event_dictionary, new_branch_name, FS_pair_sign):
+  '''
+  Original event-by-event version of make_dimuon_region, kept to validate the columnar version.
+  '''
   unpack_dimuon_vars = ["l1_indices", "l2_indices", "HTT_pdgId"]
   unpack_dimuon_vars = (event_dictionary.get(key) for key in unpack_dimuon_vars)
   to_check = [range(len(event_dictionary["Lepton_pt"])), *unpack_dimuon_vars]
@@ -71,6 +139,26 @@ def manual_dimuon_lepton_veto(event_dictionary):
   Works similarly to 'make_ditau_cut' except the branch "pass_manual_lepton_veto"
   is made specifically for the dimuon final state. Some special handling is required
   due to the way events are selected in step2 of the NanoTauFramework
+  Events pass if they have at least one lepton, no isolated electrons, and at most two isolated muons
+  (there are many pdgId=15 particles, but we assume those are fake taus).
+  Outputs are identical to manual_dimuon_lepton_veto_rowscan.
+  '''
+  nEvents_precut = len(event_dictionary["Lepton_pt"])
+  pdgId, nLeptons = jagged_content(event_dictionary["Lepton_pdgId"])
+  iso, _          = jagged_content(event_dictionary["Lepton_iso"])
+  event_index = np.repeat(np.arange(nEvents_precut), nLeptons)
+  nIsoEle = np.bincount(event_index[(abs(pdgId) == 11) & (iso < 0.3)], minlength=nEvents_precut)
+  nIsoMu  = np.bincount(event_index[(abs(pdgId) == 13) & (iso < 0.3)], minlength=nEvents_precut)
+  pass_manual_lepton_veto = np.flatnonzero((nLeptons > 0) & (nIsoEle == 0) & (nIsoMu <= 2))
+
+  event_dictionary = store_selection(event_dictionary, "pass_manual_lepton_veto", pass_manual_lepton_veto)
+  print(f"events before and after manual dimuon lepton veto = {nEvents_precut}, {len(pass_manual_lepton_veto)}")
+  return event_dictionary
+
+
+def manual_dimuon_lepton_veto_rowscan(event_dictionary):
+  '''
+  Original event-by-event version of manual_dimuon_lepton_veto, kept to validate the columnar version.
   '''
   nEvents_precut = len(event_dictionary["Lepton_pt"])
   unpack_veto = ["Lepton_pdgId", "Lepton_iso"]
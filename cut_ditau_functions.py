@@ -2,9 +2,132 @@ import numpy as np
 
 from calculate_functions import calculate_acoplan, return_TLorentz_Jets, calculate_mt, phi_mpi_pi
 from branch_functions import add_trigger_branches, add_DeepTau_branches
+from columnar_functions import gather_pair, get_event_jet_kinematics, encode_single_decayMode
+from columnar_functions import calculate_mt_array, calculate_dphi_array, store_selection
 
 def make_ditau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau=True, tau_pt_cut="None"):
   '''
+  Columnar version of the ditau selection. Every quantity is computed for all events at once
+  by gathering the two tau legs from the jagged branches (see columnar_functions).
+  Outputs are identical to make_ditau_cut_rowscan, which is kept to validate this function
+  (see compare_cut_implementations.py).
+  '''
+  nEvents_precut = len(event_dictionary["Lepton_pt"])
+  l1_idx, l2_idx = event_dictionary["l1_indices"], event_dictionary["l2_indices"]
+  t1_pt,  t2_pt  = gather_pair(event_dictionary["Lepton_pt"],  l1_idx, l2_idx)
+  t1_eta, t2_eta = gather_pair(event_dictionary["Lepton_eta"], l1_idx, l2_idx)
+  t1_phi, t2_phi = gather_pair(event_dictionary["Lepton_phi"], l1_idx, l2_idx)
+  t1_mass, t2_mass = gather_pair(event_dictionary["Lepton_mass"], l1_idx, l2_idx)
+  t1_br_idx, t2_br_idx = gather_pair(event_dictionary["Lepton_tauIdx"], l1_idx, l2_idx)
+  MET_pt, MET_phi = event_dictionary["PuppiMET_pt"], event_dictionary["PuppiMET_phi"]
+
+  tau_vars = {}
+  for branch in ["Tau_dxy", "Tau_dz", "Tau_decayMode", "Tau_charge",
+                 "Tau_rawPNetVSjet", "Tau_rawPNetVSmu", "Tau_rawPNetVSe"]:
+    tau_vars[branch] = gather_pair(event_dictionary[branch], t1_br_idx, t2_br_idx)
+  vJet_branch, vMu_branch, vEle_branch = add_DeepTau_branches([], DeepTau_version)
+  for branch in [vJet_branch, vMu_branch, vEle_branch]:
+    tau_vars[branch] = gather_pair(event_dictionary[branch], t1_br_idx, t2_br_idx)
+
+  nJet = event_dictionary["nCleanJet"]
+  jets = get_event_jet_kinematics(nJet, event_dictionary["CleanJet_pt"], event_dictionary["CleanJet_eta"],
+                                  event_dictionary["CleanJet_phi"], event_dictionary["CleanJet_mass"])
+
+  trigger_branches = add_trigger_branches([], era, final_state_mode="ditau")
+  triggers = [event_dictionary[trigger] for trigger in trigger_branches]
+  # force triggers to always be the right length, even in eras where a trigger isn't available
+  if (len(triggers) == 3): triggers.append(np.zeros(nEvents_precut, dtype=bool))
+  trig_results = pass_kinems_by_trigger_array(triggers, t1_pt, t2_pt, t1_eta, t2_eta,
+                                              jets["j1_pt"], jets["j1_eta"], jets["j2_pt"], jets["j2_eta"], jets["mjj"], nJet)
+  # trig_results = [DiTau, DiTau+Jet, VBFRun3, VBFSingleTau], same era vetoes as in the rowscan version
+  if ("2022" in era): trig_results = np.logical_and(trig_results, [1, 1, 1, 0])
+  if ("2023" in era): trig_results = np.logical_and(trig_results, [1, 1, 0, 1])
+  passKinems = np.any(trig_results, axis=1)
+  trig_idx   = np.where(passKinems, np.argmax(trig_results, axis=1), -1)
+
+  t1_decayMode, t2_decayMode = tau_vars["Tau_decayMode"]
+  encoded_t1_decayMode = encode_single_decayMode(t1_decayMode)
+  encoded_t2_decayMode = encode_single_decayMode(t2_decayMode)
+  encoded_pair_decayMode = 4*encoded_t2_decayMode + encoded_t1_decayMode # same as pair_DM_encoder
+
+  # derived variables
+  mt_t1t2   = calculate_mt_array(t1_pt, t1_phi, t2_pt, t2_phi)
+  mt_t1_MET = calculate_mt_array(t1_pt, t1_phi, MET_pt, MET_phi)
+  mt_t2_MET = calculate_mt_array(t2_pt, t2_phi, MET_pt, MET_phi)
+  mt_TOT    = np.sqrt(mt_t1t2 + mt_t1_MET + mt_t2_MET)
+
+  # no selection is applied at this stage, see the rowscan version for the previous requirements
+  pass_cuts = np.arange(nEvents_precut)
+
+  event_dictionary = store_selection(event_dictionary, "pass_cuts", pass_cuts)
+  for leg, (pt, eta, phi, mass, leg_idx) in {"t1" : (t1_pt, t1_eta, t1_phi, t1_mass, 0),
+                                            "t2" : (t2_pt, t2_eta, t2_phi, t2_mass, 1)}.items():
+    event_dictionary[f"FS_{leg}_pt"]  = pt
+    event_dictionary[f"FS_{leg}_eta"] = eta
+    event_dictionary[f"FS_{leg}_phi"] = phi
+    event_dictionary[f"FS_{leg}_dxy"] = abs(tau_vars["Tau_dxy"][leg_idx])
+    event_dictionary[f"FS_{leg}_dz"]  = abs(tau_vars["Tau_dz"][leg_idx])
+    event_dictionary[f"FS_{leg}_chg"] = tau_vars["Tau_charge"][leg_idx]
+    event_dictionary[f"FS_{leg}_DM"]  = [encoded_t1_decayMode, encoded_t2_decayMode][leg_idx]
+    event_dictionary[f"FS_{leg}_mass"] = mass
+    event_dictionary[f"FS_{leg}_rawPNetVSjet"] = tau_vars["Tau_rawPNetVSjet"][leg_idx]
+    event_dictionary[f"FS_{leg}_rawPNetVSmu"]  = tau_vars["Tau_rawPNetVSmu"][leg_idx]
+    event_dictionary[f"FS_{leg}_rawPNetVSe"]   = tau_vars["Tau_rawPNetVSe"][leg_idx]
+    event_dictionary[f"FS_{leg}_DeepTauVSjet"] = tau_vars[vJet_branch][leg_idx]
+    event_dictionary[f"FS_{leg}_DeepTauVSmu"]  = tau_vars[vMu_branch][leg_idx]
+    event_dictionary[f"FS_{leg}_DeepTauVSe"]   = tau_vars[vEle_branch][leg_idx]
+  event_dictionary["FS_tau_pt"]     = t2_pt.copy() # copy for fitting purposes
+  event_dictionary["FS_trig_idx"]   = trig_idx
+  event_dictionary["FS_mt_t1t2"]    = mt_t1t2
+  event_dictionary["FS_mt_t1_MET"]  = mt_t1_MET
+  event_dictionary["FS_mt_t2_MET"]  = mt_t2_MET
+  event_dictionary["FS_mt_TOT"]     = mt_TOT
+  event_dictionary["FS_dphi_t1t2"]  = calculate_dphi_array(t1_phi, t2_phi)
+  event_dictionary["FS_deta_t1t2"]  = abs(t1_eta - t2_eta)
+  event_dictionary["FS_dpt_t1t2"]   = t1_pt - t2_pt
+  event_dictionary["FS_dphi_t1MET"] = calculate_dphi_array(t1_phi, MET_phi)
+  event_dictionary["FS_dphi_t2MET"] = calculate_dphi_array(t2_phi, MET_phi)
+  event_dictionary["FS_pair_DM"]    = encoded_pair_decayMode
+
+  nEvents_postcut = len(pass_cuts)
+  print(f"nEvents before and after ditau cuts = {nEvents_precut}, {nEvents_postcut}")
+  return event_dictionary
+
+
+def pass_kinems_by_trigger_array(triggers, t1_pt, t2_pt, t1_eta, t2_eta,
+                                 j1_pt, j1_eta, j2_pt, j2_eta, mjj, nJet):
+  '''
+  Array version of pass_kinems_by_trigger, returns a (nEvents, 4) boolean array
+  with columns [DiTau, DiTau+Jet, VBFRun3, VBFSingleTau]
+  '''
+  ditau_trig, ditau_jet_trig, ditau_VBFRun3_trig, singletau_VBF_trig = [np.asarray(trig, dtype=bool) for trig in triggers]
+  nJet = np.asarray(nJet)
+
+  pass_j1 = (j1_pt > 50.) | ((j1_pt > 30) & (abs(j1_eta) < 2.5))
+  pass_j2 = (j2_pt > 50.) | ((j2_pt > 30) & (abs(j2_eta) < 2.5))
+  passEventJetKinems = np.where(nJet == 0, True, np.where(nJet == 1, pass_j1, pass_j1 & pass_j2))
+
+  pass_ditau = ditau_trig & (t1_pt > 40) & (t2_pt > 40) & (abs(t1_eta) < 2.1) & (abs(t2_eta) < 2.1) \
+               & passEventJetKinems
+
+  pass_ditau_jet = ditau_jet_trig & ~ditau_trig \
+                   & (t1_pt > 35) & (t2_pt > 35) & (abs(t1_eta) < 2.1) & (abs(t2_eta) < 2.1) \
+                   & passEventJetKinems & (j1_pt > 65)
+
+  pass_ditau_VBFRun3 = ditau_VBFRun3_trig & ~(ditau_trig | ditau_jet_trig) \
+                       & (t1_pt > 50) & (t2_pt > 25) & (abs(t1_eta) < 2.1) & (abs(t2_eta) < 2.1) \
+                       & passEventJetKinems & (j1_pt > 45) & (j2_pt > 45) & (mjj > 600)
+
+  pass_singletau_VBF = singletau_VBF_trig & ~(ditau_trig | ditau_jet_trig) \
+                       & (t1_pt > 50) & (abs(t1_eta) < 2.1) \
+                       & passEventJetKinems & (j1_pt > 50) & (j2_pt > 50) & (mjj > 600)
+
+  return np.stack([pass_ditau, pass_ditau_jet, pass_ditau_VBFRun3, pass_singletau_VBF], axis=1)
+
+
+def make_ditau_cut_rowscan(era, event_dictionary, DeepTau_version, skip_DeepTau=True, tau_pt_cut="None"):
+  '''
+  Original event-by-event version of make_ditau_cut, kept to validate the columnar version.
   Use a minimal set of branches to define selection criteria and identify events which pass.
   A separate function uses the generated branch "pass_cuts" to remove the info from the
   loaded samples.
@@ -333,9 +456,59 @@ def pass_kinems_by_trigger(triggers, t1_pt, t2_pt, t1_eta, t2_eta,
   return [pass_ditau, pass_ditau_jet, pass_ditau_VBFRun3, pass_singletau_VBF]
 
 
+def ditau_region_predicates(event_dictionary, DeepTau_version):
+  '''
+  Per-event quantities used by the ditau region definitions, computed once so that
+  several regions can be evaluated with ditau_region_mask without another pass over the events
+  '''
+  vJet_branch = add_DeepTau_branches([], DeepTau_version)[0]
+  t1_tauIdx, t2_tauIdx = gather_pair(event_dictionary["Lepton_tauIdx"],
+                                     event_dictionary["l1_indices"], event_dictionary["l2_indices"])
+  t1_vJet, t2_vJet = gather_pair(event_dictionary[vJet_branch], t1_tauIdx, t2_tauIdx)
+  region_predicates = {
+    "pair_sign" : np.sign(event_dictionary["HTT_pdgId"]),
+    "t1_vJet"   : t1_vJet,
+    "t2_vJet"   : t2_vJet,
+  }
+  return region_predicates
+
+
+def ditau_region_mask(region_predicates, FS_pair_sign,
+                      pass_DeepTau_t1_req, DeepTau_t1_value,
+                      pass_DeepTau_t2_req, DeepTau_t2_value, DeepTau_version):
+  ''' boolean mask of events in one ditau region, arguments are the same as make_ditau_region '''
+  pass_sign = (region_predicates["pair_sign"] == FS_pair_sign)
+  pass_DeepTau_t1 = (region_predicates["t1_vJet"] >= DeepTau_t1_value)
+  pass_DeepTau_t2 = (region_predicates["t2_vJet"] >= DeepTau_t2_value)
+  if (pass_DeepTau_t1_req == "None") or (pass_DeepTau_t2_req == "None"):
+    return pass_sign & ~(pass_DeepTau_t1 & pass_DeepTau_t2) # skip SR and DRsr events
+  pass_DeepTau_t1_minimum = (region_predicates["t1_vJet"] >= 1) # 1 is VVVLoose (AN 109, 2p1DeepTau), 2 is VVLoose
+  pass_DeepTau_t2_minimum = (region_predicates["t2_vJet"] >= 1)
+  return ( pass_sign & pass_DeepTau_t1_minimum & pass_DeepTau_t2_minimum &
+           (pass_DeepTau_t1 == pass_DeepTau_t1_req) & (pass_DeepTau_t2 == pass_DeepTau_t2_req) )
+
+
 def make_ditau_region(event_dictionary, new_branch_name, FS_pair_sign,
                       pass_DeepTau_t1_req, DeepTau_t1_value,
                       pass_DeepTau_t2_req, DeepTau_t2_value, DeepTau_version):
+  '''
+  Store the indices of events in the region as 'new_branch_name'.
+  Identical to make_ditau_region_rowscan. To fill several regions at once use FF_functions.make_FF_region_flags
+  '''
+  region_predicates = ditau_region_predicates(event_dictionary, DeepTau_version)
+  region_mask = ditau_region_mask(region_predicates, FS_pair_sign,
+                                  pass_DeepTau_t1_req, DeepTau_t1_value,
+                                  pass_DeepTau_t2_req, DeepTau_t2_value, DeepTau_version)
+  event_dictionary = store_selection(event_dictionary, new_branch_name, np.flatnonzero(region_mask))
+  return event_dictionary
+
+
+def make_ditau_region_rowscan(event_dictionary, new_branch_name, FS_pair_sign,
+                      pass_DeepTau_t1_req, DeepTau_t1_value,
+                      pass_DeepTau_t2_req, DeepTau_t2_value, DeepTau_version):
+  '''
+  Original event-by-event version of make_ditau_region, kept to validate the columnar version.
+  '''
   DEBUG = False # make print statements visible by setting this to True
   unpack_ditau_vars = ["Lepton_tauIdx", "l1_indices", "l2_indices", "HTT_pdgId"]
   unpack_ditau_vars = add_DeepTau_branches(unpack_ditau_vars, DeepTau_version)
@@ -1,12 +1,84 @@
 import numpy as np
 
-from ROOT import TLorentzVector
-
-from calculate_functions import calculate_mt_emu 
 from branch_functions import add_trigger_branches
+from columnar_functions import gather, count_per_event, store_selection
+
+emu_DZeta_value = -30 # every emu region requires HTT_DZeta above this
 
 def make_emu_cut(era, event_dictionary):
   '''
+  Works similarly to 'make_mutau_cut'.
+  The electron and muon can be either lepton in the FS pair, so their positions are
+  found for all events first and then used to gather the lepton quantities.
+  Outputs are identical to make_emu_cut_rowscan, which is kept to validate this function.
+  '''
+  nEvents_precut = len(event_dictionary["Lepton_pt"])
+  l1_idx, l2_idx = event_dictionary["l1_indices"], event_dictionary["l2_indices"]
+  el_idx, mu_idx = event_dictionary["Lepton_elIdx"], event_dictionary["Lepton_muIdx"]
+  el_is_l1 = (gather(el_idx, l1_idx) != -1) & (gather(mu_idx, l2_idx) != -1)
+  el_is_l2 = (gather(el_idx, l2_idx) != -1) & (gather(mu_idx, l1_idx) != -1) & ~el_is_l1
+  unassigned = ~(el_is_l1 | el_is_l2)
+  if np.any(unassigned): print(f"Should not print :) {np.count_nonzero(unassigned)} events without an electron-muon pair")
+
+  elFSLoc = np.where(el_is_l1, l1_idx, l2_idx)
+  muFSLoc = np.where(el_is_l1, l2_idx, l1_idx)
+  elBranchLoc = gather(el_idx, elFSLoc)
+  muBranchLoc = gather(mu_idx, muFSLoc)
+
+  muPtVal  = gather(event_dictionary["Lepton_pt"],  muFSLoc)
+  muEtaVal = gather(event_dictionary["Lepton_eta"], muFSLoc)
+  elPtVal  = gather(event_dictionary["Lepton_pt"],  elFSLoc)
+  elEtaVal = gather(event_dictionary["Lepton_eta"], elFSLoc)
+
+  crosstrg_1, crosstrg_2 = [np.asarray(event_dictionary[trigger], dtype=bool)
+                            for trigger in add_trigger_branches([], era, final_state_mode="emu")]
+  #HLT_Mu23_TrkIsoVVL_Ele12_CaloIdL_TrackIdL_IsoVL_DZ
+  passCrossTrigger_1 = crosstrg_1 & (muPtVal > 23.0) & (abs(muEtaVal) < 2.4) & (elPtVal > 12.0) & (abs(elEtaVal) < 2.5)
+  #HLT_Mu8_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ
+  passCrossTrigger_2 = crosstrg_2 & (muPtVal > 8.0)  & (abs(muEtaVal) < 2.4) & (elPtVal > 23.0) & (abs(elEtaVal) < 2.5)
+
+  dzeta = np.asarray(event_dictionary["HTT_DZeta"])
+  passDZeta = (dzeta > emu_DZeta_value)
+  #passMT = (event_dictionary["HTT_mT_l1l2met"] < 60)
+
+  pass_mask = (passCrossTrigger_1 | passCrossTrigger_2) & passDZeta & ~unassigned
+  pass_cuts = np.flatnonzero(pass_mask)
+  elFSLoc, muFSLoc = elFSLoc[pass_mask], muFSLoc[pass_mask]
+  elBranchLoc, muBranchLoc = elBranchLoc[pass_mask], muBranchLoc[pass_mask]
+  passing_events = {branch : event_dictionary[branch][pass_mask]
+                    for branch in ["Lepton_phi", "Lepton_iso", "Electron_dxy", "Electron_dz", "Electron_charge",
+                                   "Muon_dxy", "Muon_dz", "Muon_charge", "CleanJet_btagWP"]}
+
+  event_dictionary = store_selection(event_dictionary, "pass_cuts", pass_cuts, {
+    "FS_el_pt"  : elPtVal[pass_mask],
+    "FS_el_eta" : elEtaVal[pass_mask],
+    "FS_el_phi" : gather(passing_events["Lepton_phi"], elFSLoc),
+    "FS_el_iso" : gather(passing_events["Lepton_iso"], elFSLoc),
+    "FS_el_dxy" : abs(gather(passing_events["Electron_dxy"], elBranchLoc)),
+    "FS_el_dz"  : abs(gather(passing_events["Electron_dz"],  elBranchLoc)),
+    "FS_el_chg" : gather(passing_events["Electron_charge"], elBranchLoc),
+    "FS_mu_pt"  : muPtVal[pass_mask],
+    "FS_mu_eta" : muEtaVal[pass_mask],
+    "FS_mu_phi" : gather(passing_events["Lepton_phi"], muFSLoc),
+    "FS_mu_iso" : gather(passing_events["Lepton_iso"], muFSLoc),
+    "FS_mu_dxy" : abs(gather(passing_events["Muon_dxy"], muBranchLoc)),
+    "FS_mu_dz"  : abs(gather(passing_events["Muon_dz"],  muBranchLoc)),
+    "FS_mu_chg" : gather(passing_events["Muon_charge"], muBranchLoc),
+    "FS_nbJet"  : count_per_event(passing_events["CleanJet_btagWP"], lambda btag: btag > 0),
+    "FS_DZeta"  : dzeta[pass_mask],
+  })
+  #event_dictionary["FS_mt_l1l2"]     = np.asarray(event_dictionary["HTT_mT_l1l2met"])[pass_mask]
+  # no emu transverse mass is stored (neither here nor in the rowscan version), nothing downstream reads one;
+  # calculate_mt_emu from calculate_functions takes arrays if it is needed, but the lepton masses must be loaded first
+
+  nEvents_postcut = len(pass_cuts)
+  print(f"nEvents before and after emu cuts = {nEvents_precut}, {nEvents_postcut}")
+  return event_dictionary
+
+
+def make_emu_cut_rowscan(era, event_dictionary):
+  '''
+  Original event-by-event version of make_emu_cut, kept to validate the columnar version.
   Works similarly to 'make_ditau_cut'.
   Notably, the mutau cuts are more complicated, but it is simple to 
   extend the existing methods as long as one can stomach the line breaks.
@@ -21,7 +93,7 @@ def make_emu_cut(era, event_dictionary):
                 "CleanJet_btagWP", 
                  ]
   
-  unpack_emu = add_trigger_branches(unpack_emu, final_state_mode="emu")
+  unpack_emu = add_trigger_branches(unpack_emu, era, final_state_mode="emu")
   unpack_emu = (event_dictionary.get(key) for key in unpack_emu)
   to_check = [range(len(event_dictionary["Lepton_pt"])), *unpack_emu] # "*" unpacks a tuple
   
@@ -133,11 +205,63 @@ def make_emu_cut(era, event_dictionary):
   return event_dictionary
 
 
-def make_emu_region(event_dictionary, new_branch_name, FS_pair_sign, 
+def emu_region_predicates(event_dictionary, DeepTau_version=None):
+  '''
+  Per-event quantities used by the emu region definitions, computed once so that
+  several regions can be evaluated with emu_region_mask without another pass over the events.
+  DeepTau_version is unused, it is accepted so all final states share the same interface
+  '''
+  l1_idx, l2_idx = np.asarray(event_dictionary["l1_indices"]), np.asarray(event_dictionary["l2_indices"])
+  mu_lep_idx = np.where(gather(event_dictionary["Lepton_muIdx"], l1_idx) != -1, l1_idx, l2_idx)
+  el_lep_idx = np.where(gather(event_dictionary["Lepton_elIdx"], l1_idx) != -1, l1_idx, l2_idx)
+  nBTag = count_per_event(event_dictionary["CleanJet_btagWP"], lambda btag: btag > 0)
+  region_predicates = {
+    "pair_sign" : np.sign(event_dictionary["HTT_pdgId"]),
+    "mu_iso"    : gather(event_dictionary["Lepton_iso"], mu_lep_idx),
+    "el_iso"    : gather(event_dictionary["Lepton_iso"], el_lep_idx),
+    "passDZeta" : (event_dictionary["HTT_DZeta"] > emu_DZeta_value),
+    "passBTag"  : (nBTag == 0),
+  }
+  return region_predicates
+
+
+def emu_region_mask(region_predicates, FS_pair_sign,
+                    pass_el_iso_req, el_iso_value,
+                    pass_mu_iso_req, mu_iso_value,
+                    pass_BTag_req):
+  ''' boolean mask of events in one emu region, arguments are the same as make_emu_region '''
+  mu_iso, el_iso = region_predicates["mu_iso"], region_predicates["el_iso"]
+  pass_mu_iso = (mu_iso_value[0] < mu_iso) & (mu_iso < mu_iso_value[1])
+  pass_el_iso = (el_iso_value[0] < el_iso) & (el_iso < el_iso_value[1])
+  return ( (region_predicates["pair_sign"] == FS_pair_sign) &
+           (pass_mu_iso == pass_mu_iso_req) & (pass_el_iso == pass_el_iso_req) &
+           (region_predicates["passBTag"] == pass_BTag_req) & region_predicates["passDZeta"] )
+
+
+def make_emu_region(event_dictionary, new_branch_name, FS_pair_sign,
+                      pass_el_iso_req, el_iso_value,
+                      pass_mu_iso_req, mu_iso_value,
+                      pass_BTag_req):
+  '''
+  Store the indices of events in the region as 'new_branch_name'.
+  Identical to make_emu_region_rowscan. To fill several regions at once use FF_functions.make_FF_region_flags
+  '''
+  region_predicates = emu_region_predicates(event_dictionary)
+  region_mask = emu_region_mask(region_predicates, FS_pair_sign,
+                                pass_el_iso_req, el_iso_value,
+                                pass_mu_iso_req, mu_iso_value,
+                                pass_BTag_req)
+  event_dictionary = store_selection(event_dictionary, new_branch_name, np.flatnonzero(region_mask))
+  return event_dictionary
+
+
+def make_emu_region_rowscan(event_dictionary, new_branch_name, FS_pair_sign, 
                       pass_el_iso_req, el_iso_value, 
                       pass_mu_iso_req, mu_iso_value, 
                       pass_BTag_req):
-  
+  '''
+  Original event-by-event version of make_emu_region, kept to validate the columnar version.
+  '''
   unpack_emu_vars = ["event", "Lepton_elIdx", "Lepton_muIdx", "Lepton_iso", 
                        "l1_indices", "l2_indices", "HTT_pdgId",
                        "Lepton_pt", "Lepton_phi", "PuppiMET_pt", "PuppiMET_phi",
@@ -2,10 +2,138 @@ import numpy as np
 
 from calculate_functions import calculate_mt, calculate_acoplan, return_TLorentz_Jets
 from branch_functions import add_trigger_branches, add_DeepTau_branches
+from columnar_functions import gather, gather_pair, count_per_event, get_event_jet_kinematics, encode_single_decayMode
+from columnar_functions import calculate_mt_array, calculate_acoplan_array, calculate_dphi_array, store_selection
 
 def make_etau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau=False, tau_pt_cut="None"):
   '''
-  Works similarly to 'make_ditau_cut'. 
+  Works similarly to 'make_mutau_cut'. 
+  Electron and tau quantities are gathered for all events through Lepton_elIdx and Lepton_tauIdx,
+  and the selection is a boolean mask over events.
+  Outputs are identical to make_etau_cut_rowscan, which is kept to validate this function.
+  '''
+  nEvents_precut = len(event_dictionary["Lepton_pt"])
+  # in ETau, electron is always lepton 1 in FS branches, tau is always lepton 2
+  elFSLoc, tauFSLoc = event_dictionary["l1_indices"], event_dictionary["l2_indices"]
+  elPt,  tauPt  = gather_pair(event_dictionary["Lepton_pt"],  elFSLoc, tauFSLoc)
+  elEta, tauEta = gather_pair(event_dictionary["Lepton_eta"], elFSLoc, tauFSLoc)
+  elPhi, tauPhi = gather_pair(event_dictionary["Lepton_phi"], elFSLoc, tauFSLoc)
+  elIso   = gather(event_dictionary["Lepton_iso"],  elFSLoc)
+  tauMass = gather(event_dictionary["Lepton_mass"], tauFSLoc)
+  elBranchLoc  = gather(event_dictionary["Lepton_elIdx"],  elFSLoc)
+  tauBranchLoc = gather(event_dictionary["Lepton_tauIdx"], tauFSLoc)
+
+  MET_pt, MET_phi = event_dictionary["PuppiMET_pt"], event_dictionary["PuppiMET_phi"]
+  nJet = event_dictionary["nCleanJet"]
+  jets = get_event_jet_kinematics(nJet, event_dictionary["CleanJet_pt"], event_dictionary["CleanJet_eta"],
+                                  event_dictionary["CleanJet_phi"], event_dictionary["CleanJet_mass"])
+  j1_pt, j2_pt = jets["j1_pt"], jets["j2_pt"]
+
+  # missing triggers in an era are filled with False
+  trigger_names = ["HLT_Ele30_WPTight_Gsf", "HLT_Ele24_eta2p1_WPTight_Gsf_LooseDeepTauPFTauHPS30_eta2p1_CrossL1",
+                   "HLT_VBF_DiPFJet45_Mjj500_Detajj2p5_MediumDeepTauPFTauHPS45_L2NN_eta2p1",
+                   "HLT_VBF_DiPFJet45_Mjj500_Detajj2p5_Ele17_eta2p1_WPTight_Gsf"]
+  available_triggers = add_trigger_branches([], era, final_state_mode="etau")
+  triggers = [event_dictionary[trigger] if trigger in available_triggers else np.zeros(nEvents_precut, dtype=bool)
+              for trigger in trigger_names]
+  trig_results = pass_kinems_by_trigger_array(triggers, elPt, tauPt, elEta, tauEta, j1_pt, j2_pt, jets["mjj"], nJet)
+  # trig_results = [Ele, ETau, VBFSingleTau, VBFSingleEle], same era vetoes as in the rowscan version
+  if ("2022" in era): trig_results = np.logical_and(trig_results, [1, 1, 0, 0])
+  if ("2023" in era): trig_results = np.logical_and(trig_results, [1, 1, 1, 1])
+  trig_results = np.logical_and(trig_results, [1, 1, 0, 1])
+  passKinems = np.any(trig_results, axis=1)
+  trig_idx   = np.where(passKinems, np.argmax(trig_results, axis=1), -1)
+
+  # Medium (5) v Jet, VLoose (1) v Muon, Tight (6) v Ele
+  _, vMu_branch, vEle_branch = add_DeepTau_branches([], DeepTau_version)
+  passTauDTLep = (gather(event_dictionary[vMu_branch], tauBranchLoc) >= 1) & \
+                 (gather(event_dictionary[vEle_branch], tauBranchLoc) >= 6)
+
+  cut_map = { "Low" : [25, 50],  "Mid" : [50, 70],  "High" : [70, 10000]  }
+  subtau_req = np.ones(nEvents_precut, dtype=bool)
+  if (tau_pt_cut != "None"):
+    subtau_req = (cut_map[tau_pt_cut][0] <= tauPt) & (tauPt <= cut_map[tau_pt_cut][1])
+
+  nJet = np.asarray(nJet)
+  jet_reqs = np.where(nJet == 0, True, np.where(nJet == 1, (j1_pt > 30.), (j1_pt > 30.) & (j2_pt > 30.)))
+
+  pass_mask = passKinems & passTauDTLep & subtau_req & jet_reqs
+  pass_cuts = np.flatnonzero(pass_mask)
+  # only compute and store the remaining quantities for passing events
+  elFSLoc, tauFSLoc = elFSLoc[pass_mask], tauFSLoc[pass_mask]
+  elBranchLoc, tauBranchLoc = elBranchLoc[pass_mask], tauBranchLoc[pass_mask]
+  elPt, elEta, elPhi, elIso = elPt[pass_mask], elEta[pass_mask], elPhi[pass_mask], elIso[pass_mask]
+  tauPt, tauEta, tauPhi, tauMass = tauPt[pass_mask], tauEta[pass_mask], tauPhi[pass_mask], tauMass[pass_mask]
+  MET_pt, MET_phi = np.asarray(MET_pt)[pass_mask], np.asarray(MET_phi)[pass_mask]
+  passing_events = {branch : event_dictionary[branch][pass_mask]
+                    for branch in ["Electron_dxy", "Electron_dz", "Electron_charge", "Electron_mass",
+                                   "Tau_dxy", "Tau_dz", "Tau_charge", "Tau_decayMode",
+                                   "Tau_rawPNetVSjet", "Tau_rawPNetVSmu", "Tau_rawPNetVSe", "CleanJet_btagWP"]}
+
+  event_dictionary = store_selection(event_dictionary, "pass_cuts", pass_cuts, {
+    "FS_el_pt"            : elPt,
+    "FS_el_eta"           : elEta,
+    "FS_el_phi"           : elPhi,
+    "FS_el_iso"           : elIso,
+    "FS_el_dxy"           : abs(gather(passing_events["Electron_dxy"], elBranchLoc)),
+    "FS_el_dz"            : abs(gather(passing_events["Electron_dz"],  elBranchLoc)),
+    "FS_el_chg"           : gather(passing_events["Electron_charge"], elBranchLoc),
+    "FS_el_mass"          : gather(passing_events["Electron_mass"],   elBranchLoc),
+    "FS_tau_pt"           : tauPt,
+    "FS_tau_eta"          : tauEta,
+    "FS_tau_phi"          : tauPhi,
+    "FS_tau_dxy"          : abs(gather(passing_events["Tau_dxy"], tauBranchLoc)),
+    "FS_tau_dz"           : abs(gather(passing_events["Tau_dz"],  tauBranchLoc)),
+    "FS_tau_chg"          : gather(passing_events["Tau_charge"], tauBranchLoc),
+    "FS_tau_mass"         : tauMass,
+    "FS_tau_DM"           : encode_single_decayMode(gather(passing_events["Tau_decayMode"], tauBranchLoc)),
+    "FS_trig_idx"         : trig_idx[pass_mask],
+    "FS_mt"               : calculate_mt_array(elPt, elPhi, MET_pt, MET_phi),
+    "FS_nbJet"            : count_per_event(passing_events["CleanJet_btagWP"], lambda btag: btag > 1),
+    "FS_acoplan"          : calculate_acoplan_array(elPhi, tauPhi),
+    "FS_dphi_etau"        : calculate_dphi_array(elPhi, tauPhi),
+    "FS_deta_etau"        : abs(elEta - tauEta),
+    "FS_dpt_etau"         : elPt - tauPt,
+    "FS_tau_rawPNetVSjet" : gather(passing_events["Tau_rawPNetVSjet"], tauBranchLoc),
+    "FS_tau_rawPNetVSmu"  : gather(passing_events["Tau_rawPNetVSmu"],  tauBranchLoc),
+    "FS_tau_rawPNetVSe"   : gather(passing_events["Tau_rawPNetVSe"],   tauBranchLoc),
+  })
+  nEvents_postcut = len(pass_cuts)
+  print(f"nEvents before and after etau cuts = {nEvents_precut}, {nEvents_postcut}")
+  return event_dictionary
+
+
+def pass_kinems_by_trigger_array(triggers, el_pt, tau_pt, el_eta, tau_eta, j1_pt, j2_pt, mjj, nJet):
+  '''
+  Array version of pass_kinems_by_trigger, returns a (nEvents, 4) boolean array
+  with columns [SingleEle, ETau, VBFSingleTau, VBFSingleEle] and the same priority between triggers
+  '''
+  ele_trig, etau_trig, singletau_VBF_trig, singleele_VBF_trig = [np.asarray(trig, dtype=bool) for trig in triggers]
+  nJet = np.asarray(nJet)
+
+  passEventJetKinems = np.where(nJet == 0, True, np.where(nJet == 1, (j1_pt > 30.), (j1_pt > 30.) & (j2_pt > 30.)))
+  passEventTauKinems = (tau_pt > 25.) & (abs(tau_eta) < 2.5)
+  passEventEleKinems = (el_pt > 10.)  & (abs(el_eta) < 2.5)
+  passEventKinems    = passEventJetKinems & passEventTauKinems & passEventEleKinems
+
+  pass_single_ele = ele_trig & passEventKinems & (el_pt > 31.) & (tau_pt > 25.)
+
+  pass_etau = etau_trig & passEventKinems & (el_pt > 25.) & (el_pt < 31.) & (abs(el_eta) < 2.1) \
+              & (tau_pt > 35) & (abs(tau_eta) < 2.1)
+  pass_single_ele = pass_single_ele & ~pass_etau # enforce othrogonal trigger coverage
+
+  pass_singletau_VBF = singletau_VBF_trig & passEventKinems & (tau_pt > 45) & (abs(tau_eta) < 2.1) \
+                       & (j1_pt > 45) & (j2_pt > 45) & (mjj > 500)
+
+  pass_singleele_VBF = singleele_VBF_trig & passEventKinems & (el_pt > 18) & (abs(el_eta) < 2.1) \
+                       & (j1_pt > 50) & (j2_pt > 50) & (mjj > 550)
+
+  return np.stack([pass_single_ele, pass_etau, pass_singletau_VBF, pass_singleele_VBF], axis=1)
+
+
+def make_etau_cut_rowscan(era, event_dictionary, DeepTau_version, skip_DeepTau=False, tau_pt_cut="None"):
+  '''
+  Original event-by-event version of make_etau_cut, kept to validate the columnar version.
   '''
   nEvents_precut = len(event_dictionary["Lepton_pt"])
   unpack_etau = ["Lepton_pt", "Lepton_eta", "Lepton_phi", "Lepton_iso",
@@ -297,9 +425,59 @@ def pass_kinems_by_trigger(triggers, el_pt, tau_pt, el_eta, tau_eta,
   return [pass_single_ele, pass_etau, pass_singletau_VBF, pass_singleele_VBF]
 
 
+def etau_region_predicates(event_dictionary, DeepTau_version):
+  '''
+  Per-event quantities used by the etau region definitions, computed once so that
+  several regions can be evaluated with etau_region_mask without another pass over the events
+  '''
+  vJet_branch = add_DeepTau_branches([], DeepTau_version)[0]
+  tau_idx = gather(event_dictionary["Lepton_tauIdx"], event_dictionary["l2_indices"])
+  nBTag   = count_per_event(event_dictionary["CleanJet_btagWP"], lambda btag: btag > 1)
+  region_predicates = {
+    "pair_sign" : np.sign(event_dictionary["HTT_pdgId"]),
+    "el_iso"    : gather(event_dictionary["Lepton_iso"], event_dictionary["l1_indices"]),
+    "tau_vJet"  : gather(event_dictionary[vJet_branch], tau_idx),
+    "mt"        : event_dictionary["HTT_mT_lmet"],
+    "passBTag"  : (nBTag == 0), # no nCleanJet requirement, unlike mutau
+  }
+  return region_predicates
+
+
+def etau_region_mask(region_predicates, FS_pair_sign, pass_el_iso_req, el_iso_value,
+                     pass_DeepTau_req, DeepTau_value, DeepTau_version,
+                     pass_mt_req, mt_value, pass_BTag_req):
+  ''' boolean mask of events in one etau region, arguments are the same as make_etau_region '''
+  el_iso = region_predicates["el_iso"]
+  # puts el_iso between 0.05 and 0.15 for DRsr and DRar QCD
+  pass_el_iso  = (el_iso_value[0] <= el_iso) & (el_iso < el_iso_value[1])
+  pass_DeepTau = (region_predicates["tau_vJet"] >= DeepTau_value)
+  passMT       = (region_predicates["mt"] < mt_value)
+  return ( (region_predicates["pair_sign"] == FS_pair_sign) &
+           (pass_el_iso == pass_el_iso_req) & (pass_DeepTau == pass_DeepTau_req) &
+           (passMT == pass_mt_req) & (region_predicates["passBTag"] == pass_BTag_req) )
+
+
 def make_etau_region(event_dictionary, new_branch_name, FS_pair_sign, pass_el_iso_req, el_iso_value,
                      pass_DeepTau_req, DeepTau_value, DeepTau_version,
                      pass_mt_req, mt_value, pass_BTag_req):
+  '''
+  Store the indices of events in the region as 'new_branch_name'.
+  Identical to make_etau_region_rowscan. To fill several regions at once use FF_functions.make_FF_region_flags
+  '''
+  region_predicates = etau_region_predicates(event_dictionary, DeepTau_version)
+  region_mask = etau_region_mask(region_predicates, FS_pair_sign, pass_el_iso_req, el_iso_value,
+                                 pass_DeepTau_req, DeepTau_value, DeepTau_version,
+                                 pass_mt_req, mt_value, pass_BTag_req)
+  event_dictionary = store_selection(event_dictionary, new_branch_name, np.flatnonzero(region_mask))
+  return event_dictionary
+
+
+def make_etau_region_rowscan(event_dictionary, new_branch_name, FS_pair_sign, pass_el_iso_req, el_iso_value,
+                     pass_DeepTau_req, DeepTau_value, DeepTau_version,
+                     pass_mt_req, mt_value, pass_BTag_req):
+  '''
+  Original event-by-event version of make_etau_region, kept to validate the columnar version.
+  '''
   unpack_etau_vars = ["event", "Lepton_tauIdx", "Lepton_elIdx", "Lepton_iso", 
                        "l1_indices", "l2_indices", "HTT_pdgId",
                        "Lepton_pt", "Lepton_phi", "PuppiMET_pt", "PuppiMET_phi", 
@@ -2,10 +2,137 @@ import numpy as np
 
 from calculate_functions import calculate_mt, calculate_acoplan, return_TLorentz_Jets
 from branch_functions import add_trigger_branches, add_DeepTau_branches
+from columnar_functions import gather, gather_pair, count_per_event, get_event_jet_kinematics, encode_single_decayMode
+from columnar_functions import calculate_mt_array, calculate_acoplan_array, calculate_dphi_array, store_selection
 
 def make_mutau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau=False, tau_pt_cut="None"):
   '''
   Works similarly to 'make_ditau_cut'. 
+  Muon and tau quantities are gathered for all events through Lepton_muIdx and Lepton_tauIdx,
+  and the trigger kinematic windows are evaluated as boolean columns.
+  Outputs are identical to make_mutau_cut_rowscan, which is kept to validate this function.
+  '''
+  nEvents_precut = len(event_dictionary["Lepton_pt"])
+  # in MuTau, muon is always lepton 1 in FS branches, tau is always lepton 2
+  muFSLoc, tauFSLoc = event_dictionary["l1_indices"], event_dictionary["l2_indices"]
+  muPt,  tauPt  = gather_pair(event_dictionary["Lepton_pt"],  muFSLoc, tauFSLoc)
+  muEta, tauEta = gather_pair(event_dictionary["Lepton_eta"], muFSLoc, tauFSLoc)
+  muPhi, tauPhi = gather_pair(event_dictionary["Lepton_phi"], muFSLoc, tauFSLoc)
+  muIso   = gather(event_dictionary["Lepton_iso"],  muFSLoc)
+  tauMass = gather(event_dictionary["Lepton_mass"], tauFSLoc)
+  muBranchLoc  = gather(event_dictionary["Lepton_muIdx"],  muFSLoc)
+  tauBranchLoc = gather(event_dictionary["Lepton_tauIdx"], tauFSLoc)
+
+  muDxy  = abs(gather(event_dictionary["Muon_dxy"], muBranchLoc))
+  muDz   = abs(gather(event_dictionary["Muon_dz"],  muBranchLoc))
+  muChg  = gather(event_dictionary["Muon_charge"], muBranchLoc)
+  muMass = gather(event_dictionary["Muon_mass"],   muBranchLoc)
+
+  tauDxy  = abs(gather(event_dictionary["Tau_dxy"], tauBranchLoc))
+  tauDz   = abs(gather(event_dictionary["Tau_dz"],  tauBranchLoc))
+  tauChg  = gather(event_dictionary["Tau_charge"], tauBranchLoc)
+  encoded_tau_decayMode = encode_single_decayMode(gather(event_dictionary["Tau_decayMode"], tauBranchLoc))
+  leadTkPtOverTau = gather(event_dictionary["Tau_leadTkPtOverTauPt"], tauBranchLoc)
+  tauPNetvJet = gather(event_dictionary["Tau_rawPNetVSjet"], tauBranchLoc)
+  tauPNetvMu  = gather(event_dictionary["Tau_rawPNetVSmu"],  tauBranchLoc)
+  tauPNetvEle = gather(event_dictionary["Tau_rawPNetVSe"],   tauBranchLoc)
+
+  MET_pt, MET_phi = event_dictionary["PuppiMET_pt"], event_dictionary["PuppiMET_phi"]
+  mt_branch = event_dictionary["HTT_mT_lmet"]
+  mt      = calculate_mt_array(muPt, muPhi, MET_pt, MET_phi)
+  mt_diff = mt - mt_branch
+  acoplan = calculate_acoplan_array(muPhi, tauPhi)
+
+  nJet = event_dictionary["nCleanJet"]
+  jets = get_event_jet_kinematics(nJet, event_dictionary["CleanJet_pt"], event_dictionary["CleanJet_eta"],
+                                  event_dictionary["CleanJet_phi"], event_dictionary["CleanJet_mass"])
+  nbJet = count_per_event(event_dictionary["CleanJet_btagWP"], lambda btag: btag > 1)
+
+  # missing triggers in an era are filled with False
+  trigger_names = ["HLT_IsoMu24", "HLT_IsoMu20_eta2p1_LooseDeepTauPFTauHPS27_eta2p1_CrossL1",
+                   "HLT_VBF_DiPFJet45_Mjj500_Detajj2p5_MediumDeepTauPFTauHPS45_L2NN_eta2p1",
+                   "HLT_VBF_DiPFJet90_40_Mjj600_Detajj2p5_Mu3_TrkIsoVVL"]
+  available_triggers = add_trigger_branches([], era, final_state_mode="mutau")
+  triggers = [event_dictionary[trigger] if trigger in available_triggers else np.zeros(nEvents_precut, dtype=bool)
+              for trigger in trigger_names]
+  trig_results = pass_kinems_by_trigger_array(triggers, muPt, tauPt, muEta, tauEta,
+                                              jets["j1_pt"], jets["j2_pt"], jets["mjj"], nJet)
+  # trig_results = [Muon, MuTau, VBFSingleTau, VBFSingleMu], same era vetoes as in the rowscan version
+  if ("2022" in era): trig_results = np.logical_and(trig_results, [1, 1, 0, 0])
+  if ("2023" in era): trig_results = np.logical_and(trig_results, [1, 1, 1, 1])
+  trig_results = np.logical_and(trig_results, [1, 1, 0, 1])
+  passKinems = np.any(trig_results, axis=1)
+  trig_idx   = np.where(passKinems, np.argmax(trig_results, axis=1), -1)
+
+  # no selection is applied at this stage, see the rowscan version for the previous requirements
+  pass_cuts = np.arange(nEvents_precut)
+
+  event_dictionary = store_selection(event_dictionary, "pass_cuts", pass_cuts)
+  event_dictionary["FS_mu_pt"]      = muPt
+  event_dictionary["FS_mu_eta"]     = muEta
+  event_dictionary["FS_mu_phi"]     = muPhi
+  event_dictionary["FS_mu_iso"]     = muIso
+  event_dictionary["FS_mu_dxy"]     = muDxy
+  event_dictionary["FS_mu_dz"]      = muDz
+  event_dictionary["FS_mu_chg"]     = muChg
+  event_dictionary["FS_mu_mass"]    = muMass
+  event_dictionary["FS_tau_pt"]     = tauPt
+  event_dictionary["FS_tau_eta"]    = tauEta
+  event_dictionary["FS_tau_phi"]    = tauPhi
+  event_dictionary["FS_tau_dxy"]    = tauDxy
+  event_dictionary["FS_tau_dz"]     = tauDz
+  event_dictionary["FS_tau_chg"]    = tauChg
+  event_dictionary["FS_tau_mass"]   = tauMass
+  event_dictionary["FS_tau_DM"]     = encoded_tau_decayMode
+  event_dictionary["FS_trig_idx"]   = trig_idx
+  event_dictionary["FS_mt"]         = mt
+  event_dictionary["FS_mt_branch"]  = np.array(mt_branch)
+  event_dictionary["FS_mt_diff"]    = mt_diff
+  event_dictionary["FS_nbJet"]      = nbJet
+  event_dictionary["FS_acoplan"]    = acoplan
+  event_dictionary["FS_dphi_mutau"] = calculate_dphi_array(muPhi, tauPhi)
+  event_dictionary["FS_deta_mutau"] = abs(muEta - tauEta)
+  event_dictionary["FS_dpt_mutau"]  = muPt - tauPt
+  event_dictionary["FS_LeadTkPtOverTau"]  = leadTkPtOverTau
+  event_dictionary["FS_tau_rawPNetVSjet"] = tauPNetvJet
+  event_dictionary["FS_tau_rawPNetVSmu"]  = tauPNetvMu
+  event_dictionary["FS_tau_rawPNetVSe"]   = tauPNetvEle
+  nEvents_postcut = len(pass_cuts)
+  print(f"nEvents before and after mutau cuts = {nEvents_precut}, {nEvents_postcut}")
+  return event_dictionary
+
+
+def pass_kinems_by_trigger_array(triggers, mu_pt, tau_pt, mu_eta, tau_eta, j1_pt, j2_pt, mjj, nJet):
+  '''
+  Array version of pass_kinems_by_trigger, returns a (nEvents, 4) boolean array
+  with columns [SingleMu, MuTau, VBFSingleTau, VBFSingleMu] and the same priority between triggers
+  '''
+  muon_trig, mutau_trig, singletau_VBF_trig, singlemu_VBF_trig = [np.asarray(trig, dtype=bool) for trig in triggers]
+  nJet = np.asarray(nJet)
+
+  passEventJetKinems  = np.where(nJet == 0, True, np.where(nJet == 1, (j1_pt > 30.), (j1_pt > 30.) & (j2_pt > 30.)))
+  passEventTauKinems  = (tau_pt > 25.) & (abs(tau_eta) < 2.5)
+  passEventMuonKinems = (mu_pt > 10.)  & (abs(mu_eta) < 2.4)
+  passEventKinems     = passEventJetKinems & passEventTauKinems & passEventMuonKinems
+
+  pass_single_muon = muon_trig & passEventKinems & (mu_pt > 25.) & (tau_pt > 25.)
+
+  pass_mutau = mutau_trig & passEventKinems & (mu_pt > 21.) & (mu_pt < 25.) & (abs(mu_eta) < 2.1) \
+               & (tau_pt > 32) & (abs(tau_eta) < 2.1)
+  pass_single_muon = pass_single_muon & ~pass_mutau # enforce othrogonal trigger coverage
+
+  pass_singletau_VBF = singletau_VBF_trig & passEventKinems & (tau_pt > 45) & (abs(tau_eta) < 2.1) \
+                       & (j1_pt > 45) & (j2_pt > 45) & (mjj > 500)
+
+  pass_singlemu_VBF = singlemu_VBF_trig & passEventKinems & (j1_pt > 90) & (j2_pt > 40) & (mjj > 600)
+
+  return np.stack([pass_single_muon, pass_mutau, pass_singletau_VBF, pass_singlemu_VBF], axis=1)
+
+
+def make_mutau_cut_rowscan(era, event_dictionary, DeepTau_version, skip_DeepTau=False, tau_pt_cut="None"):
+  '''
+  Original event-by-event version of make_mutau_cut, kept to validate the columnar version.
+  Works similarly to 'make_ditau_cut'. 
   Notably, the mutau cuts are more complicated, but it is simple to 
   extend the existing methods as long as one can stomach the line breaks.
   '''
@@ -314,9 +441,59 @@ def pass_kinems_by_trigger(triggers, mu_pt, tau_pt, mu_eta, tau_eta,
   return [pass_single_muon, pass_mutau, pass_singletau_VBF, pass_singlemu_VBF]
 
 
+def mutau_region_predicates(event_dictionary, DeepTau_version):
+  '''
+  Per-event quantities used by the mutau region definitions, computed once so that
+  several regions can be evaluated with mutau_region_mask without another pass over the events
+  '''
+  vJet_branch = add_DeepTau_branches([], DeepTau_version)[0]
+  tau_idx = gather(event_dictionary["Lepton_tauIdx"], event_dictionary["l2_indices"])
+  nBTag   = count_per_event(event_dictionary["CleanJet_btagWP"], lambda btag: btag > 1)
+  region_predicates = {
+    "pair_sign" : np.sign(event_dictionary["HTT_pdgId"]),
+    "mu_iso"    : gather(event_dictionary["Lepton_iso"], event_dictionary["l1_indices"]),
+    "tau_vJet"  : gather(event_dictionary[vJet_branch], tau_idx),
+    "mt"        : event_dictionary["HTT_mT_lmet"],
+    "passBTag"  : (np.asarray(event_dictionary["nCleanJet"]) <= 0) | (nBTag == 0),
+  }
+  return region_predicates
+
+
+def mutau_region_mask(region_predicates, FS_pair_sign, pass_mu_iso_req, mu_iso_value,
+                      pass_DeepTau_req, DeepTau_value, DeepTau_version,
+                      pass_mt_req, mt_value, pass_BTag_req):
+  ''' boolean mask of events in one mutau region, arguments are the same as make_mutau_region '''
+  mu_iso = region_predicates["mu_iso"]
+  # puts mu_iso between 0.05 and 0.15 for DRsr and DRar QCD
+  pass_mu_iso  = (mu_iso_value[0] <= mu_iso) & (mu_iso < mu_iso_value[1])
+  pass_DeepTau = (region_predicates["tau_vJet"] >= DeepTau_value)
+  passMT       = (region_predicates["mt"] < mt_value)
+  return ( (region_predicates["pair_sign"] == FS_pair_sign) &
+           (pass_mu_iso == pass_mu_iso_req) & (pass_DeepTau == pass_DeepTau_req) &
+           (passMT == pass_mt_req) & (region_predicates["passBTag"] == pass_BTag_req) )
+
+
 def make_mutau_region(event_dictionary, new_branch_name, FS_pair_sign, pass_mu_iso_req, mu_iso_value,
                       pass_DeepTau_req, DeepTau_value, DeepTau_version,
                       pass_mt_req, mt_value, pass_BTag_req):
+  '''
+  Store the indices of events in the region as 'new_branch_name'.
+  Identical to make_mutau_region_rowscan. To fill several regions at once use FF_functions.make_FF_region_flags
+  '''
+  region_predicates = mutau_region_predicates(event_dictionary, DeepTau_version)
+  region_mask = mutau_region_mask(region_predicates, FS_pair_sign, pass_mu_iso_req, mu_iso_value,
+                                  pass_DeepTau_req, DeepTau_value, DeepTau_version,
+                                  pass_mt_req, mt_value, pass_BTag_req)
+  event_dictionary = store_selection(event_dictionary, new_branch_name, np.flatnonzero(region_mask))
+  return event_dictionary
+
+
+def make_mutau_region_rowscan(event_dictionary, new_branch_name, FS_pair_sign, pass_mu_iso_req, mu_iso_value,
+                      pass_DeepTau_req, DeepTau_value, DeepTau_version,
+                      pass_mt_req, mt_value, pass_BTag_req):
+  '''
+  Original event-by-event version of make_mutau_region, kept to validate the columnar version.
+  '''
   unpack_mutau_vars = ["event", "Lepton_tauIdx", "Lepton_muIdx", "Lepton_iso", 
                        "l1_indices", "l2_indices", "HTT_pdgId",
                        "Lepton_pt", "Lepton_phi", "PuppiMET_pt", "PuppiMET_phi", 
@@ -97,7 +97,7 @@ if __name__ == "__main__":
 
     new_process_dictionary = load_process_from_file(process, using_directory, file_map,
                                               branches, good_events, final_state_mode,
-                                              data=("Data" in process), testing=testing)
+                                              testing=testing)
     if new_process_dictionary == None: continue # skip process if empty
 
     cut_events = apply_HTT_FS_cuts_to_process(process, new_process_dictionary, final_state_mode, jet_mode,
@@ -1,22 +1,44 @@
 import uproot
 import numpy as np
+import os
+import glob
+import fnmatch
+import re
+import json
+import hashlib
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import OrderedDict
 
 from utility_functions import time_print, text_options, log_print
 from MC_dictionary import MC_dictionary
+from columnar_functions import is_awkward, to_object_array
 
 ### README ###
 # This file contains the main method to load data from root files
 # The wildcarding works for the 'concatenate' function of uproot, and might not in the future.
+# iterate_process_from_file reads the same files in chunks of 'step_size' entries with uproot.iterate
+# (streaming_step_size unless set with --step_size).
+# reconcile_branches compares the requested branches, and those in the good_events cut, to each file's branch list
+# (branch_schema, cached per mtime in memory and in branch_schema_cache_file): branches no file has are dropped,
+# branches only some files have are filled with zeros (fill_missing_branches) or replaced by zero in the cut.
+# update_catalog keeps a json catalog of the input ntuples (size, mtime, entries, normalization, branch schema),
+# so work can be planned and empty files skipped without opening them, see catalog_files.
+# The skim cache functions store the cut events of each input file as npz, see skim_cache_path.
+# run_work_units runs a function over (process, input_file) units, in parallel with a process pool if asked.
+# FilePrefetcher loads the next files on a background thread while the current one is cut (--prefetch).
 # This file also contains methods relevant to sorting samples from files.
 
 
 def load_process_from_file(process, file_directory, file_map, log_file,
                            branches, good_events, final_state_mode, 
-                           data=False, testing=False, direct_input=None):
+                           testing=False, direct_input=None, library="np"):
   '''
   This will make more sense if you read the documentation on uproot.concatenate first:
   https://uproot.readthedocs.io/en/latest/basic.html#reading-many-files-into-big-arrays
-  Most important function! Contains the only call to uproot in this library! 
+  Most important function! Contains the only call to uproot in this library, besides the
+  streaming version iterate_process_from_file below.
   Loads into memory files relevant to the given 'final_state_mode' by reading
   'file_map' which is a python dictionary maintained in a separate file. 
   uproot.concatenate grabs all files matching the wildcard in 'file_map[process]'
@@ -30,9 +52,32 @@ def load_process_from_file(process, file_directory, file_map, log_file,
     {"branch_N" : [event1, event2, event3, ..., eventN]}}
   This coding library is built using numpy arrays as the default and will not work
   with other types of arrays (although the methods could be copied and rewritten). 
+  The exception is library="ak": flat branches are still numpy arrays, but jagged branches
+  stay awkward arrays (one content buffer and offsets) instead of an object array of small arrays,
+  which the columnar_functions helpers read directly.
   Note: that a numpy array is generated for each loaded process, which corresponds
   to a set of files. 
   '''
+  file_string = set_file_string(process, file_directory, file_map, log_file, direct_input)
+  try:
+    processed_events = []
+    for file_strings, read_branches, missing_branches, cut in reconcile_branches(file_string, branches, good_events, log_file):
+      events = uproot.concatenate(file_strings, read_branches, cut=cut, library=library)
+      processed_events.append(fill_missing_branches(event_dictionary_from(events, library), missing_branches, library))
+    processed_events = join_events(processed_events)
+  except FileNotFoundError:
+    log_print(text_options["yellow"] + "FILE NOT FOUND! " + text_options["reset"], log_file, end="")
+    log_print(f"continuing without loading {file_string}...", log_file)
+    return None
+  process_list = {}
+  process_list[process] = {}
+  process_list[process]["info"] = processed_events
+ 
+  return process_list
+
+
+def set_file_string(process, file_directory, file_map, log_file, direct_input):
+  ''' Return the uproot file string for 'process' '''
   if direct_input != None:
     # way to bypass filemapping and load files from different data directories
     log_print(f"Loading {direct_input}", log_file, time=True)
@@ -40,30 +85,380 @@ def load_process_from_file(process, file_directory, file_map, log_file,
   else:
     log_print(f"Loading {file_map[process]}", log_file, time=True)
     file_string = file_directory + "/" + file_map[process] + ".root:Events"
-  if data: 
-    # if a branch isn't available in Data, don't try to load it
-    branches_not_in_data = ["Generator_weight", "NWEvents", "Tau_genPartFlav", "XSecMCweight",
-                            "Weight_DY_Zpt", "Weight_DY_Zpt_LO", "Weight_DY_Zpt_NLO",
-                            "TauSFweight", "MuSFweight", "ElSFweight", "BTagSFfull",
-                            "PUweight", "Weight_TTbar_NNLO", "Pileup_nPU"]
-    for missing_branch in branches_not_in_data:
-      branches = [branch for branch in branches if branch != missing_branch]
-  if "WJets" not in process:
-    branches = [branch for branch in branches if not branch.startswith("StitchWeight_WJets")]
+  return file_string
+
+
+# branch lists of the input files, {path : (modification time, {branch : (jagged, dtype)})}
+# filled by branch_schema, a file is only opened again once it changes.
+# The schemas are also kept in branch_schema_cache_file (json), so later runs do not open unchanged files either,
+# set it to None to keep them in memory only.
+branch_schema_cache = {}
+branch_schema_cache_file = os.path.join(os.path.expanduser("~"), ".cache", "SimplePlot", "branch_schemas.json")
+branch_schema_cache_state = {"loaded" : False, "changed" : False}
+
+def schema_to_json(schema):
+  ''' {branch : [jagged, dtype string]} for json, the format of the catalog and branch_schema_cache_file '''
+  return {branch : [jagged, None if dtype == None else dtype.str] for branch, (jagged, dtype) in schema.items()}
+
+
+def schema_from_json(stored_schema):
+  ''' inverse of schema_to_json '''
+  return {branch : (jagged, None if dtype == None else np.dtype(dtype)) for branch, (jagged, dtype) in stored_schema.items()}
+
+
+def load_branch_schema_cache():
+  ''' Read branch_schema_cache_file into branch_schema_cache once per run, schemas already in memory are kept '''
+  if branch_schema_cache_state["loaded"]: return
+  branch_schema_cache_state["loaded"] = True
+  if (branch_schema_cache_file == None) or (not os.path.exists(branch_schema_cache_file)): return
   try:
-    processed_events = uproot.concatenate([file_string], branches, cut=good_events, library="np")
+    with open(branch_schema_cache_file) as cache_file:
+      stored = json.load(cache_file)
+  except ValueError:
+    return # unreadable cache, the schemas are read again and the file is rewritten
+  for input_file, (mtime, stored_schema) in stored.items():
+    if input_file not in branch_schema_cache:
+      branch_schema_cache[input_file] = (mtime, schema_from_json(stored_schema))
+
+
+def save_branch_schema_cache():
+  '''
+  Write branch_schema_cache to branch_schema_cache_file if schemas were added since the last save.
+  Written under a temporary name first, like the skim cache, so parallel runs cannot leave a partial file.
+  '''
+  if (branch_schema_cache_file == None) or (not branch_schema_cache_state["changed"]): return
+  branch_schema_cache_state["changed"] = False
+  os.makedirs(os.path.dirname(branch_schema_cache_file) or ".", exist_ok=True)
+  temporary_path = f"{branch_schema_cache_file}.{os.getpid()}.tmp"
+  with open(temporary_path, "w") as cache_file:
+    json.dump({input_file : [mtime, schema_to_json(schema)] for input_file, (mtime, schema) in branch_schema_cache.items()},
+              cache_file)
+  os.replace(temporary_path, branch_schema_cache_file)
+
+
+def branch_schema(input_file, tree_name="Events"):
+  '''
+  Return {branch : (jagged, dtype)} for the tree of 'input_file', read once per modification time.
+  dtype is the type of the values (of the elements for jagged branches), None if uproot does not say.
+  '''
+  load_branch_schema_cache()
+  mtime = os.path.getmtime(input_file)
+  if (input_file in branch_schema_cache) and (branch_schema_cache[input_file][0] == mtime):
+    return branch_schema_cache[input_file][1]
+  schema = {}
+  with uproot.open(input_file) as root_file:
+    tree = root_file[tree_name]
+    for branch in tree.keys():
+      interpretation = tree[branch].interpretation
+      content = getattr(interpretation, "content", None)
+      jagged  = (content != None)
+      to_dtype = getattr(content if jagged else interpretation, "to_dtype", None)
+      schema[branch] = (jagged, None if to_dtype == None else np.dtype(to_dtype))
+  branch_schema_cache[input_file] = (mtime, schema)
+  branch_schema_cache_state["changed"] = True
+  return schema
+
+
+# branches missing from every input file that are filled anyway, by prefix
+# an HLT path that is not in the menu of an ntuple version never fired
+missing_branch_defaults = {
+  "HLT_" : np.bool_,
+}
+
+def cut_branches(good_events, schemas):
+  ''' names in the 'good_events' cut string that are branches of any of the files, or have a missing_branch_defaults entry '''
+  if not good_events: return []
+  names = list(dict.fromkeys(re.findall(r"[A-Za-z_]\w*", good_events)))
+  return [name for name in names
+          if any(name in schema for schema in schemas.values()) or name.startswith(tuple(missing_branch_defaults))]
+
+
+def cut_without(good_events, missing_branches):
+  ''' 'good_events' with the branches in 'missing_branches' replaced by a zero of their type '''
+  for branch, (_, dtype) in missing_branches.items():
+    good_events = re.sub(r"\b" + branch + r"\b", repr(np.zeros(1, dtype=dtype)[0].item()), good_events)
+  return good_events
+
+
+def reconcile_branches(file_string, branches, good_events=None, log_file=None):
+  '''
+  Compare 'branches' and the branches used in the 'good_events' cut to the branch lists of the files
+  matching 'file_string' and return the reads to make, a list of
+  (file strings, branches to read, {branch : (jagged, dtype)} to fill after reading, cut to apply).
+  Files are grouped by the branches they have, so mixed ntuple versions can be loaded together,
+  with a single group (the usual case) the wildcard 'file_string' is read as before.
+  Groups are runs of consecutive files in sorted order, so the joined events keep the order of the files.
+  Branches that only some files have are filled with zeros of their type in the others,
+  in the cut they are replaced by a zero (e.g. a trigger that is not in the menu never fired).
+  Branches no file has are dropped, e.g. MC weights and Tau_genPartFlav in Data or StitchWeight_WJets
+  outside WJets, unless they have an entry in missing_branch_defaults.
+  '''
+  path_pattern, tree_name = file_string.rsplit(":", 1)
+  input_files = sorted(glob.glob(path_pattern))
+  if len(input_files) == 0: return [([file_string], branches, {}, good_events)] # uproot reports the missing file
+  schemas = {input_file : branch_schema(input_file, tree_name) for input_file in input_files}
+  save_branch_schema_cache()
+
+  used_in_cut = cut_branches(good_events, schemas)
+  branch_types = {}
+  for schema in schemas.values():
+    for branch in branches + used_in_cut:
+      if (branch in schema) and (branch not in branch_types): branch_types[branch] = schema[branch]
+  for branch in branches + used_in_cut:
+    for prefix, default_type in missing_branch_defaults.items():
+      if (branch not in branch_types) and branch.startswith(prefix):
+        branch_types[branch] = (False, np.dtype(default_type))
+  not_in_files = [branch for branch in branches if branch not in branch_types]
+  if len(not_in_files) > 0: log_print(f"Not loading branches missing from the files: {not_in_files}", log_file)
+  branches = [branch for branch in branches if branch in branch_types]
+
+  groups = [] # [(branches present, cut branches present, file strings)] in file order
+  for input_file, schema in schemas.items():
+    present = (tuple(branch for branch in branches if branch in schema),
+               tuple(branch for branch in used_in_cut if branch in schema))
+    if (len(groups) > 0) and (groups[-1][:2] == present):
+      groups[-1][2].append(input_file + ":" + tree_name)
+    else:
+      groups.append((*present, [input_file + ":" + tree_name]))
+  def read(file_strings, read_branches, present_cut_branches):
+    missing_cut_branches = {branch : branch_types[branch] for branch in used_in_cut if branch not in present_cut_branches}
+    return (file_strings, list(read_branches),
+            {branch : branch_types[branch] for branch in branches if branch not in read_branches},
+            cut_without(good_events, missing_cut_branches))
+  if len(set(group[:2] for group in groups)) == 1:
+    return [read([file_string], groups[0][0], groups[0][1])]
+  log_print(f"{len(set(group[:2] for group in groups))} different branch lists in {path_pattern}, "
+            f"reading them separately in {len(groups)} runs of files", log_file)
+  return [read(file_strings, read_branches, present_cut_branches) for read_branches, present_cut_branches, file_strings in groups]
+
+
+def event_dictionary_from(events, library):
+  '''
+  {branch : values} for events read by uproot. With library="ak" the record array is split into its fields,
+  flat branches are converted to numpy arrays and jagged branches stay awkward arrays.
+  '''
+  if library != "ak": return events
+  import awkward as ak
+  return {branch : ak.to_numpy(events[branch]) if events[branch].ndim == 1 else events[branch]
+          for branch in events.fields}
+
+
+def fill_missing_branches(events, missing_branches, library="np"):
+  '''
+  Add the branches in 'missing_branches', {branch : (jagged, dtype)}, to the loaded 'events' as zeros,
+  or as an empty array per event for jagged branches. Filled after the cut, so only for the kept events.
+  With library="np" every event shares one read-only empty array, so no array is made per event.
+  '''
+  if len(missing_branches) == 0: return events
+  nEvents = len(next(iter(events.values()))) if len(events) > 0 else 0
+  for branch, (jagged, dtype) in missing_branches.items():
+    if jagged and (library == "ak"):
+      import awkward as ak
+      events[branch] = ak.unflatten(np.zeros(0, dtype=dtype), np.zeros(nEvents, dtype=np.int64))
+    elif jagged:
+      no_entries = np.zeros(0, dtype=dtype)
+      no_entries.flags.writeable = False
+      events[branch] = np.empty(nEvents, dtype=object)
+      events[branch].fill(no_entries)
+    else:
+      events[branch] = np.zeros(nEvents, dtype=dtype)
+  return events
+
+
+def join_events(events_list):
+  ''' Concatenate the branches of several loaded event dictionaries, which have the same branches '''
+  if len(events_list) == 1: return events_list[0]
+  joined = {}
+  for branch in events_list[0]:
+    if is_awkward(events_list[0][branch]):
+      import awkward as ak
+      joined[branch] = ak.concatenate([events[branch] for events in events_list])
+    else:
+      joined[branch] = np.concatenate([events[branch] for events in events_list])
+  return joined
+
+
+# number of entries read at once by iterate_process_from_file
+# peak memory while streaming scales with this (and the loaded branches), not with the size of the sample
+streaming_step_size = 200000
+
+def iterate_process_from_file(process, file_directory, file_map, log_file,
+                              branches, good_events, final_state_mode,
+                              testing=False, direct_input=None, step_size=streaming_step_size,
+                              library="np"):
+  '''
+  Streaming version of load_process_from_file using uproot.iterate.
+  Yields process dictionaries with the same layout, {process : {"info" : events}}, each made from
+  at most 'step_size' entries of the input files. Chunks with no events passing 'good_events' are skipped.
+  Each chunk can be cut and reduced to the plotted variables before the next one is read,
+  so large samples (TT) no longer need to fit in memory at once.
+  With 'testing' only the first chunk with events of each read is used, for a quick check of the full chain.
+  '''
+  file_string = set_file_string(process, file_directory, file_map, log_file, direct_input)
+  try:
+    for file_strings, read_branches, missing_branches, cut in reconcile_branches(file_string, branches, good_events, log_file):
+      for processed_events in uproot.iterate(file_strings, read_branches, cut=cut,
+                                             step_size=step_size, library=library):
+        if len(processed_events["run"]) == 0: continue
+        processed_events = event_dictionary_from(processed_events, library)
+        yield {process : {"info" : fill_missing_branches(processed_events, missing_branches, library)}}
+        if testing: break
   except FileNotFoundError:
     log_print(text_options["yellow"] + "FILE NOT FOUND! " + text_options["reset"], log_file, end="")
     log_print(f"continuing without loading {file_string}...", log_file)
-    return None
-  process_list = {}
-  process_list[process] = {}
-  process_list[process]["info"] = processed_events
- 
-  return process_list
+
+
+# catalog of the ntuples in an input directory, see update_catalog
+catalog_version = 1
+
+def catalog_entry(input_file):
+  '''
+  Open 'input_file' once and return its catalog entry: number of entries, the sample normalization
+  (XSecMCweight and NWEvents of the first entry, None if the branch is missing or the file is empty)
+  and the branch schema. An unreadable file gets 0 entries and the error message.
+  '''
+  entry = {"size" : os.path.getsize(input_file), "mtime" : os.path.getmtime(input_file),
+           "entries" : 0, "XSecMCweight" : None, "NWEvents" : None, "branches" : {}}
+  try:
+    schema = branch_schema(input_file)
+    with uproot.open(input_file) as root_file:
+      tree = root_file["Events"]
+      entry["entries"] = int(tree.num_entries)
+      for normalization in ["XSecMCweight", "NWEvents"]:
+        if (normalization in schema) and (entry["entries"] > 0):
+          entry[normalization] = float(tree[normalization].array(entry_stop=1, library="np")[0])
+  except Exception as error:
+    entry["error"] = str(error)
+    return entry
+  entry["branches"] = schema_to_json(schema)
+  return entry
+
+
+def update_catalog(input_directory, catalog_path, log_file=None):
+  '''
+  Return the catalog of every .root file under 'input_directory', {path relative to it : entry from catalog_entry},
+  stored as json in 'catalog_path'. Only new files and files whose size or mtime changed are opened,
+  files that are gone are removed. The branch schemas are also put in branch_schema_cache,
+  so reconcile_branches does not open the files again.
+  '''
+  catalog = {}
+  if os.path.exists(catalog_path):
+    with open(catalog_path) as catalog_file:
+      stored = json.load(catalog_file)
+    if stored.get("version") == catalog_version: catalog = stored["files"]
+  updated = {}
+  for directory, _, file_names in os.walk(input_directory):
+    for file_name in sorted(file_names):
+      if not file_name.endswith(".root"): continue
+      input_file = os.path.join(directory, file_name)
+      relative_path = os.path.relpath(input_file, input_directory)
+      entry = catalog.get(relative_path)
+      if (entry == None) or (entry["size"] != os.path.getsize(input_file)) or (entry["mtime"] != os.path.getmtime(input_file)):
+        entry = catalog_entry(input_file)
+        if "error" in entry: log_print(f"Could not read {input_file}: {entry['error']}", log_file)
+      updated[relative_path] = entry
+  n_opened = sum(1 for path in updated if updated[path] is not catalog.get(path))
+  log_print(f"Catalog {catalog_path}: {len(updated)} files, {n_opened} new or changed", log_file, time=True)
+
+  if (updated != catalog) or (not os.path.exists(catalog_path)):
+    os.makedirs(os.path.dirname(catalog_path) or ".", exist_ok=True)
+    temporary_path = catalog_path + ".tmp"
+    with open(temporary_path, "w") as catalog_file:
+      json.dump({"version" : catalog_version, "files" : updated}, catalog_file, indent=1, sort_keys=True)
+    os.replace(temporary_path, catalog_path)
+
+  for relative_path, entry in updated.items():
+    if "error" in entry: continue
+    branch_schema_cache[os.path.join(input_directory, relative_path)] = (entry["mtime"], schema_from_json(entry["branches"]))
+  save_branch_schema_cache()
+  return updated
+
+
+def catalog_files(catalog, file_pattern):
+  '''
+  Return the catalog paths (without .root) matching 'file_pattern', a file map wildcard, like glob would,
+  and those of them that have no entries
+  '''
+  file_pattern = file_pattern + ".root"
+  matches = sorted(path for path in catalog
+                   if fnmatch.fnmatchcase(path, file_pattern) and (path.count("/") == file_pattern.count("/")))
+  empty   = [path[:-5] for path in matches if catalog[path]["entries"] == 0]
+  return [path[:-5] for path in matches], empty
+
+
+# the modules that decide which events pass the cuts, any edit to them invalidates the skim cache
+# the plotting modules are left out, so a change of binning or plot style reuses the cached skims,
+# and the choices of the plotting driver (region, branches, good_events...) are in the cache settings instead
+skim_cache_source_files = [
+  "cut_and_study_functions.py", "cut_ditau_functions.py", "cut_mutau_functions.py", "cut_etau_functions.py",
+  "cut_emu_functions.py", "cut_dimuon_functions.py", "columnar_functions.py", "calculate_functions.py",
+  "FF_functions.py", "FF_dictionary.py", "triggers_dictionary.py", "setup.py", "branch_functions.py",
+]
+cut_code_version = None
+
+def set_cut_code_version():
+  ''' sha256 of the files in skim_cache_source_files, computed once per run '''
+  global cut_code_version
+  if cut_code_version == None:
+    code_hash = hashlib.sha256()
+    for source_file in skim_cache_source_files:
+      with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source_file), "rb") as source:
+        code_hash.update(source.read())
+    cut_code_version = code_hash.hexdigest()
+  return cut_code_version
+
+
+def input_file_signature(file_string):
+  ''' (path, size, modification time) of every file matching 'file_string', which may contain wildcards '''
+  file_string = file_string.replace(":Events", "")
+  return [(input_file, os.path.getsize(input_file), os.path.getmtime(input_file))
+          for input_file in sorted(glob.glob(file_string))]
+
+
+def skim_cache_path(cache_directory, stage, process, file_string, settings):
+  '''
+  Return the cache file for the cut events of 'process' loaded from 'file_string'.
+  The name contains a hash of the input files (size and mtime), the cut code, and 'settings',
+  a dictionary of everything else that changes the selected events (era, final state, jet mode, branches...).
+  Returns None if no input file matches, so that missing files are reported by the usual loading path.
+  '''
+  signature = input_file_signature(file_string)
+  if len(signature) == 0: return None
+  key = json.dumps({"stage" : stage, "process" : process, "files" : signature,
+                    "settings" : settings, "code" : set_cut_code_version()}, sort_keys=True, default=str)
+  digest = hashlib.sha256(key.encode()).hexdigest()[:20]
+  return os.path.join(cache_directory, f"{process}_{stage}_{digest}.npz")
+
+
+def load_skim_cache(cache_path):
+  '''
+  Return (found, cut_events) for a skim cache file.
+  cut_events is None if the cached selection had no events, as returned by the cut functions.
+  '''
+  if (cache_path == None) or (not os.path.exists(cache_path)): return False, None
+  with np.load(cache_path, allow_pickle=True) as cached:
+    cut_events = {branch : cached[branch] for branch in cached.files}
+  if ("__no_events__" in cut_events): return True, None
+  return True, cut_events
+
+
+def save_skim_cache(cache_path, cut_events):
+  '''
+  Store the cut events (or None) in a compressed npz file. Jagged branches are stored as object arrays.
+  The file is written under a temporary name first, so an interrupted run cannot leave a partial cache.
+  '''
+  if cache_path == None: return
+  os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+  to_store = {"__no_events__" : np.zeros(0)} if cut_events == None else cut_events
+  temporary_path = f"{cache_path}.{os.getpid()}.tmp" # units or runs writing the same key do not share it
+  with open(temporary_path, "wb") as cache_file:
+    np.savez_compressed(cache_file, **{branch : to_object_array(values) if is_awkward(values) else np.asarray(values)
+                                       for branch, values in to_store.items()})
+  os.replace(temporary_path, cache_path)
 
 
 def sort_combined_processes(combined_processes_dictionary, fakes=False):
+  combined_processes_dictionary = concatenate_merge_pieces(combined_processes_dictionary)
   data_dictionary, background_dictionary, signal_dictionary = {}, {}, {}
   for process in combined_processes_dictionary:
     newProcess = process + "Fakes" if fakes==True else process
@@ -137,29 +532,159 @@ def append_to_combined_processes(process, cut_events, vars_to_plot, combined_pro
       combined_processes[process]["Cuts"][cut] = cut_events[cut]
 
   if one_file_at_a_time and process.endswith("_alt") and orig_process!="":
-    for key1 in combined_processes[orig_process]:
-      assert key1 in combined_processes[process]
-      if isinstance(combined_processes[orig_process][key1], dict):
-        for key2 in combined_processes[orig_process][key1]:
-          assert key2 in combined_processes[process][key1]
-          combined_processes[orig_process][key1][key2] = np.append(combined_processes[orig_process][key1][key2], combined_processes[process][key1][key2])
-      elif isinstance(combined_processes[orig_process][key1], np.ndarray):
-        combined_processes[orig_process][key1] = np.append(combined_processes[orig_process][key1], combined_processes[process][key1])
-      else:
-        print("I don't know what happened here ('append_to_combined_processes' in file_functions.py)")
-    del combined_processes[process]
+    combined_processes = merge_alt_process(orig_process, process, combined_processes)
+
+  return combined_processes
+
+
+def merge_alt_process(orig_process, alt_process, combined_processes):
+  '''
+  Queue every array of combined_processes[alt_process] to be appended to the same array of combined_processes[orig_process],
+  then remove alt_process. Used to merge the pieces (files or chunks) of one process.
+  The pieces are kept in a list and concatenated once by concatenate_merge_pieces, because appending them
+  one at a time copied everything merged so far for every new file.
+  '''
+  for key1 in combined_processes[orig_process]:
+    if key1 == "MergePieces": continue
+    assert key1 in combined_processes[alt_process]
+    if isinstance(combined_processes[orig_process][key1], dict):
+      for key2 in combined_processes[orig_process][key1]:
+        assert key2 in combined_processes[alt_process][key1]
+    elif not isinstance(combined_processes[orig_process][key1], np.ndarray):
+      print("I don't know what happened here ('append_to_combined_processes' in file_functions.py)")
+  alt_entry  = combined_processes.pop(alt_process)
+  alt_pieces = alt_entry.pop("MergePieces", []) # e.g. the chunks of one file, merged in a worker
+  combined_processes[orig_process].setdefault("MergePieces", []).extend([alt_entry] + alt_pieces)
+  return combined_processes
+
+
+def concatenate_pieces(pieces):
+  ''' Same as appending the arrays in 'pieces' one after the other with np.append, but copies each array only once '''
+  if len(pieces) == 1: return pieces[0]
+  return np.concatenate([np.ravel(piece) for piece in pieces])
 
+
+def concatenate_merge_pieces(combined_processes):
+  '''
+  Append the pieces queued by merge_alt_process to their process, with one concatenation per array.
+  Called by sort_combined_processes, so the process dictionaries are complete once they are sorted.
+  '''
+  for process in combined_processes:
+    pieces = combined_processes[process].pop("MergePieces", [])
+    if len(pieces) == 0: continue
+    for key1 in combined_processes[process]:
+      if isinstance(combined_processes[process][key1], dict):
+        for key2 in combined_processes[process][key1]:
+          combined_processes[process][key1][key2] = concatenate_pieces([combined_processes[process][key1][key2]]
+                                                                       + [piece[key1][key2] for piece in pieces])
+      elif isinstance(combined_processes[process][key1], np.ndarray):
+        combined_processes[process][key1] = concatenate_pieces([combined_processes[process][key1]]
+                                                               + [piece[key1] for piece in pieces])
+    del pieces
   return combined_processes
 
+
+def add_to_combined_processes(process, process_entry, combined_processes, one_file_at_a_time):
+  '''
+  Same as append_to_combined_processes for an entry that was already made by it,
+  e.g. one returned by a worker process when running with --jobs
+  '''
+  orig_process = ""
+  if process in combined_processes.keys():
+    if not one_file_at_a_time: print(f" !@#$%^&*&^%$#@! ADDING DUPLICATE PROCESS DATA FOR {process} NAMED {process}_alt !@#$%^&*&^%$#@!")
+    orig_process = process
+    process = process+"_alt"
+  combined_processes[process] = process_entry
+  if one_file_at_a_time and orig_process!="":
+    combined_processes = merge_alt_process(orig_process, process, combined_processes)
+  return combined_processes
+
+
+def run_work_units(work_function, work_units, jobs=1, unit_sizes=None, arguments=(), start_method=None):
+  '''
+  Call work_function(*unit, *arguments) for each unit in 'work_units' and yield (unit index, result).
+  With jobs <= 1 the units run here, in order. With jobs > 1 they run in a pool of 'jobs' worker processes,
+  largest 'unit_sizes' first so that the biggest samples do not start last, and the results are yielded
+  as they finish, so the caller should merge them by unit index to get an output independent of the timing.
+  work_function and 'arguments' are sent to the workers, so they have to be picklable and must not rely on
+  the globals of the main script; 'start_method' is the multiprocessing start method, the platform default if None.
+  '''
+  if jobs <= 1:
+    for unit_index, unit in enumerate(work_units):
+      yield unit_index, work_function(*unit, *arguments)
+    return
+  order = list(range(len(work_units)))
+  if unit_sizes != None: order = sorted(order, key=lambda i: unit_sizes[i], reverse=True)
+  sys.stdout.flush() # unflushed output would be printed again by every forked worker
+  sys.stderr.flush()
+  with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context(start_method)) as executor:
+    futures = {executor.submit(work_function, *work_units[i], *arguments) : i for i in order}
+    for future in as_completed(futures):
+      yield futures.pop(future), future.result()
+
+
+class FilePrefetcher:
+  '''
+  Runs the loads in 'planned_loads' (argument tuples of 'load_function') on a background thread,
+  in order, while the previous result is being cut. uproot releases the GIL while decompressing,
+  so reading the next file overlaps with the python loops on the current one.
+  At most 'depth' loads are started ahead of the one being used, which bounds the extra memory.
+  load() returns the result for its arguments, planned loads that were skipped (e.g. read from the skim cache)
+  are dropped, and loads that were not planned are done directly.
+  '''
+  def __init__(self, load_function, planned_loads, depth=1):
+    self.load_function = load_function
+    self.planned_loads = list(planned_loads)
+    self.depth         = depth
+    self.next_planned  = 0
+    self.pending       = OrderedDict() # arguments : future
+    self.executor      = ThreadPoolExecutor(max_workers=1)
+    self.start_next_loads()
+
+  def start_next_loads(self):
+    while (len(self.pending) < self.depth) and (self.next_planned < len(self.planned_loads)):
+      arguments = self.planned_loads[self.next_planned]
+      self.next_planned += 1
+      self.pending[arguments] = self.executor.submit(self.load_function, *arguments)
+
+  def load(self, *arguments):
+    if arguments in self.pending:
+      while True:
+        planned_arguments, future = self.pending.popitem(last=False)
+        if planned_arguments == arguments: break
+        future.cancel()
+      self.start_next_loads()
+      return future.result()
+    if arguments in self.planned_loads[self.next_planned:]:
+      # the loads started so far were skipped, continue the plan after this one
+      self.drop_pending()
+      self.next_planned += self.planned_loads[self.next_planned:].index(arguments) + 1
+      self.start_next_loads()
+    return self.load_function(*arguments)
+
+  def drop_pending(self):
+    for future in self.pending.values(): future.cancel()
+    self.pending.clear()
+
+  def close(self):
+    self.drop_pending()
+    self.executor.shutdown(wait=True)
+
+
 def load_and_store_NWEvents(process, event_dictionary):
   '''
   Read the NWEvents value for a sample and store it in the MC_dictionary,
   overriding the hardcoded values from V11 samples. Delete the NWEvents branch after.
   '''
-  MC_dictionary[process]["XSecMCweight"] = event_dictionary["XSecMCweight"][0]
+  store_XSecMCweight(process, event_dictionary["XSecMCweight"][0])
+
+
+def store_XSecMCweight(process, XSecMCweight):
+  ''' Store the XSecMCweight of a sample in the MC_dictionary, also for the DY gen splits '''
+  MC_dictionary[process]["XSecMCweight"] = XSecMCweight
   if ("DY" in process):
-    MC_dictionary[process+"DYGen"]["XSecMCweight"] = event_dictionary["XSecMCweight"][0]
-    MC_dictionary[process+"DYLep"]["XSecMCweight"] = event_dictionary["XSecMCweight"][0]
-    MC_dictionary[process+"DYJet"]["XSecMCweight"] = event_dictionary["XSecMCweight"][0]
+    MC_dictionary[process+"DYGen"]["XSecMCweight"] = XSecMCweight
+    MC_dictionary[process+"DYLep"]["XSecMCweight"] = XSecMCweight
+    MC_dictionary[process+"DYJet"]["XSecMCweight"] = XSecMCweight
 
 
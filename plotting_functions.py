@@ -1,5 +1,6 @@
 # libraries
 import numpy as np
+import weakref
 import matplotlib.pyplot as plt
 
 ### README
@@ -10,7 +11,7 @@ from binning_dictionary   import binning_dictionary, label_dictionary
 from triggers_dictionary  import triggers_dictionary
 
 from luminosity_dictionary import luminosities_with_normtag as luminosities
-from calculate_functions  import yields_for_CSV, calculate_underoverflow
+from calculate_functions  import yields_for_CSV, calculate_binned_values
 
 
 def make_pie_chart(data_hist, MC_dictionary, use_data=False, use_fakes=False):
@@ -611,13 +612,8 @@ def get_binned_info(final_state, testing, process_name, process_variable, xbins,
   #  print(len(process_variable), len(weights))
   #  print(process_variable)
   #  print(weights)
-  underflow, overflow, underflow_error, overflow_error = calculate_underoverflow(process_variable, xbins, weights, variable)
-  binned_values, _    = np.histogram(process_variable, xbins, weights=weights)
-  binned_values[0]   += underflow
-  binned_values[-1]  += overflow
-  binned_weight_2, _  = np.histogram(process_variable, xbins, weights=weights*weights)
-  binned_weight_2[0]  += underflow_error
-  binned_weight_2[-1] += overflow_error
+  # one pass over the events, under/overflow are added to the edge bins
+  binned_values, binned_weight_2 = calculate_binned_values(process_variable, xbins, weights, variable)
   return binned_values, binned_weight_2
 
 def get_weight_stats(process_name, process_weights):
@@ -639,23 +635,7 @@ def get_binned_process(final_state, testing, process_dictionary, variable, xbins
     process_variable = process_dictionary[process]["PlotEvents"][variable]
     process_mask = mask[process][mask_n] if mask_n != 999 else []
     if len(process_variable) == 0: continue
-    if ("Data" in process) and ("Fakes" not in process):
-      process_weights = np.ones(np.shape(process_variable)) # weights of one for data if not part of fakes estimate
-    elif ("Data" in process) and ("Fakes" in process):
-      # define process weights directly for Data
-      FF_weightQCD = process_dictionary[process]["FFweight_QCD"]*process_dictionary[process]["FFweight_FractionQCD"]
-      FF_weightWJ = process_dictionary[process]["FFweight_WJ"]*(1-process_dictionary[process]["FFweight_FractionQCD"])
-      process_weights = FF_weightQCD + FF_weightWJ
-      #process_weights = get_MC_weights(process_dictionary, process, add_weights=FF_weight)
-    elif ("Data" not in process) and (("Fakes" in process) or (process == "myQCD")):
-      # for signal and MC, get process weights as an option in the set_MC_weights function
-      try:
-        process_weights = get_MC_weights(process_dictionary, process, useFFweights=True)
-      except KeyError: # V3 and lower, preserving old behavior
-        process_weights = process_dictionary[process]["FF_weight"]
-        #process_weights = get_MC_weights(process_dictionary, process)
-    else:
-      process_weights = get_MC_weights(process_dictionary, process)
+    process_weights = get_process_weights(process_dictionary, process, np.shape(process_variable))
     h_processes[process] = {}
     binned_values, binned_errors = get_binned_info(final_state, testing, process, process_variable,
                                                    xbins_, process_weights, lumi_, process_mask, variable)
@@ -664,8 +644,109 @@ def get_binned_process(final_state, testing, process_dictionary, variable, xbins
   return h_processes
 
 
+# event weights already made by get_process_weights
+# {(id of the process entry, process) : (weak references to the arrays of the entry, shape, weights)}
+process_weight_cache = {}
+
+def get_process_weights(process_dictionary, process, shape):
+  '''
+  Event weights of a process for get_binned_process, 'shape' is the shape of its plotted variables.
+  The product of the weight arrays is made once per process and reused for every variable and mask,
+  until an array of the process entry is replaced (arrays modified in place are not noticed).
+  '''
+  entry  = process_dictionary[process]
+  inputs = [values for values in entry.values() if isinstance(values, np.ndarray)]
+  key    = (id(entry), process)
+  cached = process_weight_cache.get(key)
+  if ((cached != None) and (cached[1] == shape) and (len(cached[0]) == len(inputs))
+      and all(reference() is values for reference, values in zip(cached[0], inputs))):
+    return cached[2]
+  process_weights = make_process_weights(process_dictionary, process, shape)
+  # forget the weights of process entries that are gone
+  for stale_key in [key_ for key_, (references, _, _) in process_weight_cache.items()
+                    if any(reference() is None for reference in references)]:
+    del process_weight_cache[stale_key]
+  process_weight_cache[key] = ([weakref.ref(values) for values in inputs], shape, process_weights)
+  return process_weights
+
+
+def make_process_weights(process_dictionary, process, shape):
+  ''' Event weights of a process, see get_process_weights '''
+  if ("Data" in process) and ("Fakes" not in process):
+    process_weights = np.ones(shape) # weights of one for data if not part of fakes estimate
+  elif ("Data" in process) and ("Fakes" in process):
+    # define process weights directly for Data
+    FF_weightQCD = process_dictionary[process]["FFweight_QCD"]*process_dictionary[process]["FFweight_FractionQCD"]
+    FF_weightWJ = process_dictionary[process]["FFweight_WJ"]*(1-process_dictionary[process]["FFweight_FractionQCD"])
+    process_weights = FF_weightQCD + FF_weightWJ
+    #process_weights = get_MC_weights(process_dictionary, process, add_weights=FF_weight)
+  elif ("Data" not in process) and (("Fakes" in process) or (process == "myQCD")):
+    # for signal and MC, get process weights as an option in the set_MC_weights function
+    try:
+      process_weights = get_MC_weights(process_dictionary, process, useFFweights=True)
+    except KeyError: # V3 and lower, preserving old behavior
+      process_weights = process_dictionary[process]["FF_weight"]
+      #process_weights = get_MC_weights(process_dictionary, process)
+  else:
+    process_weights = get_MC_weights(process_dictionary, process)
+  return process_weights
+
+
+def get_binned_process_all_vars(final_state, testing, process_dictionary, variables, final_state_mode_bins, lumi_):
+  '''
+  Batch version of get_binned_process for every variable in 'variables', returns {variable : {process : hist}}.
+  The weights and scaling of each process are computed once, then each of its variables is histogrammed.
+  'final_state_mode_bins' is the final state used to look up the binning with make_bins.
+  '''
+  h_processes = {variable : {} for variable in variables}
+  for process in process_dictionary:
+    plot_events = process_dictionary[process]["PlotEvents"]
+    weights = None
+    for variable in variables:
+      process_variable = plot_events[variable]
+      if len(process_variable) == 0: continue
+      if weights is None:
+        process_weights = get_process_weights(process_dictionary, process, np.shape(process_variable))
+        skip_scaling = ("Data" in process) or ("Fakes" in process)
+        scaling = 1 if skip_scaling else set_MC_process_info(process, lumi_, scaling=True)[2]
+        if testing == True: scaling = adjust_scaling(final_state, process, scaling)
+        weights = scaling * process_weights
+      binned_values, binned_errors = calculate_binned_values(process_variable, make_bins(variable, final_state_mode_bins),
+                                                             weights, variable)
+      h_processes[variable][process] = {"BinnedEvents" : binned_values, "BinnedErrors" : binned_errors}
+  return h_processes
+
+
+def get_binned_all_vars(final_state_mode, testing, data_dictionary, background_dictionary, signal_dictionary,
+                        variables, lumi_, presentation_mode=False, userMC=[]):
+  '''
+  get_binned_data, get_binned_backgrounds and get_binned_signals for all 'variables' at once,
+  walking each process dictionary once instead of once per variable.
+  Returns {variable : {"Data" : h_data, "Backgrounds" : h_backgrounds, "Signals" : h_signals}},
+  each the same as what the single variable functions return (h_backgrounds is by family).
+  '''
+  variables = list(dict.fromkeys(variables))
+  h_data_by_dataset = get_binned_process_all_vars(final_state_mode, testing, data_dictionary, variables, final_state_mode, lumi_)
+  h_MC_by_process   = get_binned_process_all_vars(final_state_mode, testing, background_dictionary, variables, final_state_mode, lumi_)
+  h_signals         = get_binned_process_all_vars(final_state_mode, testing, signal_dictionary, variables, final_state_mode, lumi_)
+  binned = {}
+  for variable in variables:
+    binned[variable] = {
+      "Data"        : sum_binned_data(h_data_by_dataset[variable]),
+      "Backgrounds" : group_backgrounds_by_family(final_state_mode, h_MC_by_process[variable], presentation_mode,
+                                                  userMC),
+      "Signals"     : h_signals[variable],
+    }
+  return binned
+
+
 def get_binned_data(final_state, testing, data_dictionary, variable, xbins_, lumi_, mask={}, mask_n=999):
   h_data_by_dataset = get_binned_process(final_state, testing, data_dictionary, variable, xbins_, lumi_, mask, mask_n)
+  return sum_binned_data(h_data_by_dataset)
+
+
+def sum_binned_data(h_data_by_dataset):
+  ''' Add up the histograms of the datasets into one "Data" entry '''
   h_data = {}
   h_data["Data"] = {}
   first_key = list(h_data_by_dataset)[0]
@@ -696,7 +777,40 @@ def get_binned_backgrounds(final_state_mode, testing, background_dictionary, var
   skip_background_accumulation = False # DEBUG
   h_MC_by_process = get_binned_process(final_state_mode, testing, background_dictionary, variable, xbins_, lumi_, mask, mask_n)
   if (skip_background_accumulation): return h_MC_by_process
+  return group_backgrounds_by_family(final_state_mode, h_MC_by_process, presentation_mode, userMC)
+
 
+def group_backgrounds_by_family(final_state_mode, h_MC_by_process, presentation_mode=False, userMC=[]):
+  '''
+  Add up the MC histograms of each family, see get_binned_backgrounds.
+  The family of each process comes from background_family_table, which is only resolved once,
+  and each family histogram is one grouped sum over the stacked process histograms.
+  '''
+  MC_by_family = background_families(final_state_mode, presentation_mode, userMC)
+  family_of    = background_family_table(list(h_MC_by_process), MC_by_family, presentation_mode)
+
+  first_key = list(h_MC_by_process)[0]
+  family_index  = {family_name : i for i, family_name in enumerate(MC_by_family)}
+  process_rows  = [family_index[family_of[MC_process]] for MC_process in h_MC_by_process]
+  binned_events = np.zeros((len(MC_by_family), len(h_MC_by_process[first_key]["BinnedEvents"])))
+  binned_errors = np.zeros((len(MC_by_family), len(h_MC_by_process[first_key]["BinnedErrors"])))
+  # np.add.at adds the processes one after the other, in the same order as adding them one at a time
+  np.add.at(binned_events, process_rows, np.array([h_MC_by_process[MC_process]["BinnedEvents"] for MC_process in h_MC_by_process]))
+  np.add.at(binned_errors, process_rows, np.array([h_MC_by_process[MC_process]["BinnedErrors"] for MC_process in h_MC_by_process])) # TODO: add in quadrature
+
+  h_MC_by_family = {}
+  for family_name, i in family_index.items():
+    checksum = np.sum(binned_events[i])
+    if (checksum == 0): 
+      #print(f"MC family {family_name} has no events") # DEBUG
+      continue
+    h_MC_by_family[family_name] = {"BinnedEvents" : binned_events[i], "BinnedErrors" : binned_errors[i]}
+
+  return h_MC_by_family
+
+
+def background_families(final_state_mode, presentation_mode=False, userMC=[]):
+  ''' Families of the MC stack in stacking order, 'userMC' replaces the default ones. "Other" is always included '''
   # Note: Re-ordering of backgrounds in the stacked histogram can be done here by rearranging the processes in these lists
   if presentation_mode:
     keep_separate = {
@@ -716,56 +830,40 @@ def get_binned_backgrounds(final_state_mode, testing, background_dictionary, var
   MC_by_family = keep_separate[final_state_mode]
   if userMC!=[]: MC_by_family = userMC
   if "Other" not in MC_by_family: MC_by_family.append("Other")
+  return MC_by_family
 
-  # initialize empty family entries here
-  first_key = list(h_MC_by_process)[0]
-  h_MC_by_family = {}
-  for family_name in MC_by_family:
-    h_MC_by_family[family_name] = {}
-    h_MC_by_family[family_name]["BinnedEvents"] = np.zeros(len(h_MC_by_process[first_key]["BinnedEvents"]))
-    h_MC_by_family[family_name]["BinnedErrors"] = np.zeros(len(h_MC_by_process[first_key]["BinnedErrors"]))
- 
-  background_is_processed = {}
-  for MC_process in h_MC_by_process:
-    background_is_processed[MC_process] = False
-    for family_name in MC_by_family:
-      #print(family_name) # DEBUG
-      if   (not background_is_processed[MC_process]) and (family_name in MC_process):
-        h_MC_by_family[family_name]["BinnedEvents"] += h_MC_by_process[MC_process]["BinnedEvents"]
-        h_MC_by_family[family_name]["BinnedErrors"] += h_MC_by_process[MC_process]["BinnedErrors"]
-        background_is_processed[MC_process] = True
-      # allowing HWW to go into Other, if "HWW" is not a valid family name.
-      elif ( (not background_is_processed[MC_process]) and family_name=="HWW" 
-            and (np.any([hww_tag in MC_process for hww_tag in ["ggH_WW", "VBF_WW"]]))
-            and (not presentation_mode) ): # special handling for HWW when not in presentation mode
-        h_MC_by_family["HWW"]["BinnedEvents"] += h_MC_by_process[MC_process]["BinnedEvents"]
-        h_MC_by_family["HWW"]["BinnedErrors"] += h_MC_by_process[MC_process]["BinnedErrors"]
-        background_is_processed[MC_process] = True
-      elif ( (not background_is_processed[MC_process]) 
-            and (np.any([diboson_tag in MC_process for diboson_tag in ["WW", "WZ", "ZZ"] if "_WW" not in MC_process]))
-            and (not presentation_mode) ): # special handling for VV when not in presentation mode
-        h_MC_by_family["VV"]["BinnedEvents"] += h_MC_by_process[MC_process]["BinnedEvents"]
-        h_MC_by_family["VV"]["BinnedErrors"] += h_MC_by_process[MC_process]["BinnedErrors"]
-        background_is_processed[MC_process] = True
-      else: 
-        pass
-        # background_is_processed[MC_process] == True OR 
-        # current family name doesn't match sample, but a later one does
-        # for example, MC_process = DY0JNLO , but it has to go through families JetFakes, TT, ST, VV before DY
-    if (not background_is_processed[MC_process]) and (not np.any([family_name in MC_process for family_name in MC_by_family])):
-      h_MC_by_family["Other"]["BinnedEvents"] += h_MC_by_process[MC_process]["BinnedEvents"]
-      h_MC_by_family["Other"]["BinnedErrors"] += h_MC_by_process[MC_process]["BinnedErrors"] # TODO: add in quadrature
-      background_is_processed[MC_process] = True
-      #print(background_is_processed) # DEBUG
-  for process_key, is_processed in background_is_processed.items():
-    if (not is_processed): print(f"Warning! {process_key} wasn't processed! It's not part of the plot!")
+
+def background_family(MC_process, MC_by_family, presentation_mode=False):
+  '''
+  Family of one MC process: the first family (in stacking order) whose name is part of the process name.
+  Outside presentation mode, ggH_WW and VBF_WW go to HWW when it is a family, and WW, WZ, ZZ samples go to VV
+  as soon as the families before them do not match (for example, DY0JNLO has to go through JetFakes, TT, ST, VV before DY).
+  Processes matching no family go to Other.
+  '''
   for family_name in MC_by_family:
-    checksum = np.sum(h_MC_by_family[family_name]["BinnedEvents"])
-    if (checksum == 0): 
-      #print(f"MC family {family_name} has no events") # DEBUG
-      del h_MC_by_family[family_name]
+    if (family_name in MC_process):
+      return family_name
+    # allowing HWW to go into Other, if "HWW" is not a valid family name.
+    elif ((family_name == "HWW") and any(hww_tag in MC_process for hww_tag in ["ggH_WW", "VBF_WW"])
+          and (not presentation_mode)):
+      return "HWW"
+    elif (("_WW" not in MC_process) and any(diboson_tag in MC_process for diboson_tag in ["WW", "WZ", "ZZ"])
+          and (not presentation_mode)):
+      return "VV"
+  return "Other"
+
+
+# {(processes, families, presentation_mode) : {process : family}}, filled by background_family_table
+background_family_tables = {}
+
+def background_family_table(MC_processes, MC_by_family, presentation_mode=False):
+  ''' {process : family} for 'MC_processes', resolved once and reused for every variable (and every run of a loop) '''
+  key = (tuple(MC_processes), tuple(MC_by_family), presentation_mode)
+  if key not in background_family_tables:
+    background_family_tables[key] = {MC_process : background_family(MC_process, MC_by_family, presentation_mode)
+                                     for MC_process in MC_processes}
+  return background_family_tables[key]
 
-  return h_MC_by_family
 
 def get_summed_backgrounds(h_backgrounds):
   '''
@@ -5,9 +5,8 @@ from branch_functions import set_branches
 from plotting_functions import set_vars_to_plot
 from utility_functions import log_print
 from file_map_dictionary import set_dataset_info
-from file_functions import load_process_from_file
+from file_functions import load_process_from_file, FilePrefetcher, concatenate_pieces
 from cut_and_study_functions import apply_AR_cut
-import numpy as np
 import gc
 
 
@@ -43,27 +42,36 @@ def produce_FF_weight(setup, fakesLabel, jet_mode, semilep_mode):
       # Multiple entries per process, results from wildcard search
       input_files = glob.glob( using_directory + "/" + file_map[dataset] + ".root")
       input_files = sorted([f.replace(using_directory+"/","")[:-5] for f in input_files])
-    for input_file in input_files:
+    def load_file(input_file):
       this_file_map = {dataset: input_file} # Make a temporary filemap just for this loop
-      AR_process_dictionary = load_process_from_file(dataset, using_directory, this_file_map, log_file,
-                                              branches, AR_region, final_state_mode,
-                                              data=True, testing=testing)
+      return load_process_from_file(dataset, using_directory, this_file_map, log_file,
+                                    branches, AR_region, final_state_mode,
+                                    testing=testing)
+    # with --prefetch N the next files are read on a background thread while the current one is cut
+    prefetcher = None
+    if setup.prefetch > 0:
+      prefetcher = FilePrefetcher(load_file, [(input_file,) for input_file in input_files], depth=setup.prefetch)
+    FF_weight_pieces, PlotEvents_pieces = [], {}
+    for input_file in input_files:
+      AR_process_dictionary = prefetcher.load(input_file) if prefetcher != None else load_file(input_file)
       AR_events = AR_process_dictionary[dataset]["info"]
       cut_events_AR = apply_AR_cut(era, dataset, AR_events, final_state_mode, jet_mode, semilep_mode, DeepTau_version, tau_pt_cut)
-      if "FF_weight" not in FF_dictionary[fakesLabel]: # First file, or not doing one at a time
-        FF_dictionary[fakesLabel]["FF_weight"]  = cut_events_AR["FF_weight"]
-        for var in vars_to_plot:
-          if ("flav" in var) or ("Generator_weight" in var): continue
-          FF_dictionary[fakesLabel]["PlotEvents"][var] = cut_events_AR[var]
-      else:
-        FF_dictionary[fakesLabel]["FF_weight"]  = np.append(FF_dictionary[fakesLabel]["FF_weight"], cut_events_AR["FF_weight"])
-        for var in vars_to_plot:
-          if ("flav" in var): continue
-          FF_dictionary[fakesLabel]["PlotEvents"][var] = np.append(FF_dictionary[fakesLabel]["PlotEvents"][var], cut_events_AR[var])
+      # the arrays of each file are collected and concatenated once after the loop,
+      # appending them file by file copied everything collected so far for every new file
+      FF_weight_pieces.append(cut_events_AR["FF_weight"])
+      for var in vars_to_plot:
+        if ("flav" in var) or ("Generator_weight" in var): continue
+        PlotEvents_pieces.setdefault(var, []).append(cut_events_AR[var])
       del AR_process_dictionary
       del AR_events
       del cut_events_AR
       gc.collect()
+    if prefetcher != None: prefetcher.close()
+    if len(FF_weight_pieces) > 0:
+      FF_dictionary[fakesLabel]["FF_weight"] = concatenate_pieces(FF_weight_pieces)
+      for var, pieces in PlotEvents_pieces.items():
+        FF_dictionary[fakesLabel]["PlotEvents"][var] = concatenate_pieces(pieces)
+    del FF_weight_pieces, PlotEvents_pieces
 
     return FF_dictionary
 
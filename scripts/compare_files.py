@@ -122,12 +122,11 @@ if __name__ == "__main__":
       process_list.append(process + "_" + tag)
     else:
       process, tag = process.split("_") # grabs base name
-    data_tag = False if "Run" not in process else True
     branches     = set_branches(final_state_mode, DeepTau_version, process)
 
     new_process_dictionary = load_process_from_file(process, using_directory, file_map, log_file,
                                               branches, good_events, final_state_mode,
-                                              data=data_tag, testing=testing, direct_input=direct_input)
+                                              testing=testing, direct_input=direct_input)
     if new_process_dictionary == None: continue # skip process if empty
     cut_events = apply_HTT_FS_cuts_to_process(process, new_process_dictionary, log_file, final_state_mode, jet_mode,
                                               DeepTau_version=DeepTau_version)
@@ -22,6 +22,25 @@ class setup_handler:
     self.parser.add_argument('--presentation', dest='presentation_mode', default=False, action='store_true')
     self.parser.add_argument('--oneatatime',   dest='oneAtATime',  default=False,       action='store_true')
     self.parser.add_argument('--tau_pt',       dest='tau_pt_cut',  default="None",      action='store')
+    self.parser.add_argument('--single_pass',  dest='single_pass', default=False,       action='store_true',
+                             help='read each file once and split SR and AR in memory (standard_plot.py)')
+    self.parser.add_argument('--streaming',    dest='streaming',   default=False,       action='store_true',
+                             help='read files in chunks of --step_size entries (standard_plot.py)')
+    self.parser.add_argument('--step_size',    dest='step_size',   default=None, type=int, action='store',
+                             help='entries per chunk with --streaming, memory use scales with it (standard_plot.py)')
+    self.parser.add_argument('--skim_cache',   dest='skim_cache',  default=None,        action='store',
+                             help='directory to store and reuse the cut events of each file (standard_plot.py)')
+    self.parser.add_argument('--jobs',         dest='jobs',        default=1,  type=int, action='store',
+                             help='number of worker processes loading and cutting files (standard_plot.py)')
+    self.parser.add_argument('--start_method', dest='start_method', default=None,       action='store',
+                             choices=['fork', 'spawn', 'forkserver'],
+                             help='how the --jobs workers are started, the platform default if not set (standard_plot.py)')
+    self.parser.add_argument('--awkward',      dest='awkward',     default=False,       action='store_true',
+                             help='load jagged branches as awkward arrays instead of numpy object arrays (standard_plot.py)')
+    self.parser.add_argument('--prefetch',     dest='prefetch',    default=0,  type=int, action='store',
+                             help='number of files read ahead on a background thread (standard_plot.py, producers.py)')
+    self.parser.add_argument('--catalog',      dest='catalog',     default=None,        action='store',
+                             help='json catalog of the input files, made or updated at the start (standard_plot.py)')
     self.parser.add_argument('--temp_version', dest='temp_version', default="None",      action='store') # do not commit
 
 
@@ -53,6 +72,15 @@ class setup_handler:
     use_NLO       = args.use_NLO     # True by default, use LO DY if False
     file_map      = self.set_file_map(testing, use_NLO, era)
     oneAtATime    = args.oneAtATime
+    self.single_pass = args.single_pass # False by default, True loads the AR selection once and splits off the SR
+    self.streaming   = args.streaming   # False by default, True cuts each chunk of a file before reading the next
+    self.step_size   = args.step_size   # None by default (file_functions.streaming_step_size), entries per chunk when streaming
+    self.skim_cache  = args.skim_cache  # None by default, a directory enables the skim cache (not used when streaming)
+    self.jobs        = args.jobs        # 1 by default, number of files loaded and cut in parallel
+    self.start_method = args.start_method # None by default, multiprocessing start method of the --jobs workers
+    self.library     = "ak" if args.awkward else "np" # jagged branches as awkward or numpy object arrays
+    self.prefetch    = args.prefetch    # 0 by default, N reads up to N files ahead while the current one is cut
+    self.catalog     = args.catalog     # None by default, a json file path plans the work from the input file catalog
 
     # misc info
     hide_plots  = args.hide_plots  # False by default, show plots unless otherwise specified
@@ -167,12 +195,15 @@ def add_triggers_and_FS_to_good_events(good_events, final_state_mode, era):
   return good_events
 
 
-def set_good_events(final_state_mode, era, non_SR_region=False, temp_version="None", disable_triggers=False, useMiniIso=False):
+def set_good_events(final_state_mode, era, non_SR_region=False, temp_version="None", disable_triggers=False, useMiniIso=False,
+                    pushdown_SR=False):
   '''
   Return a string defining a 'good_events' flag used by uproot to preskim input events
   to only those passing these simple requirements. 'good_events' changes based on
   final_state_mode, and the trigger condition is removed if a trigger study is 
   being conducted (since requiring the trigger biases the study).
+  With 'pushdown_SR' the SR requirements on flat branches are added as well (see FF_functions.SR_pushdown_cut),
+  only use it when the events are cut to the SR afterwards.
   '''
   DEBUG = False
   if (DEBUG):
@@ -212,6 +243,9 @@ def set_good_events(final_state_mode, era, non_SR_region=False, temp_version="No
   good_events = add_triggers_and_FS_to_good_events(good_events, final_state_mode, era)
   if (non_SR_region): return good_events # give output with MET filters, lepton veto, veto maps, FS, and triggers
   good_events += " & (HTT_SRevent)" # preselected events from HTT ntuplizer
+  if (pushdown_SR):
+    from FF_functions import SR_pushdown_cut # not at the top, FF_functions imports this file
+    good_events += SR_pushdown_cut(final_state_mode)
 
   return good_events
 
@@ -6,7 +6,7 @@ import numpy as np
 import sys
 import matplotlib.pyplot as plt
 import gc
-import copy
+import functools
 import correctionlib
 
 # explicitly import used functions from user files, grouped roughly by call order and relatedness
@@ -15,17 +15,25 @@ from setup               import setup_handler, set_good_events
 from branch_functions    import set_branches
 from plotting_functions  import set_vars_to_plot
 from file_map_dictionary import set_dataset_info
+from MC_dictionary       import MC_dictionary
 
 # import statements for data loading and processing
 from file_functions          import load_process_from_file, append_to_combined_processes, sort_combined_processes
-from FF_functions            import set_JetFakes_process, FF_control_flow
+from file_functions          import iterate_process_from_file, load_and_store_NWEvents, streaming_step_size
+from file_functions          import skim_cache_path, load_skim_cache, save_skim_cache, input_file_signature
+from file_functions          import run_work_units, add_to_combined_processes
+from file_functions          import update_catalog, catalog_files, store_XSecMCweight
+from file_functions          import FilePrefetcher
+from FF_functions            import set_JetFakes_process, FF_control_flow, SR_pushdown_mask
 from cut_and_study_functions import apply_HTT_FS_cuts_to_process
-from cut_and_study_functions import apply_cut, set_protected_branches
+from cut_and_study_functions import apply_cut, split_DY_by_gen
+from columnar_functions      import EventTable, event_count
 
 # plotting
 from luminosity_dictionary import luminosities_with_normtag as luminosities
 from plotting_functions    import get_midpoints, make_eta_phi_plot
 from plotting_functions    import get_binned_data, get_binned_backgrounds, get_binned_signals, get_summed_backgrounds
+from plotting_functions    import get_binned_all_vars
 from plotting_functions    import setup_ratio_plot, make_ratio_plot, spruce_up_plot, spruce_up_legend
 from plotting_functions    import spruce_up_single_plot, add_text
 from plotting_functions    import plot_data, plot_MC, plot_signal, make_bins, make_pie_chart, make_two_dimensional_plot
@@ -38,9 +46,63 @@ from utility_functions     import time_print, make_directory, print_setup_info,
 
 from make_fitter_shapes    import save_fitter_shapes, make_masks_per_bin
 
-def add_HpT_correction(process, cut_events):
+# correction set of add_HpT_correction by era, and the correctionlib sets loaded so far (each worker loads its own)
+HpT_correction_file = "HpT_Gen_Reco_corr.json"
+HpT_correction_eras = {
+  "2022 CD"  : "2022preEE",
+  "2022 EFG" : "2022postEE",
+  "2023 C"   : "2023preBPix",
+  "2023 D"   : "2023postBPix",
+}
+HpT_correction_sets = {}
+
+class CutSettings:
+  '''
+  Settings of the main block that are needed to load and cut one input file.
+  They are passed explicitly to the per-file functions below instead of being read from the main block,
+  so process_file_unit also runs in worker processes started with spawn (--jobs).
+  The log file is not sent to workers, each work unit logs to its own buffer (see process_file_unit).
+  '''
+  def __init__(self, setup, region, good_events, AR_good_events, vars_to_plot, log_file):
+    testing, final_state_mode, jet_mode, era, _, tau_pt_cut = setup.state_info
+    using_directory, _, _, _, _, one_file_at_a_time, temp_version = setup.file_info
+    _, _, DeepTau_version, _, semilep_mode, _, _ = setup.misc_info
+    self.testing          = testing
+    self.final_state_mode = final_state_mode
+    self.jet_mode         = jet_mode
+    self.era              = era
+    self.tau_pt_cut       = tau_pt_cut
+    self.DeepTau_version  = DeepTau_version
+    self.semilep_mode     = semilep_mode
+    self.temp_version     = temp_version
+    self.using_directory  = using_directory
+    self.region           = region
+    self.good_events      = good_events
+    self.AR_good_events   = AR_good_events
+    self.vars_to_plot     = vars_to_plot
+    self.single_pass      = setup.single_pass
+    self.streaming        = setup.streaming
+    self.step_size        = streaming_step_size if setup.step_size == None else setup.step_size
+    self.skim_cache       = setup.skim_cache
+    self.library          = setup.library
+    self.correctionEra    = HpT_correction_eras[era]
+    # pieces of the same process (files or chunks) are merged by append_to_combined_processes
+    self.append_one_at_a_time = one_file_at_a_time or setup.streaming
+    self.log_file         = log_file
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["log_file"] = None # an open file can not be sent to a worker process
+    return state
+
+
+def add_HpT_correction(process, cut_events, settings):
   # add H_pT correction to all samples
   # for signal, use ggH or VBF as necessary. For others, average the correction.
+  if HpT_correction_file not in HpT_correction_sets:
+    HpT_correction_sets[HpT_correction_file] = correctionlib.CorrectionSet.from_file(HpT_correction_file)
+  cevalHpT = HpT_correction_sets[HpT_correction_file]
+  correctionEra = settings.correctionEra
   recoHpT = cut_events["HTT_H_pt"]
   nCleanJet = cut_events["nCleanJet"]
   correctionJetMode = np.array([0 if nJet == 0 else 1 for nJet in nCleanJet])
@@ -56,6 +118,330 @@ def add_HpT_correction(process, cut_events):
   cut_events["HTT_H_pt_corr"] = recoHpT*val
   return cut_events
 
+def files_to_process(file_map, reject_datasets, semilep_mode, using_directory, one_file_at_a_time, catalog=None,
+                     log_file=None):
+  '''
+  Yield (process, input_file) for every file that should be loaded.
+  Rejected datasets and WJ backgrounds already covered by JetFakes are skipped.
+  With a 'catalog' (see update_catalog) files are matched in it instead of the directory. With one_file_at_a_time
+  empty files are skipped, otherwise the wildcard is still loaded (empty files add no events)
+  unless every file of the process is empty.
+  '''
+  for process in file_map: 
+
+    # This line skips Muon_Run* when processing the ditau final state, for example 
+    if (process in reject_datasets): continue
+
+    # This line skips WJ backgrounds if the semilep_mode is set to indicate it is already considered in JetFakes
+    if ("WJ" in process) and (("WJ" in semilep_mode) or ("Full" in semilep_mode)): continue
+
+    if catalog != None:
+      matched_files, empty_files = catalog_files(catalog, file_map[process])
+      input_files = [input_file for input_file in matched_files if input_file not in empty_files]
+      if one_file_at_a_time:
+        if len(empty_files) > 0: log_print(f"Skipping empty files {empty_files}", log_file)
+      elif len(input_files) > 0:
+        input_files = [file_map[process]]
+      elif len(empty_files) > 0:
+        log_print(f"Skipping {process}, all of its files are empty {empty_files}", log_file)
+    elif not one_file_at_a_time:
+      # One single entry per process, probably containing wildcard symbol, as defined in file_map_dictionary.py
+      input_files = [file_map[process]]
+    else:
+      # Multiple entries per process, results from wildcard search
+      import glob
+      input_files = glob.glob( using_directory + "/" + file_map[process] + ".root")
+      input_files = sorted([f.replace(using_directory+"/","")[:-5] for f in input_files])
+
+    for input_file in input_files:
+      yield process, input_file
+
+
+def load_process_chunks(process, input_file, branches, good_events, settings, prefetcher=None):
+  '''
+  Return the loaded process dictionaries of one input file: a single one, or one per chunk when streaming.
+  '''
+  this_file_map = {process: input_file} # Make a temporary filemap just for this file
+  if settings.streaming:
+    return iterate_process_from_file(process, settings.using_directory, this_file_map, settings.log_file,
+                                     branches, good_events, settings.final_state_mode,
+                                     testing=settings.testing, step_size=settings.step_size, library=settings.library)
+  if prefetcher != None:
+    new_process_dictionary = prefetcher.load(process, input_file, tuple(branches), good_events)
+  else:
+    new_process_dictionary = load_file(process, input_file, branches, good_events, settings)
+  return [] if new_process_dictionary == None else [new_process_dictionary]
+
+
+def load_file(process, input_file, branches, good_events, settings):
+  ''' Load one input file without streaming, this is what the prefetcher runs on its thread '''
+  this_file_map = {process: input_file} # Make a temporary filemap just for this file
+  return load_process_from_file(process, settings.using_directory, this_file_map, settings.log_file,
+                                list(branches), good_events, settings.final_state_mode,
+                                testing=settings.testing, library=settings.library)
+
+
+def unit_branches(process, settings):
+  ''' branches to load for the files of 'process' '''
+  return set_branches(settings.final_state_mode, settings.era, settings.DeepTau_version, process,
+                      temp_version=settings.temp_version, vars_to_plot=settings.vars_to_plot)
+
+
+def planned_loads(work_units, settings):
+  '''
+  Return the arguments of load_file for every load the main loop will make, in order, for the prefetcher.
+  Loads that the skim cache already covers are left out.
+  '''
+  import os
+  loads = []
+  for process, input_file in work_units:
+    branches = unit_branches(process, settings)
+    cached = {stage : (cache_file != None) and os.path.exists(cache_file) for stage, cache_file in
+              [("SR", skim_cache_file("SR", process, input_file, branches, settings.good_events, settings)),
+               ("AR", skim_cache_file("AR", process, input_file, branches, settings.AR_good_events, settings))]}
+    if settings.single_pass:
+      if not (cached["SR"] and cached["AR"]):
+        loads.append((process, input_file, tuple(branches + ["HTT_SRevent"]), settings.AR_good_events))
+    else:
+      if not cached["SR"]: loads.append((process, input_file, tuple(branches), settings.good_events))
+      if not cached["AR"]: loads.append((process, input_file, tuple(branches), settings.AR_good_events))
+  return loads
+
+
+def split_SR_events(process, new_process_dictionary, settings):
+  '''
+  Return a new process dictionary holding only the HTT_SRevent events of one loaded with the looser
+  (non-SR) good_events that also pass the pushed down SR requirements.
+  This is the same set of events as loading with the SR good_events, in the same order.
+  '''
+  event_dictionary = new_process_dictionary[process]["info"]
+  SR_mask = (np.asarray(event_dictionary["HTT_SRevent"], dtype=bool)
+             & SR_pushdown_mask(event_dictionary, settings.final_state_mode))
+  SR_events = {branch : values[SR_mask] for branch, values in event_dictionary.items()}
+  return {process : {"info" : SR_events}}
+
+
+def apply_SR_cuts(process, new_process_dictionary, settings):
+  ''' Apply the final state and jet cuts to a loaded file, returns the cut events or None '''
+  return apply_HTT_FS_cuts_to_process(settings.era, process, new_process_dictionary, settings.log_file,
+                                      settings.final_state_mode, settings.jet_mode,
+                                      settings.DeepTau_version, settings.tau_pt_cut)
+
+
+def add_SR_events(process, cut_events, combined_process_dictionary, settings):
+  '''
+  Add the cut events of a file (from apply_SR_cuts) to combined_process_dictionary.
+  DY is split by gen flavor.
+  '''
+  if cut_events == None: return combined_process_dictionary
+
+  cut_events = add_HpT_correction(process, cut_events, settings)
+  vars_to_plot, append_one_at_a_time = settings.vars_to_plot, settings.append_one_at_a_time
+
+  if ("DY" in process) and (settings.final_state_mode != "dimuon"):
+    DY_splits = split_DY_by_gen(cut_events)
+    if DY_splits == None: return combined_process_dictionary
+    background_gen, background_lep, background_jet = DY_splits
+
+    combined_process_dictionary = append_to_combined_processes(process+"DYGen", background_gen, 
+                                         vars_to_plot, combined_process_dictionary, append_one_at_a_time)
+    combined_process_dictionary = append_to_combined_processes(process+"DYLep", background_lep, 
+                                         vars_to_plot, combined_process_dictionary, append_one_at_a_time)
+    combined_process_dictionary = append_to_combined_processes(process+"DYJet", background_jet, 
+                                         vars_to_plot, combined_process_dictionary, append_one_at_a_time)
+    del background_gen
+    del background_lep
+    del background_jet
+  else:
+    combined_process_dictionary = append_to_combined_processes(process, cut_events, vars_to_plot, 
+                                                               combined_process_dictionary, append_one_at_a_time)
+  return combined_process_dictionary
+
+
+def apply_AR_cuts(process, new_process_dictionary, settings):
+  '''
+  Select the FF region (settings.region, AR or AR_star) from a file loaded with the non-SR good_events and apply the
+  final state and jet cuts, returns the cut events or None.
+  '''
+  event_dictionary = new_process_dictionary[process]["info"]
+  if (event_dictionary == None): return None
+  era, final_state_mode, jet_mode = settings.era, settings.final_state_mode, settings.jet_mode
+  DeepTau_version, region = settings.DeepTau_version, settings.region
+
+  from cut_and_study_functions import append_lepton_indices, append_flavor_indices
+  # knows which branches to cut, and only copies them when read
+  event_dictionary = EventTable(event_dictionary, event_count(event_dictionary))
+  event_dictionary = append_lepton_indices(event_dictionary)
+  if ("Data" not in process):
+    from file_functions import load_and_store_NWEvents
+    load_and_store_NWEvents(process, event_dictionary)
+    # Remove fakes from MC if they come from TT or WJ samples.
+    # We do this because we assume their jetFakes are not well-modeled
+    # and so we replace them with the JetFakes estimate from Data.
+    # For other MC, we use the fakes from MC, meaning those should be subtracted from Data
+    # during the estimate.
+    keep_fakes = False if (("TT" in process) or ("WJ" in process)) else True
+    event_dictionary = append_flavor_indices(event_dictionary, final_state_mode, keep_fakes=keep_fakes)
+    event_dictionary = apply_cut(event_dictionary, "pass_gen_cuts")
+    if (event_dictionary==None or len(event_dictionary["run"])==0): return None
+
+  event_dictionary = FF_control_flow(final_state_mode, settings.semilep_mode, region, event_dictionary, DeepTau_version)
+  event_dictionary = apply_cut(event_dictionary, "pass_"+region+"_cuts")
+
+  if (event_dictionary==None or len(event_dictionary["run"])==0): return None
+  from cut_and_study_functions import apply_jet_cut
+  event_dictionary   = apply_jet_cut(event_dictionary, jet_mode)
+  if (event_dictionary==None or len(event_dictionary["run"])==0): return None
+
+  skip_DeepTau = True
+  if (final_state_mode == "ditau"):
+    from cut_ditau_functions import make_ditau_cut
+    event_dictionary   = make_ditau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau, settings.tau_pt_cut)
+    if (event_dictionary==None or len(event_dictionary["run"])==0): return None
+
+  if (final_state_mode == "mutau"):
+    from cut_mutau_functions import make_mutau_cut
+    event_dictionary   = make_mutau_cut(era, event_dictionary, DeepTau_version)
+    if (event_dictionary==None or len(event_dictionary["run"])==0): return None
+
+  if (final_state_mode == "etau"):
+    from cut_etau_functions import make_etau_cut
+    event_dictionary   = make_etau_cut(era, event_dictionary, DeepTau_version)
+    if (event_dictionary==None or len(event_dictionary["run"])==0): return None
+
+  event_dictionary   = apply_cut(event_dictionary, "pass_cuts")
+  if (event_dictionary==None or len(event_dictionary["run"])==0): return None
+  return event_dictionary
+
+
+def add_AR_events(process, cut_events, combined_process_dictionaryFakes, settings):
+  ''' Add the cut events of a file (from apply_AR_cuts) to combined_process_dictionaryFakes '''
+  if cut_events == None: return combined_process_dictionaryFakes
+  # skip DY splitting stuff because we subtract MC from Data later where the MC is all combined anyways
+
+  cut_events = add_HpT_correction(process, cut_events, settings)
+
+  combined_process_dictionaryFakes = append_to_combined_processes(process, cut_events, settings.vars_to_plot, 
+                                                         combined_process_dictionaryFakes, settings.append_one_at_a_time)
+  return combined_process_dictionaryFakes
+
+
+def skim_cache_file(stage, process, input_file, branches, good_events, settings):
+  '''
+  Return the skim cache file for the SR or AR ('stage') cut events of one input file, or None if the cache is off.
+  Every setting of this script that changes which events are selected goes in the cache key here,
+  since standard_plot.py itself is not hashed (see file_functions.skim_cache_source_files).
+  '''
+  if (settings.skim_cache == None) or settings.streaming: return None
+  cache_settings = {"era" : settings.era, "final_state_mode" : settings.final_state_mode, "jet_mode" : settings.jet_mode,
+                    "DeepTau_version" : settings.DeepTau_version, "tau_pt_cut" : settings.tau_pt_cut,
+                    "temp_version" : settings.temp_version, "semilep_mode" : settings.semilep_mode,
+                    "region" : settings.region, "branches" : branches, "good_events" : good_events,
+                    "library" : settings.library}
+  return skim_cache_path(settings.skim_cache, stage, process, settings.using_directory + "/" + input_file + ".root",
+                         cache_settings)
+
+
+def load_cached_cut_events(stage, process, cache_file, settings):
+  '''
+  Return (found, cut_events) from the skim cache.
+  The cut functions store the sample normalization in MC_dictionary while cutting,
+  so that is redone here from the cached events.
+  '''
+  found, cut_events = load_skim_cache(cache_file)
+  if found: log_print(f"Loaded {stage} {process} from skim cache {cache_file}", settings.log_file, time=True)
+  if found and (cut_events != None) and ("Data" not in process):
+    if (stage == "SR") and (settings.final_state_mode != "dimuon"):
+      load_and_store_NWEvents("TTToSemiLeptonic" if "TTToSemiLeptonic" in process else process, cut_events)
+    elif (stage == "AR"):
+      load_and_store_NWEvents(process, cut_events)
+  return found, cut_events
+
+
+def cut_events_per_file(stage, process, input_file, branches, good_events, settings, prefetcher=None):
+  '''
+  Yield the SR or AR ('stage') cut events of one input file, one per chunk when streaming.
+  With --skim_cache, the cut events are read from the cache if it is up to date, and stored otherwise.
+  '''
+  apply_cuts = apply_SR_cuts if stage == "SR" else apply_AR_cuts
+  cache_file = skim_cache_file(stage, process, input_file, branches, good_events, settings)
+  found, cut_events = load_cached_cut_events(stage, process, cache_file, settings)
+  if found:
+    yield cut_events
+    return
+  for new_process_dictionary in load_process_chunks(process, input_file, branches, good_events, settings, prefetcher):
+    cut_events = apply_cuts(process, new_process_dictionary, settings)
+    del new_process_dictionary
+    save_skim_cache(cache_file, cut_events)
+    yield cut_events
+
+
+def single_pass_cut_events_per_file(process, input_file, branches, settings, prefetcher=None):
+  '''
+  Yield (SR cut events, AR cut events) for one input file read once with the AR selection, see --single_pass.
+  Both are read from the skim cache if available, which uses the same cache files as the two pass mode.
+  '''
+  SR_cache_file = skim_cache_file("SR", process, input_file, branches, settings.good_events, settings)
+  AR_cache_file = skim_cache_file("AR", process, input_file, branches, settings.AR_good_events, settings)
+  found_SR, SR_cut_events = load_cached_cut_events("SR", process, SR_cache_file, settings)
+  found_AR, AR_cut_events = load_cached_cut_events("AR", process, AR_cache_file, settings)
+  if found_SR and found_AR:
+    yield SR_cut_events, AR_cut_events
+    return
+  for new_process_dictionary in load_process_chunks(process, input_file, branches + ["HTT_SRevent"],
+                                                    settings.AR_good_events, settings, prefetcher):
+    SR_cut_events = apply_SR_cuts(process, split_SR_events(process, new_process_dictionary, settings), settings)
+    AR_cut_events = apply_AR_cuts(process, new_process_dictionary, settings)
+    del new_process_dictionary
+    save_skim_cache(SR_cache_file, SR_cut_events)
+    save_skim_cache(AR_cache_file, AR_cut_events)
+    yield SR_cut_events, AR_cut_events
+
+
+def process_file_unit(process, input_file, settings, prefetcher=None):
+  '''
+  Work unit of the main loop: cut one input file for the SR and the AR and return the combined process
+  dictionaries of that file alone, the MC_dictionary normalizations changed while cutting, vars_to_plot,
+  and the lines logged while cutting in a worker, which the main process writes to its log file.
+  With --jobs N this runs in a worker process, so the returned values are all the main process gets back.
+  Run in the main process (--jobs 1), the unit logs straight to the log file so progress shows while it runs.
+  '''
+  import copy, io, multiprocessing
+  unit_log = io.StringIO()
+  if multiprocessing.parent_process() != None: # pool worker, the log file stays with the main process
+    settings = copy.copy(settings)
+    settings.log_file = unit_log
+  unit_dictionary, unit_dictionaryFakes = {}, {}
+  XSec_before = {name : info.get("XSecMCweight") for name, info in MC_dictionary.items()}
+  branches = unit_branches(process, settings)
+  if settings.single_pass:
+    # the file is read once with the AR selection (the SR selection without HTT_SRevent),
+    # and the SR events are split off in memory
+    for SR_cut_events, AR_cut_events in single_pass_cut_events_per_file(process, input_file, branches, settings,
+                                                                        prefetcher):
+      unit_dictionary = add_SR_events(process, SR_cut_events, unit_dictionary, settings)
+      unit_dictionaryFakes = add_AR_events(process, AR_cut_events, unit_dictionaryFakes, settings)
+      del SR_cut_events, AR_cut_events
+      gc.collect()
+
+  else:
+    for cut_events in cut_events_per_file("SR", process, input_file, branches, settings.good_events, settings,
+                                          prefetcher):
+      unit_dictionary = add_SR_events(process, cut_events, unit_dictionary, settings)
+      del cut_events
+      gc.collect()
+
+    for cut_events in cut_events_per_file("AR", process, input_file, branches, settings.AR_good_events, settings,
+                                          prefetcher):
+      unit_dictionaryFakes = add_AR_events(process, cut_events, unit_dictionaryFakes, settings)
+      del cut_events
+      gc.collect()
+
+  XSec_updates = {name : info["XSecMCweight"] for name, info in MC_dictionary.items()
+                  if info.get("XSecMCweight") != XSec_before[name]}
+  return unit_dictionary, unit_dictionaryFakes, XSec_updates, settings.vars_to_plot, unit_log.getvalue()
+
+
 if __name__ == "__main__":
   '''
   Just read the code, it speaks for itself.
@@ -85,106 +471,24 @@ if __name__ == "__main__":
   testing, final_state_mode, jet_mode, era, lumi, tau_pt_cut = setup.state_info
   using_directory, plot_dir, log_file, use_NLO, file_map, one_file_at_a_time, temp_version = setup.file_info
   hide_plots, hide_yields, DeepTau_version, do_JetFakes, semilep_mode, _, presentation_mode = setup.misc_info
-  if one_file_at_a_time: import glob
+  jobs        = setup.jobs
+  prefetch    = setup.prefetch
+  catalog     = None if setup.catalog == None else update_catalog(using_directory, setup.catalog, log_file)
+  # pieces of the same process (files or chunks) are merged by append_to_combined_processes
+  append_one_at_a_time = one_file_at_a_time or setup.streaming
 
   print_setup_info(setup)
   # used for printing, might be different from what is called per process
-  good_events  = set_good_events(final_state_mode, era, non_SR_region=False, temp_version=temp_version)
-  branches     = set_branches(final_state_mode, era, DeepTau_version, "ggH_TauTau", temp_version=temp_version)
+  good_events  = set_good_events(final_state_mode, era, non_SR_region=False, temp_version=temp_version,
+                                 pushdown_SR=True)
   vars_to_plot = set_vars_to_plot(final_state_mode, jet_mode=jet_mode)
+  branches     = set_branches(final_state_mode, era, DeepTau_version, "ggH_TauTau", temp_version=temp_version,
+                              vars_to_plot=vars_to_plot)
   print_processing_info(good_events, branches, vars_to_plot, log_file)
 
   _, reject_datasets = set_dataset_info(final_state_mode)
 
-  # make and apply cuts to any loaded events, store in new dictionaries for plotting
-  combined_process_dictionary = {}
-  # load corrections to apply
-  cevalHpT = correctionlib.CorrectionSet.from_file("HpT_Gen_Reco_corr.json")
-
-  eraConversionMap = {
-   "2022 CD"  : "2022preEE",
-   "2022 EFG" : "2022postEE",
-   "2023 C"   : "2023preBPix",
-   "2023 D"   : "2023postBPix",
-  }
-  correctionEra = eraConversionMap[era]
-
-  for process in file_map: 
-
-    # being reset each run, but they're literally strings so who cares
-    branches     = set_branches(final_state_mode, era, DeepTau_version, process, temp_version=temp_version)
-
-    # This line skips Muon_Run* when processing the ditau final state, for example 
-    if (process in reject_datasets): continue
-
-    # This line skips WJ backgrounds if the semilep_mode is set to indicate it is already considered in JetFakes
-    if ("WJ" in process) and (("WJ" in semilep_mode) or ("Full" in semilep_mode)): continue
-
-    if not one_file_at_a_time:
-      # One single entry per process, probably containing wildcard symbol, as defined in file_map_dictionary.py
-      input_files = [file_map[process]]
-    else:
-      # Multiple entries per process, results from wildcard search
-      input_files = glob.glob( using_directory + "/" + file_map[process] + ".root")
-      input_files = sorted([f.replace(using_directory+"/","")[:-5] for f in input_files])
-
-    for input_file in input_files:
-      this_file_map = {process: input_file} # Make a temporary filemap just for this loop
-      new_process_dictionary = load_process_from_file(process, using_directory, this_file_map, log_file,
-                                                branches, good_events, final_state_mode,
-                                                data=("Data" in process), testing=testing)
-      if new_process_dictionary == None: continue # skip process if empty
-
-      cut_events = apply_HTT_FS_cuts_to_process(era, process, new_process_dictionary, log_file, final_state_mode, jet_mode,
-                                                DeepTau_version, tau_pt_cut)
-
-      if cut_events == None: continue
-
-      cut_events = add_HpT_correction(process, cut_events)
-
-      if ("DY" in process) and (final_state_mode != "dimuon"):
-        # def split_DY_by_gen, return combined_process_dictionary
-        event_flavor_arr = cut_events["event_flavor"]
-        pass_gen_flav, pass_lep_flav, pass_jet_flav = [], [], []
-        for i, event_flavor in enumerate(event_flavor_arr):
-          if event_flavor == "G": pass_gen_flav.append(i)
-          if event_flavor == "L": pass_lep_flav.append(i)
-          if event_flavor == "J": pass_jet_flav.append(i)
-    
-        protected_branches = set_protected_branches(final_state_mode="none", jet_mode="Inclusive")
-        background_gen_deepcopy = copy.deepcopy(cut_events)
-        background_gen_deepcopy["pass_flavor_cut"] = np.array(pass_gen_flav)
-        background_gen_deepcopy = apply_cut(background_gen_deepcopy, "pass_flavor_cut", protected_branches)
-        if background_gen_deepcopy == None: continue
-
-        background_lep_deepcopy = copy.deepcopy(cut_events)
-        background_lep_deepcopy["pass_flavor_cut"] = np.array(pass_lep_flav)
-        background_lep_deepcopy = apply_cut(background_lep_deepcopy, "pass_flavor_cut", protected_branches)
-        if background_lep_deepcopy == None: continue
-
-        background_jet_deepcopy = copy.deepcopy(cut_events)
-        background_jet_deepcopy["pass_flavor_cut"] = np.array(pass_jet_flav)
-        background_jet_deepcopy = apply_cut(background_jet_deepcopy, "pass_flavor_cut", protected_branches)
-        if background_jet_deepcopy == None: continue
-
-        combined_process_dictionary = append_to_combined_processes(process+"DYGen", background_gen_deepcopy, 
-                                             vars_to_plot, combined_process_dictionary, one_file_at_a_time)
-        combined_process_dictionary = append_to_combined_processes(process+"DYLep", background_lep_deepcopy, 
-                                             vars_to_plot, combined_process_dictionary, one_file_at_a_time)
-        combined_process_dictionary = append_to_combined_processes(process+"DYJet", background_jet_deepcopy, 
-                                             vars_to_plot, combined_process_dictionary, one_file_at_a_time)
-        del background_gen_deepcopy
-        del background_lep_deepcopy
-        del background_jet_deepcopy
-      else:
-        combined_process_dictionary = append_to_combined_processes(process, cut_events, vars_to_plot, 
-                                                                   combined_process_dictionary, one_file_at_a_time)
-      del new_process_dictionary
-      del cut_events
-      gc.collect()
-
-  # after loop, sort big dictionary into three smaller ones
-  data_dictionary, background_dictionary, signal_dictionary = sort_combined_processes(combined_process_dictionary)
+  # the H_pT correction (add_HpT_correction) is loaded from HpT_correction_file when first used
 
   fakesLabel = "JetFakes"
 
@@ -206,101 +510,75 @@ if __name__ == "__main__":
   region = "AR_star" # AR_star for DiTau (which is ARPF + ARFP + ARFF), and AR for mutau/etau
   if (final_state_mode == "mutau") or (final_state_mode == "etau"): region = "AR"
   non_SR_region = ("AR" in region) or ("DR" in region) or ("aiso" in region) or ("combined" in region)
-  good_events  = set_good_events(final_state_mode, era, non_SR_region)
+  AR_good_events = set_good_events(final_state_mode, era, non_SR_region)
 
   # make and apply cuts to any loaded events, store in new dictionaries for plotting
+  # combined_process_dictionary holds the SR, combined_process_dictionaryFakes the AR used for JetFakes
+  # each (process, input_file) is one work unit, run in parallel with --jobs N
+  # results are kept by unit index as they finish and merged in file map order once all are done,
+  # so a slow file does not hold up the others and the output does not depend on the number of jobs
+  settings = CutSettings(setup, region, good_events, AR_good_events, vars_to_plot, log_file)
+  combined_process_dictionary = {}
   combined_process_dictionaryFakes = {}
-  for process in file_map: 
-
-    branches     = set_branches(final_state_mode, era, DeepTau_version, process, temp_version=temp_version)
-
-    if (process in reject_datasets): continue
-    if ("WJ" in process) and (("WJ" in semilep_mode) or ("Full" in semilep_mode)): continue
-
-    if not one_file_at_a_time:
-      input_files = [file_map[process]]
-    else:
-      input_files = glob.glob( using_directory + "/" + file_map[process] + ".root")
-      input_files = sorted([f.replace(using_directory+"/","")[:-5] for f in input_files])
-
-    for input_file in input_files:
-      this_file_map = {process: input_file}
-      new_process_dictionary = load_process_from_file(process, using_directory, this_file_map, log_file,
-                                            branches, good_events, final_state_mode,
-                                            data=("Data" in process), testing=testing)
-      event_dictionary = new_process_dictionary[process]["info"]
-      if (event_dictionary == None): continue
-
-      protected_branches = ["None"]
-      from cut_and_study_functions import append_lepton_indices, append_flavor_indices
-      event_dictionary = append_lepton_indices(event_dictionary)
-      if ("Data" not in process):
-        protected_branches = ["FS_t1_flav", "FS_t2_flav", "pass_gen_cuts", "event_flavor"]
-        from file_functions import load_and_store_NWEvents
-        load_and_store_NWEvents(process, event_dictionary)
-        # Remove fakes from MC if they come from TT or WJ samples.
-        # We do this because we assume their jetFakes are not well-modeled
-        # and so we replace them with the JetFakes estimate from Data.
-        # For other MC, we use the fakes from MC, meaning those should be subtracted from Data
-        # during the estimate.
-        keep_fakes = False if (("TT" in process) or ("WJ" in process)) else True
-        event_dictionary = append_flavor_indices(event_dictionary, final_state_mode, keep_fakes=keep_fakes)
-        event_dictionary = apply_cut(event_dictionary, "pass_gen_cuts", protected_branches)
-        if (event_dictionary==None or len(event_dictionary["run"])==0): continue
-
-      event_dictionary = FF_control_flow(final_state_mode, semilep_mode, region, event_dictionary, DeepTau_version)
-      event_dictionary = apply_cut(event_dictionary, "pass_"+region+"_cuts", protected_branches)
-
-      if (event_dictionary==None or len(event_dictionary["run"])==0): continue
-      from cut_and_study_functions import apply_jet_cut
-      event_dictionary   = apply_jet_cut(event_dictionary, jet_mode)
-      if (event_dictionary==None or len(event_dictionary["run"])==0): continue
-
-      skip_DeepTau = True
-      if (final_state_mode == "ditau"):
-        from cut_ditau_functions import make_ditau_cut
-        event_dictionary   = make_ditau_cut(era, event_dictionary, DeepTau_version, skip_DeepTau, tau_pt_cut)
-        if (event_dictionary==None or len(event_dictionary["run"])==0): continue
-
-      if (final_state_mode == "mutau"):
-        from cut_mutau_functions import make_mutau_cut
-        event_dictionary   = make_mutau_cut(era, event_dictionary, DeepTau_version)
-        if (event_dictionary==None or len(event_dictionary["run"])==0): continue
-
-      if (final_state_mode == "etau"):
-        from cut_etau_functions import make_etau_cut
-        event_dictionary   = make_etau_cut(era, event_dictionary, DeepTau_version)
-        if (event_dictionary==None or len(event_dictionary["run"])==0): continue
-
-      protected_branches = set_protected_branches(final_state_mode=final_state_mode, jet_mode="none")
-      event_dictionary   = apply_cut(event_dictionary, "pass_cuts", protected_branches)
-      if (event_dictionary==None or len(event_dictionary["run"])==0): continue
-      # then skip DY splitting stuff because we subtract MC from Data later where the MC is all combined anyways
-
-      event_dictionary = add_HpT_correction(process, event_dictionary)
-
-      combined_process_dictionaryFakes = append_to_combined_processes(process, event_dictionary, vars_to_plot, 
-                                                             combined_process_dictionaryFakes, one_file_at_a_time)
-
-      del new_process_dictionary
-      del event_dictionary
-      gc.collect()
-
-  # after loop, sort big dictionary into three smaller ones
+  work_units = list(files_to_process(file_map, reject_datasets, semilep_mode, using_directory, one_file_at_a_time,
+                                     catalog, log_file))
+  if catalog != None:
+    # normalizations from the catalog, so samples with no events passing the cuts are set too
+    for process, input_file in work_units:
+      if ("Data" in process): continue
+      XSecMCweights = [catalog[path + ".root"]["XSecMCweight"] for path in catalog_files(catalog, input_file)[0]]
+      XSecMCweights = [XSecMCweight for XSecMCweight in XSecMCweights if XSecMCweight != None]
+      if len(XSecMCweights) > 0:
+        store_XSecMCweight("TTToSemiLeptonic" if "TTToSemiLeptonic" in process else process, XSecMCweights[0])
+  unit_sizes = [sum(size for _, size, _ in input_file_signature(using_directory + "/" + input_file + ".root"))
+                for _, input_file in work_units]
+  if log_file: log_file.flush() # forked workers would get a copy of unwritten lines
+  # the next files are read on a thread while the current one is cut, not with worker processes or streaming
+  prefetcher = None
+  if (prefetch > 0) and (jobs <= 1) and (not setup.streaming):
+    prefetcher = FilePrefetcher(functools.partial(load_file, settings=settings), planned_loads(work_units, settings),
+                                depth=prefetch)
+  finished_units = {}
+  for unit_index, unit_results in run_work_units(process_file_unit, work_units, jobs, unit_sizes,
+                                                 arguments=(settings, prefetcher), start_method=setup.start_method):
+    finished_units[unit_index] = unit_results[:-1]
+    if log_file: log_file.write(unit_results[-1]) # lines logged by a worker, empty if the unit ran here
+    del unit_results
+    gc.collect()
+  if prefetcher != None: prefetcher.close()
+  for unit_index in range(len(work_units)):
+    unit_dictionary, unit_dictionaryFakes, XSec_updates, unit_vars_to_plot = finished_units.pop(unit_index)
+    for name, XSecMCweight in XSec_updates.items():
+      MC_dictionary[name]["XSecMCweight"] = XSecMCweight
+    vars_to_plot += [var for var in unit_vars_to_plot if var not in vars_to_plot]
+    for unit_process, process_entry in unit_dictionary.items():
+      combined_process_dictionary = add_to_combined_processes(unit_process, process_entry,
+                                                              combined_process_dictionary, append_one_at_a_time)
+    for unit_process, process_entry in unit_dictionaryFakes.items():
+      combined_process_dictionaryFakes = add_to_combined_processes(unit_process, process_entry,
+                                                                   combined_process_dictionaryFakes, append_one_at_a_time)
+    del unit_dictionary, unit_dictionaryFakes
+  gc.collect()
+
+  # after loop, sort big dictionaries into three smaller ones
+  data_dictionary, background_dictionary, signal_dictionary = sort_combined_processes(combined_process_dictionary)
   data_dictionaryFakes, background_dictionaryFakes, signal_dictionaryFakes = sort_combined_processes(combined_process_dictionaryFakes, fakes=True)
     
   fakesLabel = "JetFakes"
   # TODO: if mutau or etau give handling for two binned processes, JetFakes_QCD and JetFakes_WJ
 
   binned_JetFakes_var_dictionary = {}
+  # every variable is histogrammed in one pass over each process, the loops below only pick out the histograms
+  binned_Fakes = get_binned_all_vars(final_state_mode, testing, data_dictionaryFakes, background_dictionaryFakes,
+                                     signal_dictionaryFakes, vars_to_plot, lumi)
   for var in vars_to_plot:
     log_print(f"Plotting {var}", log_file, time=True)
     xbins = make_bins(var, final_state_mode)
 
-    h_data               = get_binned_data(final_state_mode, testing, data_dictionaryFakes, var, xbins, lumi)
-    h_backgrounds        = get_binned_backgrounds(final_state_mode, testing, background_dictionaryFakes, var, xbins, lumi)
+    h_data               = binned_Fakes[var]["Data"]
+    h_backgrounds        = binned_Fakes[var]["Backgrounds"]
     h_summed_backgrounds = get_summed_backgrounds(h_backgrounds)
-    h_signals            = get_binned_signals(final_state_mode, testing, signal_dictionaryFakes, var, xbins, lumi) 
+    h_signals            = binned_Fakes[var]["Signals"]
 
     # FF background = h_data(already mult. by FF) - h_summed_backgrounds(ditto) - h_signals(ditto)
     if testing:
@@ -433,19 +711,20 @@ if __name__ == "__main__":
                     + str(unrolled_var) + ".png", dpi=200)
  
 
+  binned_SR = get_binned_all_vars(final_state_mode, testing, data_dictionary, background_dictionary,
+                                  signal_dictionary, vars_to_plot, lumi, presentation_mode)
   for var in vars_to_plot:
     if DEBUG: log_print(f"Plotting {var}", log_file, time=True)
 
     xbins = make_bins(var, final_state_mode)
     hist_ax, hist_ratio = setup_ratio_plot()
 
-    h_data = get_binned_data(final_state_mode, testing, data_dictionary, var, xbins, lumi)
-    h_backgrounds = get_binned_backgrounds(final_state_mode, testing, background_dictionary, var, xbins, lumi,
-                                           presentation_mode)
+    h_data = binned_SR[var]["Data"]
+    h_backgrounds = binned_SR[var]["Backgrounds"]
     h_summed_backgrounds = get_summed_backgrounds(h_backgrounds)
     extra_hist = binned_JetFakes_var_dictionary[var]["BinnedEvents"]
     h_summed_backgrounds["Bkgd"]["BinnedEvents"] += extra_hist # adding JetFakes
-    h_signals = get_binned_signals(final_state_mode, testing, signal_dictionary, var, xbins, lumi) 
+    h_signals = binned_SR[var]["Signals"]
 
     # plot everything :)
     plot_data(   hist_ax, xbins, h_data,        lumi, presentation_mode)